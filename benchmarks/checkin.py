@@ -0,0 +1,79 @@
+"""Measures the latency of an incremental check-in against the tree size.
+
+Builds synthetic folders of increasing size in a temporary directory, commits
+them once, then times a rescan of the unchanged tree (what happens on startup)
+and :meth:`~gitobox.git.GitRepository.check_in` after modifying a single file.
+With incremental staging, that last time should stay flat as the tree grows.
+
+Usage: python benchmarks/checkin.py [size ...]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import logging
+import os
+from rpaths import Path
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gitobox.git import GitRepository  # noqa
+
+
+def make_tree(root, nb_files, per_dir=100):
+    for i in range(nb_files):
+        directory = root / ('d%d' % (i // per_dir))
+        if i % per_dir == 0:
+            directory.mkdir()
+        with (directory / ('f%d.txt' % i)).open('w') as fp:
+            fp.write("file %d\n" % i)
+
+
+def bench(nb_files):
+    tmp = Path.tempdir(prefix='gitobox_bench_')
+    try:
+        folder = tmp / 'folder'
+        folder.mkdir()
+        make_tree(folder, nb_files)
+        subprocess.check_call(['git', 'init', '-q', '--bare',
+                               (tmp / 'repo').path])
+        subprocess.check_call(['git', '--git-dir', (tmp / 'repo').path,
+                               'config', 'user.name', 'bench'])
+        subprocess.check_call(['git', '--git-dir', (tmp / 'repo').path,
+                               'config', 'user.email', 'bench@localhost'])
+        repo = GitRepository(tmp / 'repo', folder, 'master', b'password',
+                             15550)
+
+        start = time.time()
+        repo.check_in()
+        full = time.time() - start
+
+        start = time.time()
+        repo.check_in()
+        rescan = time.time() - start
+
+        changed = folder / 'd0' / 'f0.txt'
+        with changed.open('w') as fp:
+            fp.write("changed\n")
+        start = time.time()
+        repo.check_in([changed.path])
+        incremental = time.time() - start
+
+        print("%8d files: full check-in %7.3fs, unchanged rescan %7.3fs, "
+              "one-file check-in %7.3fs" % (
+                  nb_files, full, rescan, incremental))
+    finally:
+        tmp.rmtree()
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 50000]
+    for size in sizes:
+        bench(size)
+
+
+if __name__ == '__main__':
+    main()
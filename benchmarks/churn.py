@@ -0,0 +1,179 @@
+"""Stress test of the watcher: no change is lost under sustained churn.
+
+Writer threads create and modify files in a temporary folder as fast as they
+can for a while, and a watcher feeds the changes to a callback standing in
+for the check-in, that takes a fixed time (``--commit-time``) to run. The
+watcher's maximum delay forces several "check-ins" during the churn.
+
+Once the writers stop and the watcher settles, the last write to every file
+has to have been followed by a callback that got the file, or a directory
+containing it (which the check-in would scan); the script exits with status
+1 otherwise. It also reports how long the watcher's event handlers waited to
+start the timer: that is time the observer's thread is not reading events,
+which should stay far below the commit time.
+
+Usage: python benchmarks/churn.py [--duration SECONDS] [--writers N]
+    [--commit-time SECONDS] [--max-delay SECONDS] [--poll SECONDS]
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import logging
+import os
+import random
+from rpaths import Path
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gitobox.locking import SyncLock  # noqa
+from gitobox.watch import DirectoryWatcher, PollingWatcher  # noqa
+
+
+class Collector(object):
+    """The callback: records the paths it gets, slowly.
+    """
+    def __init__(self, commit_time):
+        self.commit_time = commit_time
+        # Path -> when the latest callback that got it started
+        self.paths = {}
+        self.calls = 0
+        self.all_changed = 0
+
+    def __call__(self, changes=None, moves=()):
+        start = time.time()
+        self.calls += 1
+        if changes is None:
+            self.all_changed += 1
+        else:
+            for path in changes:
+                self.paths[path] = start
+        time.sleep(self.commit_time)
+
+
+def delivered(paths, path):
+    """Gets the latest callback that got `path` or one of its parents.
+    """
+    latest = 0.0
+    while True:
+        latest = max(latest, paths.get(path, 0.0))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return latest
+        path = parent
+
+
+def time_calls(function, durations):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            durations.append(time.time() - start)
+    return wrapper
+
+
+def writer(folder, number, deadline, written):
+    rng = random.Random(number)
+    mine = []
+    i = 0
+    while time.time() < deadline:
+        if mine and rng.random() < 0.5:
+            path = rng.choice(mine)
+        else:
+            directory = folder / ('w%d' % number) / ('d%d' % (i // 50))
+            if i % 50 == 0:
+                directory.mkdir(parents=True)
+            path = directory / ('f%d' % i)
+            mine.append(path)
+            i += 1
+        with path.open('w') as fp:
+            fp.write('%f\n' % time.time())
+        written[path.path.decode('utf-8')] = time.time()
+        time.sleep(rng.random() * 0.002)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Checks that no change is lost while check-ins run")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--commit-time', type=float, default=1.0)
+    parser.add_argument('--timeout', type=float, default=0.2)
+    parser.add_argument('--max-delay', type=float, default=2.0)
+    parser.add_argument('--poll', type=float, default=0.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    tmp = Path.tempdir(prefix='gitobox_churn_')
+    try:
+        folder = tmp / 'folder'
+        folder.mkdir()
+        collector = Collector(args.commit_time)
+        lock = SyncLock(name=str(folder))
+        if args.poll:
+            watcher = PollingWatcher(folder, collector, lock, args.timeout,
+                                     interval=args.poll, budget=1.0,
+                                     max_delay=args.max_delay)
+        else:
+            watcher = DirectoryWatcher(folder, collector, lock, args.timeout,
+                                       max_delay=args.max_delay)
+        starts = []
+        watcher._timer.start = time_calls(watcher._timer.start, starts)
+        watcher.run()
+        time.sleep(max(args.poll * 2, 0.5))
+
+        # Path -> when its last write ended
+        written = {}
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target=writer,
+                                    args=(folder, n, deadline, written))
+                   for n in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stopped = time.time()
+
+        # Waits for the last changes to come through
+        timer = watcher._timer
+        quiet_since = None
+        while quiet_since is None or time.time() - quiet_since < 2.0:
+            time.sleep(0.1)
+            if timer.primed_for() is None and not timer.executing:
+                if quiet_since is None:
+                    quiet_since = time.time()
+            else:
+                quiet_since = None
+            if time.time() - stopped > 60.0 + args.poll * 4:
+                print("Watcher didn't settle")
+                break
+
+        lost = sorted(path for path, when in written.items()
+                      if delivered(collector.paths, path) < when)
+        starts.sort()
+        print("%d paths written by %d writers in %.1fs" % (
+              len(written), args.writers, args.duration))
+        print("%d callbacks (%.1fs each), %d paths delivered" % (
+              collector.calls, args.commit_time, len(collector.paths)))
+        if starts:
+            print("timer start(): %d calls, median %.2fms, 99th percentile "
+                  "%.2fms, max %.2fms" % (
+                      len(starts), starts[len(starts) // 2] * 1000,
+                      starts[int(len(starts) * 0.99)] * 1000,
+                      starts[-1] * 1000))
+        if lost:
+            print("LOST %d paths, e.g.:" % len(lost))
+            for path in lost[:10]:
+                print("  %s" % path)
+            sys.exit(1)
+        print("No path lost")
+    finally:
+        tmp.rmtree()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Measures a full check-in of a tree of large files, serial vs. parallel.
+
+Builds a synthetic folder of mixed file sizes (many small documents, some
+images, a few big archives) filled with incompressible data, then times
+:meth:`~gitobox.git.GitRepository.check_in` with a single hashing process and
+with one per core. Each run uses a fresh repository and an empty stat cache.
+
+The default total size is small enough to run quickly; pass a bigger one to
+reproduce real folders (the tree is written in the temporary directory, use
+TMPDIR to put it on the right disk).
+
+Usage: python benchmarks/hashing.py [total size, e.g. 500M or 10G] [jobs ...]
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import logging
+import multiprocessing
+import os
+import random
+from rpaths import Path
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gitobox.git import GitRepository  # noqa
+
+
+# (probability, minimum size, maximum size)
+SIZES = [(0.70, 4 << 10, 256 << 10),
+         (0.25, 1 << 20, 16 << 20),
+         (0.05, 64 << 20, 512 << 20)]
+
+POOL_SIZE = 64 << 20
+CHUNK_SIZE = 1 << 20
+
+
+def parse_size(s):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if s[-1].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
+
+def make_tree(root, total):
+    """Writes files of random sizes until `total` bytes were written.
+    """
+    rng = random.Random(42)
+    # Random data to copy from; offsets are random, so files don't repeat
+    # within zlib's window and don't compress
+    pool = os.urandom(POOL_SIZE)
+    written = nb_files = 0
+    while written < total:
+        r = rng.random()
+        for probability, low, high in SIZES:
+            if r < probability:
+                break
+            r -= probability
+        size = min(rng.randint(low, high), total - written)
+        directory = root / ('d%d' % (nb_files // 100))
+        if nb_files % 100 == 0:
+            directory.mkdir()
+        with (directory / ('f%d.bin' % nb_files)).open('wb') as fp:
+            fp.write(('file %d\n' % nb_files).encode('ascii'))
+            left = size
+            while left > 0:
+                length = min(left, CHUNK_SIZE)
+                offset = rng.randint(0, POOL_SIZE - length)
+                fp.write(pool[offset:offset + length])
+                left -= length
+        written += size
+        nb_files += 1
+    return nb_files
+
+
+def bench(tmp, folder, jobs):
+    repo = tmp / ('repo%d' % jobs)
+    subprocess.check_call(['git', 'init', '-q', '--bare', repo.path])
+    subprocess.check_call(['git', '--git-dir', repo.path,
+                           'config', 'user.name', 'bench'])
+    subprocess.check_call(['git', '--git-dir', repo.path,
+                           'config', 'user.email', 'bench@localhost'])
+    try:
+        repository = GitRepository(repo, folder, 'master', b'password',
+                                   15550, hash_jobs=jobs)
+        start = time.time()
+        repository.check_in()
+        return time.time() - start
+    finally:
+        repo.rmtree()
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    total = parse_size(sys.argv[1]) if len(sys.argv) > 1 else 500 << 20
+    jobs = ([int(a) for a in sys.argv[2:]] or
+            [1, multiprocessing.cpu_count()])
+
+    tmp = Path.tempdir(prefix='gitobox_bench_')
+    try:
+        folder = tmp / 'folder'
+        folder.mkdir()
+        start = time.time()
+        nb_files = make_tree(folder, total)
+        print("Wrote %d files, %.1f MiB in %.1fs" % (
+              nb_files, total / (1 << 20), time.time() - start))
+        for nb in jobs:
+            duration = bench(tmp, folder, nb)
+            print("%3d hashing processes: full check-in %8.2fs "
+                  "(%.1f MiB/s)" % (nb, duration,
+                                    total / (1 << 20) / duration))
+    finally:
+        tmp.rmtree()
+
+
+if __name__ == '__main__':
+    main()
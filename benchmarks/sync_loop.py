@@ -0,0 +1,493 @@
+"""Benchmarks the whole synchronization loop, end to end.
+
+For each tree size, builds a synthetic folder and a bare repository in a
+temporary directory, starts ``gitobox`` on them in a separate process and
+drives it like its users would:
+
+* initial: time from startup to the first commit;
+* storm: rewrites, creates and deletes many files as fast as possible, then
+  measures the time from the last change to the commit;
+* push: pushes a commit changing some files from a clone, through the real
+  pre-receive and post-receive hooks, and reads the check-out time from the
+  metrics endpoint;
+* concurrent: pushes from several clones at once while the folder is still
+  changing, so the pushes wait in line for the debounce. Pushes that were
+  made on top of the previous commit are rejected if the folder's changes
+  get committed first, or if another push wins.
+
+For each scenario, the CPU time (including Git processes), peak RSS and
+number of read/write system calls of the gitobox process are read from
+/proc. With ``--strace``, the total number of system calls of gitobox and
+its children is counted with ``strace -c`` as well.
+
+Everything is local and the random generator is seeded, so results of
+different commits can be compared; ``--json`` writes them with the gitobox
+commit, Git version and machine they were measured on.
+
+Linux only.
+
+Usage: python benchmarks/sync_loop.py [--json FILE] [--strace] [size ...]
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+from rpaths import Path
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # PY2
+    from urllib2 import urlopen
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+IDENTITY = {'GIT_AUTHOR_NAME': 'bench', 'GIT_AUTHOR_EMAIL': 'bench@localhost',
+            'GIT_COMMITTER_NAME': 'bench',
+            'GIT_COMMITTER_EMAIL': 'bench@localhost'}
+
+
+def make_env():
+    env = dict(os.environ)
+    env.update(IDENTITY)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+ENV = make_env()
+
+
+def git(*args, **kwargs):
+    return subprocess.check_output(['git'] + list(args), env=ENV,
+                                   stderr=subprocess.STDOUT, **kwargs)
+
+
+def write_file(path, rng, size=None):
+    if size is None:
+        size = rng.randint(100, 4000)
+    with open(path, 'wb') as fp:
+        fp.write(('%d\n' % rng.getrandbits(64)).encode('ascii'))
+        fp.write(b'x' * size)
+
+
+def make_tree(root, nb_files, rng):
+    for i in range(nb_files):
+        directory = os.path.join(root, 'd%d' % (i // 100))
+        if i % 100 == 0:
+            os.mkdir(directory)
+        write_file(os.path.join(directory, 'f%d.txt' % i), rng)
+
+
+def tree_files(nb_files):
+    return [os.path.join('d%d' % (i // 100), 'f%d.txt' % i)
+            for i in range(nb_files)]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def read_ref(repo, branch='master'):
+    """Reads a branch directly, cheaper than running Git in a loop.
+    """
+    try:
+        with open(os.path.join(repo, 'refs', 'heads', branch), 'rb') as fp:
+            return fp.read().strip()
+    except IOError:
+        pass
+    try:
+        with open(os.path.join(repo, 'packed-refs'), 'rb') as fp:
+            for line in fp:
+                if line.rstrip().endswith(b' refs/heads/' +
+                                          branch.encode('ascii')):
+                    return line.split(b' ', 1)[0]
+    except IOError:
+        pass
+    return None
+
+
+def wait_for_ref(repo, old, timeout=600.0):
+    """Waits for the branch to move away from `old`.
+
+    Returns the time at which it did.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if read_ref(repo) != old:
+            return time.time()
+        time.sleep(0.01)
+    raise RuntimeError("Timed out waiting for a commit")
+
+
+def proc_stats(pid):
+    """Reads CPU time, memory and I/O counters of a process from /proc.
+    """
+    stats = {}
+    with open('/proc/%d/stat' % pid) as fp:
+        fields = fp.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf(str('SC_CLK_TCK'))
+    # utime, stime, cutime, cstime (children that have been waited for)
+    stats['cpu_user'] = (int(fields[11]) + int(fields[13])) / ticks
+    stats['cpu_system'] = (int(fields[12]) + int(fields[14])) / ticks
+    with open('/proc/%d/status' % pid) as fp:
+        for line in fp:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                stats[key.lower() + '_kb'] = int(value.split()[0])
+    try:
+        with open('/proc/%d/io' % pid) as fp:
+            for line in fp:
+                key, _, value = line.partition(':')
+                if key in ('syscr', 'syscw', 'read_bytes', 'write_bytes'):
+                    stats[key] = int(value)
+    except IOError:
+        pass
+    return stats
+
+
+def stats_delta(before, after):
+    delta = {}
+    for key, value in after.items():
+        if key.startswith('vm'):
+            delta[key] = value
+        else:
+            delta[key] = value - before.get(key, 0)
+    return delta
+
+
+_metric_line = re.compile(r'^([a-z_]+)(\{[^}]*\})? (\S+)$')
+
+
+def scrape(port):
+    """Fetches the metrics, as a dict mapping (name, labels) to values.
+    """
+    metrics = {}
+    body = urlopen('http://127.0.0.1:%d/metrics' % port).read()
+    for line in body.decode('utf-8').splitlines():
+        m = _metric_line.match(line)
+        if m is not None:
+            metrics[(m.group(1), m.group(2) or '')] = float(m.group(3))
+    return metrics
+
+
+def metric_sum(metrics, name, label=''):
+    return sum(v for (n, labels), v in metrics.items()
+               if n == name and label in labels)
+
+
+class Gitobox(object):
+    """Runs gitobox on a folder in a separate process.
+    """
+    def __init__(self, folder, repo, timeout, log_file, strace_file=None):
+        self.metrics_port = free_port()
+        self.log_file = log_file
+        cmd = [sys.executable, '-m', 'gitobox', '-t', str(timeout),
+               '--metrics-port', str(self.metrics_port), folder, repo]
+        if strace_file is not None:
+            cmd = ['strace', '-f', '-c', '-o', strace_file] + cmd
+        with open(log_file, 'wb') as log:
+            self.process = subprocess.Popen(cmd, env=ENV, stdout=log,
+                                            stderr=subprocess.STDOUT)
+        self.pid = self.process.pid
+        if strace_file is not None:
+            self.pid = self._find_child()
+
+    def _find_child(self):
+        # The process we want to measure is strace's child
+        for _ in range(500):
+            try:
+                with open('/proc/%d/task/%d/children' % (
+                        self.process.pid, self.process.pid)) as fp:
+                    children = fp.read().split()
+                if children:
+                    return int(children[0])
+            except IOError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("Couldn't find gitobox under strace")
+
+    def wait_ready(self):
+        for _ in range(1000):
+            try:
+                return scrape(self.metrics_port)
+            except (IOError, OSError):
+                if self.process.poll() is not None:
+                    with open(self.log_file) as fp:
+                        sys.stderr.write(fp.read())
+                    raise RuntimeError("gitobox exited with status %d" %
+                                       self.process.returncode)
+                time.sleep(0.02)
+        raise RuntimeError("gitobox didn't start")
+
+    def stats(self):
+        return proc_stats(self.pid)
+
+    def stop(self):
+        if self.process.poll() is None:
+            os.kill(self.pid, signal.SIGINT)
+            self.process.wait()
+
+
+def parse_strace(filename):
+    """Reads the total number of calls from a ``strace -c`` summary.
+    """
+    with open(filename) as fp:
+        for line in fp:
+            fields = line.split()
+            if fields and fields[-1] == 'total':
+                # % time, seconds, usecs/call, calls, [errors,] total
+                return int(fields[3])
+    return None
+
+
+def scenario_storm(folder, repo, files, nb_changes, rng):
+    old = read_ref(repo)
+    changed = rng.sample(files, min(nb_changes, len(files)))
+    for path in changed:
+        write_file(os.path.join(folder, path), rng)
+    for i in range(nb_changes // 10):
+        write_file(os.path.join(folder, 'd0', 'storm%d.txt' % i), rng)
+    for i in range(nb_changes // 20):
+        os.remove(os.path.join(folder, 'd0', 'storm%d.txt' % i))
+    last_change = time.time()
+    return {'changes': nb_changes,
+            'commit_latency': wait_for_ref(repo, old) - last_change}
+
+
+def clone(repo, target):
+    git('clone', '-q', repo, target)
+
+
+def update_clone(path):
+    git('-C', path, 'fetch', '-q', 'origin')
+    git('-C', path, 'reset', '-q', '--hard', 'origin/master')
+
+
+def commit_in_clone(path, files, rng, message):
+    for name in files:
+        write_file(os.path.join(path, name), rng)
+    git('-C', path, 'add', '--', *files)
+    git('-C', path, 'commit', '-q', '-m', message)
+
+
+def push(path):
+    """Pushes to master, returns (duration, success).
+    """
+    start = time.time()
+    proc = subprocess.Popen(['git', '-C', path, 'push', '-q', 'origin',
+                             'HEAD:master'],
+                            env=ENV, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    proc.communicate()
+    return time.time() - start, proc.returncode == 0
+
+
+def scenario_push(gitobox, clone_dir, files, nb_changes, rng):
+    update_clone(clone_dir)
+    commit_in_clone(clone_dir, rng.sample(files, min(nb_changes, len(files))),
+                    rng, 'push')
+    before = scrape(gitobox.metrics_port)
+    duration, ok = push(clone_dir)
+    after = scrape(gitobox.metrics_port)
+    name = 'gitobox_operation_seconds_sum'
+    return {'changes': nb_changes, 'push_time': duration, 'ok': ok,
+            'check_out_time': (metric_sum(after, name, 'check_out') -
+                               metric_sum(before, name, 'check_out'))}
+
+
+def scenario_concurrent(gitobox, folder, clones, files, rng, storm_time):
+    for i, clone_dir in enumerate(clones):
+        update_clone(clone_dir)
+        commit_in_clone(clone_dir, ['concurrent%d.txt' % i], rng,
+                        'concurrent %d' % i)
+
+    # Keeps the folder changing for a while
+    stop = threading.Event()
+    storm_rng = random.Random(rng.getrandbits(32))
+
+    def storm():
+        paths = storm_rng.sample(files, min(100, len(files)))
+        while not stop.is_set():
+            write_file(os.path.join(folder, storm_rng.choice(paths)),
+                       storm_rng)
+            time.sleep(0.01)
+    thread = threading.Thread(target=storm)
+    thread.start()
+    time.sleep(0.2)
+
+    results = [None] * len(clones)
+
+    def do_push(i):
+        results[i] = push(clones[i])
+    threads = [threading.Thread(target=do_push, args=(i,))
+               for i in range(len(clones))]
+    for t in threads:
+        t.start()
+    time.sleep(storm_time)
+    stop.set()
+    thread.join()
+    for t in threads:
+        t.join()
+    return {'pushes': len(clones),
+            'ok': sum(1 for _, ok in results if ok),
+            'push_times': [d for d, _ in results],
+            'max_push_time': max(d for d, _ in results)}
+
+
+def bench(nb_files, args):
+    rng = random.Random(args.seed)
+    tmp = Path.tempdir(prefix='gitobox_bench_')
+    try:
+        folder = (tmp / 'folder').path.decode('utf-8')
+        repo = (tmp / 'repo').path.decode('utf-8')
+        os.mkdir(folder)
+        make_tree(folder, nb_files, rng)
+        files = tree_files(nb_files)
+        git('init', '-q', '--bare', repo)
+
+        strace_file = None
+        if args.strace:
+            strace_file = (tmp / 'strace.txt').path.decode('utf-8')
+        results = {'files': nb_files}
+
+        start = time.time()
+        gitobox = Gitobox(folder, repo, args.timeout,
+                          (tmp / 'gitobox.log').path.decode('utf-8'),
+                          strace_file)
+        try:
+            gitobox.wait_ready()
+            before = gitobox.stats()
+            results['initial'] = {'commit_latency':
+                                  wait_for_ref(repo, None) - start}
+            after = gitobox.stats()
+            results['initial'].update(stats_delta(before, after))
+
+            before = after
+            results['storm'] = scenario_storm(folder, repo, files,
+                                              args.storm, rng)
+            after = gitobox.stats()
+            results['storm'].update(stats_delta(before, after))
+
+            clones = []
+            for i in range(args.pushers):
+                clone_dir = (tmp / ('clone%d' % i)).path.decode('utf-8')
+                clone(repo, clone_dir)
+                clones.append(clone_dir)
+
+            before = gitobox.stats()
+            results['push'] = scenario_push(gitobox, clones[0], files,
+                                            args.push, rng)
+            after = gitobox.stats()
+            results['push'].update(stats_delta(before, after))
+
+            before = after
+            results['concurrent'] = scenario_concurrent(
+                gitobox, folder, clones, files, rng, args.storm_time)
+            after = gitobox.stats()
+            results['concurrent'].update(stats_delta(before, after))
+
+            results['total'] = after
+        finally:
+            gitobox.stop()
+        if strace_file is not None:
+            results['total']['syscalls'] = parse_strace(strace_file)
+        return results
+    finally:
+        tmp.rmtree()
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', '-C', ROOT, 'describe', '--always', '--dirty'],
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'gitobox_commit': commit,
+            'git_version': git('--version').decode('ascii').strip(),
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count()}
+
+
+def report(result):
+    print("%d files:" % result['files'])
+    for name in ('initial', 'storm', 'push', 'concurrent'):
+        r = result[name]
+        details = []
+        if 'commit_latency' in r:
+            details.append("commit latency %.3fs" % r['commit_latency'])
+        if 'push_time' in r:
+            details.append("push %.3fs%s, check-out %.3fs" % (
+                r['push_time'], "" if r['ok'] else " (FAILED)",
+                r['check_out_time']))
+        if 'pushes' in r:
+            details.append("%d/%d pushes ok, slowest %.3fs" % (
+                r['ok'], r['pushes'], r['max_push_time']))
+        details.append("cpu %.2fs user %.2fs sys" % (r['cpu_user'],
+                                                     r['cpu_system']))
+        if 'syscr' in r:
+            details.append("%d read + %d write syscalls" % (r['syscr'],
+                                                            r['syscw']))
+        print("  %-10s %s" % (name, ", ".join(details)))
+    total = result['total']
+    print("  %-10s peak RSS %.1f MiB%s" % (
+        'total', total['vmhwm_kb'] / 1024,
+        "" if total.get('syscalls') is None
+        else ", %d syscalls (strace)" % total['syscalls']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End-to-end benchmark of gitobox's synchronization loop")
+    parser.add_argument('sizes', nargs='*', type=int,
+                        default=[1000, 10000, 100000],
+                        help="Number of files in the synthetic folders")
+    parser.add_argument('--json', action='store',
+                        help="Write the results to this file")
+    parser.add_argument('--strace', action='store_true',
+                        help="Count system calls with strace (slower)")
+    parser.add_argument('--timeout', type=int, default=1,
+                        help="Debounce timeout given to gitobox")
+    parser.add_argument('--storm', type=int, default=1000,
+                        help="Number of changes in the storm scenario")
+    parser.add_argument('--push', type=int, default=100,
+                        help="Number of files changed by the pushed commit")
+    parser.add_argument('--pushers', type=int, default=3,
+                        help="Number of concurrent pushes")
+    parser.add_argument('--storm-time', type=float, default=1.5,
+                        help="How long the folder keeps changing during "
+                        "concurrent pushes")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    output = {'environment': environment(), 'parameters': vars(args),
+              'results': []}
+    for size in args.sizes:
+        result = bench(size, args)
+        report(result)
+        output['results'].append(result)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(output, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Uncompressed copies of blobs, to check them out without Git.
+
+Contains :class:`~gitobox.blobcache.BlobCache`.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+import os
+from threading import Lock
+
+from gitobox.copying import copy_data
+from gitobox.metrics import BLOB_CACHE
+from gitobox.utils import make_unique_bytestring
+
+
+class BlobCache(object):
+    """Content-addressed cache of blobs, stored as plain files.
+
+    Files are named after the blob's ID (``ab/cdef...``) and are read-only.
+    Checking out a cached blob is a file copy, which
+    :func:`~gitobox.copying.copy_data` turns into a clone on copy-on-write
+    filesystems and into a copy in the kernel elsewhere, instead of Git
+    inflating the object and Python writing it out.
+
+    Only blobs of at least `MIN_SIZE` bytes are cached. When the cache grows
+    over `max_size` bytes, the least recently used blobs are removed.
+    """
+    MIN_SIZE = 64 << 10
+
+    # Fraction of max_size that is kept when trimming
+    TRIM_TARGET = 0.8
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._temp = path / 'tmp'
+        self._lock = Lock()
+        # Total size of the blobs, computed on first use
+        self._size = None
+
+    def _blob_path(self, blob):
+        blob = blob.decode('ascii')
+        return self.path / blob[:2] / blob[2:]
+
+    def copy_to(self, blob, fp):
+        """Writes a blob from the cache to an open file.
+
+        Returns False if it is not in the cache.
+        """
+        path = self._blob_path(blob)
+        try:
+            src = path.open('rb')
+        except (IOError, OSError):
+            BLOB_CACHE.inc(result='miss')
+            return False
+        with src:
+            copy_data(src, fp)
+        BLOB_CACHE.inc(result='hit')
+        try:
+            # Marks it as recently used
+            os.utime(path.path, None)
+        except OSError:
+            pass
+        return True
+
+    def wants(self, size):
+        """Checks whether a blob of that size should be cached.
+        """
+        return self.MIN_SIZE <= size <= self.max_size * self.TRIM_TARGET
+
+    def add(self, blob, filename):
+        """Copies a file known to have the content of `blob` into the cache.
+        """
+        target = self._blob_path(blob)
+        if target.exists():
+            return
+        if not self._temp.is_dir():
+            self._temp.mkdir(parents=True)
+        temp = self._temp / make_unique_bytestring().decode('ascii')
+        try:
+            with open(filename, 'rb') as src:
+                with temp.open('wb') as dst:
+                    copy_data(src, dst)
+            size = os.stat(temp.path).st_size
+            if not target.parent.is_dir():
+                target.parent.mkdir(parents=True)
+            temp.chmod(0o444)
+            temp.rename(target)
+        except Exception:
+            if temp.exists():
+                temp.remove()
+            raise
+        self._added(size)
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._list())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._trim()
+
+    def _list(self):
+        """Lists the cached blobs, as (path, mtime, size) tuples.
+
+        The mtime is updated when a blob is used.
+        """
+        blobs = []
+        for directory in self.path.listdir():
+            if directory == self._temp or not directory.is_dir():
+                continue
+            for path in directory.listdir():
+                try:
+                    st = os.stat(path.path)
+                except OSError:
+                    continue
+                blobs.append((path, st.st_mtime, st.st_size))
+        return blobs
+
+    def _trim(self):
+        """Removes the least recently used blobs; call with the lock held.
+        """
+        blobs = sorted(self._list(), key=lambda b: b[1])
+        size = sum(b[2] for b in blobs)
+        target = self.max_size * self.TRIM_TARGET
+        removed = 0
+        for path, _, blob_size in blobs:
+            if size <= target:
+                break
+            try:
+                path.remove()
+            except OSError:
+                continue
+            size -= blob_size
+            removed += 1
+        self._size = size
+        logging.info("Removed %d blobs from the blob cache, %d bytes left",
+                     removed, size)
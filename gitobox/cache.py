@@ -0,0 +1,179 @@
+"""Persistent stat cache.
+
+Contains :class:`~gitobox.cache.StatCache`, which remembers the blob ID of
+every file of the synced folder along with its (size, mtime, inode), so that
+files which didn't change don't need to be read and hashed again, even across
+restarts.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+import sqlite3
+from threading import Lock
+import time
+
+
+class StatCache(object):
+    """Maps (path, size, mtime_ns, inode) to a Git mode and blob ID.
+
+    The cache is stored in an SQLite database. Paths are relative to the
+    synced folder; paths, modes (e.g. ``b'100644'``) and IDs are bytes. It is
+    safe to use from multiple threads.
+
+    Like Git's index, it guards against "racily clean" entries: a file
+    modified in the same mtime tick as it was recorded could change again
+    without its stat changing, so such entries are stored with an invalid
+    size, and the file gets hashed again the next time it is looked at.
+    """
+    VERSION = 1
+
+    # Granularity of mtimes, on filesystems that store whole seconds (FAT,
+    # HFS+, some SMB and NFS servers) and on the others (kernel timer tick)
+    COARSE_GRANULARITY = 2000000000
+    FINE_GRANULARITY = 10000000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = Lock()
+        if not filename.parent.is_dir():
+            filename.parent.mkdir(parents=True)
+        self._db = sqlite3.connect(filename.path, check_same_thread=False)
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        version, = self._db.execute('PRAGMA user_version').fetchone()
+        if version != self.VERSION:
+            if version != 0:
+                logging.warning("Stat cache has unknown version %d, "
+                                "rebuilding", version)
+            self._db.execute('DROP TABLE IF EXISTS entries')
+            self._db.execute(
+                '''
+                CREATE TABLE entries(
+                    path BLOB PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    mode BLOB NOT NULL,
+                    blob BLOB NOT NULL)
+                ''')
+            self._db.execute('PRAGMA user_version = %d' % self.VERSION)
+            self._db.commit()
+        # Finds files that were moved, see lookup_inode()
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_inode '
+                         'ON entries(inode)')
+        self._db.commit()
+
+    @staticmethod
+    def key(st):
+        """Gets the part of a stat result that the cache compares.
+        """
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1000000000)
+        return st.st_size, mtime_ns, st.st_ino
+
+    @classmethod
+    def is_racy(cls, key, recorded_ns):
+        """Checks whether a file with that stat key could change unnoticed.
+
+        That's the case if its mtime is not older than `recorded_ns` (when the
+        key was taken, in nanoseconds) by at least the filesystem's
+        granularity.
+        """
+        mtime_ns = key[1]
+        if mtime_ns % 1000000000 == 0:
+            granularity = cls.COARSE_GRANULARITY
+        else:
+            granularity = cls.FINE_GRANULARITY
+        return mtime_ns + granularity > recorded_ns
+
+    def lookup(self, path, st):
+        """Returns (mode, blob) if the file is known with that stat, or None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime_ns, inode, mode, blob FROM entries '
+                'WHERE path = ?',
+                (sqlite3.Binary(path),)).fetchone()
+        if row is None or tuple(row[:3]) != self.key(st):
+            return None
+        return bytes(row[3]), bytes(row[4])
+
+    def lookup_inode(self, st):
+        """Finds the entries with that stat under any path.
+
+        Renaming or moving a file keeps its inode, size and mtime; returns a
+        list of (path, mode, blob) for the known files with the same.
+        """
+        size, mtime_ns, inode = self.key(st)
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT path, mode, blob FROM entries '
+                'WHERE inode = ? AND size = ? AND mtime_ns = ?',
+                (inode, size, mtime_ns)).fetchall()
+        return [(bytes(row[0]), bytes(row[1]), bytes(row[2]))
+                for row in rows]
+
+    def load(self):
+        """Reads the whole cache, as a dict mapping paths to (key, mode, blob).
+
+        Faster than :meth:`lookup` when most files are going to be checked.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT path, size, mtime_ns, inode, mode, blob '
+                'FROM entries').fetchall()
+        return dict((bytes(row[0]),
+                     (tuple(row[1:4]), bytes(row[4]), bytes(row[5])))
+                    for row in rows)
+
+    def update(self, entries):
+        """Records entries, an iterable of (path, stat, mode, blob).
+
+        Racily clean entries (see :meth:`is_racy`) are recorded so that they
+        never match.
+        """
+        now = int(time.time() * 1000000000)
+
+        def row(path, st, mode, blob):
+            key = self.key(st)
+            if self.is_racy(key, now):
+                key = (-1,) + key[1:]
+            return ((sqlite3.Binary(path),) + key +
+                    (sqlite3.Binary(mode), sqlite3.Binary(blob)))
+
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO entries(path, size, mtime_ns, inode, '
+                'mode, blob) VALUES(?, ?, ?, ?, ?, ?)',
+                (row(*entry) for entry in entries))
+            self._db.commit()
+
+    def remove(self, paths):
+        """Forgets about the given paths.
+        """
+        with self._lock:
+            self._db.executemany(
+                'DELETE FROM entries WHERE path = ?',
+                ((sqlite3.Binary(path),) for path in paths))
+            self._db.commit()
+
+    def entries(self):
+        """Lists all the entries, as (path, mode, blob) tuples.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT path, mode, blob FROM entries').fetchall()
+        return [(bytes(path), bytes(mode), bytes(blob))
+                for path, mode, blob in rows]
+
+    def clear(self):
+        """Empties the cache, so that every file will be hashed again.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM entries')
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,108 @@
+"""Copying file contents without going through Python when possible.
+
+Contains :func:`~gitobox.copying.copy_data`, which clones a file on
+copy-on-write filesystems (btrfs, XFS), has the kernel copy it with
+``copy_file_range()`` or ``sendfile()``, or falls back to reading and writing
+it.
+"""
+
+from __future__ import unicode_literals
+
+import errno
+import os
+import shutil
+
+from gitobox.metrics import FILE_COPIES
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# ioctl cloning a file on copy-on-write filesystems (btrfs, XFS)
+FICLONE = 0x40049409
+
+CHUNK_SIZE = 1 << 20
+
+# Errors meaning the system call can't be used for these files, rather than
+# that something went wrong
+_UNSUPPORTED = set(getattr(errno, name) for name in
+                   ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP',
+                    'EBADF', 'ETXTBSY')
+                   if hasattr(errno, name))
+
+
+def reflink(src, dst):
+    """Clones the content of a file into another, if the filesystem can.
+
+    Both are open file objects. Returns False if it's not supported.
+    """
+    if fcntl is None:
+        return False
+    try:
+        dst.flush()
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _copy_file_range(infd, outfd, count):
+    return os.copy_file_range(infd, outfd, count)
+
+
+def _sendfile(infd, outfd, count):
+    return os.sendfile(outfd, infd, None, count)
+
+
+_KERNEL_COPIES = []
+if hasattr(os, 'copy_file_range'):  # Python 3.8+, Linux
+    _KERNEL_COPIES.append(('copy_file_range', _copy_file_range))
+if hasattr(os, 'sendfile') and hasattr(os, 'uname') and \
+        os.uname()[0] == 'Linux':  # Other systems only send to sockets
+    _KERNEL_COPIES.append(('sendfile', _sendfile))
+
+
+def _kernel_copy(function, src, dst):
+    """Copies from the current offset of `src` until its end.
+
+    Returns False if that system call can't copy between these files.
+    """
+    infd, outfd = src.fileno(), dst.fileno()
+    copied = 0
+    try:
+        while True:
+            nb = function(infd, outfd, CHUNK_SIZE * 16)
+            if nb == 0:
+                break
+            copied += nb
+    except OSError as e:
+        if copied == 0 and e.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def copy_data(src, dst):
+    """Copies the content of an open file to another, as cheaply as possible.
+
+    `src` should be positioned at its start (nothing read from it) and `dst`
+    be empty. Returns the method that was used: ``'reflink'``,
+    ``'copy_file_range'``, ``'sendfile'`` or ``'stream'``.
+    """
+    if reflink(src, dst):
+        method = 'reflink'
+    else:
+        method = 'stream'
+        dst.flush()
+        for name, function in _KERNEL_COPIES:
+            if _kernel_copy(function, src, dst):
+                method = name
+                # The kernel moved the file offset under the file object
+                dst.seek(0, os.SEEK_END)
+                break
+        else:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    FILE_COPIES.inc(method=method)
+    return method
@@ -0,0 +1,90 @@
+"""Client for the control socket: ``gitobox ctl``.
+
+Contains :func:`~gitobox.ctl.ctl_main`, which sends a command to a running
+gitobox through the Unix socket in the Git directory, prints what it answers,
+and exits with status 0 if it succeeded, 1 otherwise.
+
+This gets run from cron jobs and deploy scripts, so it only imports the
+standard library (not watchdog or the rest of gitobox).
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import os
+import socket
+import sys
+
+from gitobox.server import CONTROL_COMMANDS, CONTROL_PROTOCOL, frame
+
+
+def find_socket(repository):
+    """Finds the control socket of a repository, bare or not.
+    """
+    for path in (os.path.join(repository, 'gitobox.sock'),
+                 os.path.join(repository, '.git', 'gitobox.sock')):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def send_command(conn, command, args=(), output=None):
+    """Sends a command over the control socket, relaying the answer.
+
+    Returns True if it succeeded.
+    """
+    if output is None:
+        output = getattr(sys.stdout, 'buffer', sys.stdout)
+    payload = b'\n'.join([CONTROL_PROTOCOL, command.encode('ascii')] +
+                         [arg.encode('utf-8') for arg in args])
+    conn.sendall(frame(payload))
+    for line in conn.makefile('rb'):
+        if line == b'OK\n':
+            return True
+        elif line == b'ERROR\n':
+            return False
+        output.write(line)
+        output.flush()
+    output.write(b"connection closed by gitobox\n")
+    return False
+
+
+def ctl_main(argv):
+    """Entry point for ``gitobox ctl``.
+    """
+    parser = argparse.ArgumentParser(
+        prog='gitobox ctl',
+        description="Controls a running gitobox: commit pending changes now "
+                    "(sync-now, or flush to also wait for the commit), pause "
+                    "and resume synchronization, or show its status")
+    parser.add_argument('repository',
+                        help="Git repository gitobox is synchronizing")
+    parser.add_argument('command', choices=CONTROL_COMMANDS)
+    parser.add_argument('--timeout', action='store', type=float,
+                        help="With flush, give up after that many seconds "
+                        "(default: wait as long as needed)")
+    parser.add_argument('--socket', action='store',
+                        help="Path of the control socket (default: "
+                        "gitobox.sock in the repository)")
+    args = parser.parse_args(argv)
+
+    path = args.socket or find_socket(args.repository)
+    if path is None:
+        sys.stderr.write("No control socket in %s, is gitobox running?\n" %
+                         args.repository)
+        sys.exit(1)
+    extra = []
+    if args.command == 'flush' and args.timeout is not None:
+        extra.append('%g' % args.timeout)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            conn.connect(path)
+        except socket.error as e:
+            sys.stderr.write("Couldn't connect to gitobox on %s: %s\n" %
+                             (path, e))
+            sys.exit(1)
+        ok = send_command(conn, args.command, extra)
+    finally:
+        conn.close()
+    sys.exit(0 if ok else 1)
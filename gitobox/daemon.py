@@ -0,0 +1,222 @@
+"""Serving many folders from a single process.
+
+Contains :class:`~gitobox.daemon.Daemon`, which runs a
+:class:`~gitobox.sync.Synchronizer` for every folder listed in a configuration
+file, sharing a single watchdog observer, hook server and worker pool.
+
+The configuration file looks like this::
+
+    [gitobox]
+    # Number of check-ins/check-outs that can run at the same time
+    workers = 4
+    # Defaults for the folders
+    timeout = 5
+    max_delay = 60
+    push_deadline = 30
+    # One commit per top-level directory that changed
+    split_commits = false
+    # Commit changes made while gitobox was stopped as several commits, dated
+    # from the files, when they are more than that many seconds apart
+    catch_up_gap = 3600
+    # Files this big are committed as Git LFS pointers
+    lfs_threshold = 50M
+    # Uncompressed copies of checked out files, to write them faster
+    blob_cache = 2G
+    # Seconds between checks for repacking the repository, 0 to disable
+    maintenance_interval = 300
+    # Extra patterns of files that are never committed
+    ignore = *.bak
+        Thumbs.db
+
+    [my-project]
+    folder = ~/Dropbox/my-project
+    repository = /srv/git/my-project.git
+    branch = master
+
+    [network-share]
+    folder = /mnt/share/project
+    repository = /srv/git/project.git
+    # No inotify events on this mount, scan it every 30 seconds instead
+    poll = 30
+"""
+
+from __future__ import unicode_literals
+
+import logging
+import multiprocessing
+from rpaths import Path
+import sys
+from watchdog.observers import Observer
+
+from gitobox.pool import WorkerPool
+from gitobox.server import Server
+from gitobox.sync import Synchronizer
+from gitobox.utils import parse_size
+
+try:
+    from configparser import RawConfigParser
+except ImportError:  # PY2
+    from ConfigParser import RawConfigParser
+
+
+BOOLEANS = {'1': True, 'yes': True, 'true': True, 'on': True,
+            '0': False, 'no': False, 'false': False, 'off': False}
+
+
+class FolderConfig(object):
+    """Configuration for one synced folder.
+    """
+    def __init__(self, name, folder, repository, branch, timeout, options):
+        self.name = name
+        self.folder = folder
+        self.repository = repository
+        self.branch = branch
+        self.timeout = timeout
+        # Extra keyword arguments for the Synchronizer
+        self.options = options
+
+
+def read_config(filename):
+    """Reads a daemon configuration file.
+
+    Returns the number of workers and a list of
+    :class:`~gitobox.daemon.FolderConfig`.
+    """
+    parser = RawConfigParser()
+    if not parser.read(str(filename)):
+        logging.critical("Can't read configuration file %s", filename)
+        sys.exit(1)
+
+    def get(section, option, default=None):
+        if parser.has_option(section, option):
+            return parser.get(section, option)
+        elif parser.has_option('gitobox', option):
+            return parser.get('gitobox', option)
+        elif default is not None:
+            return default
+        logging.critical("Configuration file %s: missing '%s' in section "
+                         "[%s]", filename, option, section)
+        sys.exit(1)
+
+    def get_boolean(section, option):
+        value = get(section, option, 'false').lower()
+        if value not in BOOLEANS:
+            raise ValueError("'%s' should be a boolean, not %r" % (option,
+                                                                   value))
+        return BOOLEANS[value]
+
+    try:
+        workers = int(get('gitobox', 'workers',
+                          str(multiprocessing.cpu_count())))
+        folders = []
+        repositories = set()
+        for section in parser.sections():
+            if section == 'gitobox':
+                continue
+            lfs_threshold = get(section, 'lfs_threshold', ' ').strip()
+            lfs_threshold = (parse_size(lfs_threshold) if lfs_threshold
+                             else None)
+            blob_cache = get(section, 'blob_cache', ' ').strip()
+            blob_cache = parse_size(blob_cache) if blob_cache else None
+            folder = FolderConfig(
+                section,
+                Path(get(section, 'folder')).expand_user().absolute(),
+                Path(get(section, 'repository')).expand_user().absolute(),
+                get(section, 'branch', 'master'),
+                int(get(section, 'timeout', '5')),
+                {'push_deadline': float(get(section, 'push_deadline', '30')),
+                 'max_delay': float(get(section, 'max_delay', '60')) or None,
+                 'backoff': float(get(section, 'backoff', '0')),
+                 'ignore': get(section, 'ignore', ' ').split(),
+                 'poll': float(get(section, 'poll', '0')) or None,
+                 'poll_budget': float(get(section, 'poll_budget', '0.1')),
+                 'split_commits': get_boolean(section, 'split_commits'),
+                 'lfs_threshold': lfs_threshold,
+                 'maintenance_interval': float(
+                     get(section, 'maintenance_interval', '300')),
+                 'blob_cache': blob_cache,
+                 'catch_up_gap': float(get(section, 'catch_up_gap', '0'))
+                 or None})
+            if folder.repository in repositories:
+                logging.critical("Configuration file %s: repository %s is "
+                                 "used by multiple folders", filename,
+                                 folder.repository)
+                sys.exit(1)
+            repositories.add(folder.repository)
+            folders.append(folder)
+    except ValueError as e:
+        logging.critical("Configuration file %s: %s", filename, e)
+        sys.exit(1)
+    if not folders:
+        logging.critical("Configuration file %s doesn't list any folder",
+                         filename)
+        sys.exit(1)
+    return workers, folders
+
+
+class Daemon(object):
+    """Synchronizes many folders, each with its own Git repository.
+
+    A single hook server is shared; requests are routed to the right
+    :class:`~gitobox.sync.Synchronizer` by the password that was written in
+    the repository's hook, and commands from ``gitobox ctl`` by the Unix
+    socket they came in on. Each folder keeps its own lock, so work on
+    different repositories can happen concurrently, up to the number of
+    workers.
+    """
+    def __init__(self, workers, folders, cache=None):
+        self._observer = Observer()
+        self._hook_server = Server(self._hook_triggered,
+                                   self._control_requested)
+        self._pool = WorkerPool(workers)
+
+        self._synchronizers = {}
+        self._by_socket = {}
+        for folder in folders:
+            logging.info("Setting up folder %s: %s <-> %s (%s)",
+                         folder.name, folder.folder, folder.repository,
+                         folder.branch)
+            sync = Synchronizer(folder.folder, folder.repository,
+                                folder.branch, folder.timeout,
+                                cache=cache,
+                                observer=self._observer,
+                                server=self._hook_server,
+                                pool=self._pool,
+                                **folder.options)
+            self._synchronizers[sync.password] = sync
+            if sync.socket_path is not None:
+                self._by_socket[sync.socket_path.path] = sync
+
+    def _hook_triggered(self, request, conn, addr):
+        sync = self._synchronizers.get(request.password)
+        if sync is None:
+            logging.debug("Got invalid message on hook server from %s",
+                          addr)
+            conn.sendall(b"hook auth failed\nERROR\n")
+        else:
+            sync.hook_triggered(request, conn, addr)
+
+    def _control_requested(self, request, conn, addr):
+        sync = self._by_socket.get(addr.path)
+        if sync is None:
+            conn.sendall(b"unknown folder\nERROR\n")
+        else:
+            sync.control_requested(request, conn, addr)
+
+    def run(self):
+        for sync in self._synchronizers.values():
+            sync.start()
+        self._observer.start()
+
+        try:
+            self._hook_server.run()
+        except KeyboardInterrupt:
+            logging.warning("Got KeyboardInterrupt, exiting...")
+        except Exception:
+            logging.critical("Exiting after unhandled exception!")
+            raise
+
+
+def daemon(config, cache=None):
+    workers, folders = read_config(config)
+    Daemon(workers, folders, cache=cache).run()
@@ -5,13 +5,32 @@ Contains the :class:`~gitobox.git.GitRepository` class.
 
 from __future__ import unicode_literals
 
+import binascii
+import contextlib
+from collections import deque
+import hashlib
+import io
 import logging
+import multiprocessing
 import os
-import pkg_resources
 from rpaths import Path
+import shutil
+import stat
 import subprocess
 import sys
-import tarfile
+from threading import Lock, RLock, Thread, local
+import time
+import zlib
+
+from gitobox.blobcache import BlobCache
+from gitobox.cache import StatCache
+from gitobox.ignore import DEFAULT_IGNORE, IgnoreFilter
+from gitobox.journal import CheckoutJournal
+from gitobox.lfs import MAX_POINTER_SIZE, LargeFileStore, parse_pointer
+from gitobox.metrics import GIT_COMMANDS, OPERATIONS, STAGED_BYTES, \
+    STAGED_FILES, span
+from gitobox.pool import run_parallel
+from gitobox.utils import PY3, irange, iteritems, make_unique_bytestring
 
 
 def decode_utf8(s):
@@ -21,27 +40,394 @@ def decode_utf8(s):
         return s
 
 
+def is_attributes_file(path):
+    """Tells whether a relative path (bytes) is a ``.gitattributes`` file.
+    """
+    return path.rsplit(b'/', 1)[-1] == b'.gitattributes'
+
+
+def encode_path(s):
+    """Encodes a filename given as unicode the way the filesystem does.
+    """
+    if isinstance(s, bytes):
+        return s
+    elif PY3:
+        return s.encode(sys.getfilesystemencoding(), 'surrogateescape')
+    else:
+        return s.encode(sys.getfilesystemencoding())
+
+
 def repr_cmdline(cmd):
     return ' '.join(decode_utf8(s) for s in cmd)
 
 
-def shell_quote(s):
-    """Given bl"a, returns "bl\\"a".
+def _find_program(name):
+    """Finds a program in the PATH, returns None if it isn't there.
+    """
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+_low_priority = None
+
 
-    Returns bytes.
+def _low_priority_prefix():
+    """Gets the command prefix running a program so it yields the CPU and disk.
+
+    This uses nice and ionice rather than a preexec_fn, which isn't safe in a
+    process with threads.
     """
-    if not isinstance(s, bytes):
-        s = s.encode('utf-8')
-    if any(c in s for c in b' \t\n\r\x0b\x0c*$\\"\''):
-        return b'"' + (s.replace(b'\\', b'\\\\')
-                        .replace(b'"', b'\\"')
-                        .replace(b'$', b'\\$')) + b'"'
-    else:
-        return s
+    global _low_priority
+    if _low_priority is None:
+        _low_priority = []
+        if os.name == 'posix':
+            nice = _find_program('nice')
+            if nice is not None:
+                _low_priority.extend([nice, '-n', '19'])
+            ionice = _find_program('ionice')
+            if ionice is not None:
+                _low_priority.extend([ionice, '-c', '3', '-t'])
+    return _low_priority
+
+
+# Batch processes that are running, watched by a single thread that stops
+# those left idle
+_running = set()
+_running_lock = Lock()
+_reaper = None
+
+
+def _watch_idle(process):
+    global _reaper
+    with _running_lock:
+        _running.add(process)
+        if _reaper is None:
+            _reaper = Thread(target=_stop_idle_processes,
+                             name='gitobox-idle-processes')
+            _reaper.setDaemon(True)
+            _reaper.start()
+
+
+def _stop_idle_processes():
+    """Stops the batch processes that haven't been used for a while.
+
+    There is one thread for all the repositories, so that a daemon serving
+    many folders doesn't keep Git processes around for those that are quiet.
+    """
+    while True:
+        time.sleep(BatchProcess.IDLE_TIMEOUT / 2)
+        with _running_lock:
+            processes = list(_running)
+        for process in processes:
+            process.close_if_idle()
+
+
+class BatchProcess(object):
+    """Long-running Git process that gets requests on its stdin, one per line.
+
+    Avoids starting a new Git process for every request. The process is
+    (re)started on demand, and stopped once it has been idle for
+    `IDLE_TIMEOUT` seconds. Safe to use from multiple threads.
+    """
+    CHUNK_SIZE = 1 << 16
+    IDLE_TIMEOUT = 60.0
+
+    def __init__(self, git, args, cwd=None, env=None):
+        self._cmd = git + args
+        self._args = args
+        self._cwd = cwd
+        self._env = env
+        self._proc = None
+        self._lock = Lock()
+        self._last_used = 0.0
+
+    def _request(self, line):
+        """Sends a request and reads the response line; call with lock held.
+        """
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        if self._proc is None or self._proc.poll() is not None:
+            logging.debug("Starting: %s", repr_cmdline(['git'] + self._args))
+            self._proc = subprocess.Popen(self._cmd,
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          cwd=self._cwd,
+                                          env=self._env)
+            _watch_idle(self)
+        self._last_used = time.time()
+        try:
+            self._proc.stdin.write(line + b'\n')
+            self._proc.stdin.flush()
+            response = self._proc.stdout.readline()
+        except (IOError, OSError):
+            response = b''
+        if not response:
+            self._died()
+        return response.rstrip(b'\n')
+
+    def _read(self, size, fp=None):
+        """Reads a number of bytes of response; call with lock held.
+        """
+        while size > 0:
+            chunk = self._proc.stdout.read(min(size, self.CHUNK_SIZE))
+            if not chunk:
+                self._died()
+            if fp is not None:
+                fp.write(chunk)
+            size -= len(chunk)
+
+    def _died(self):
+        proc, self._proc = self._proc, None
+        with _running_lock:
+            _running.discard(self)
+        proc.stdin.close()
+        raise subprocess.CalledProcessError(proc.wait(), self._cmd)
+
+    def _close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
+            with _running_lock:
+                _running.discard(self)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def close_if_idle(self):
+        """Stops the process if it hasn't been used for `IDLE_TIMEOUT`.
+        """
+        # If it's being used, it's not idle
+        if not self._lock.acquire(False):
+            return
+        try:
+            if time.time() - self._last_used >= self.IDLE_TIMEOUT:
+                if self._proc is not None:
+                    logging.debug("Stopping idle %s",
+                                  repr_cmdline(['git'] + self._args))
+                self._close()
+        finally:
+            self._lock.release()
+
+
+class CatFile(BatchProcess):
+    """Long-running ``git cat-file`` process, in batch mode.
+
+    Used to resolve revisions and to stream blobs.
+    """
+    def __init__(self, git, contents=False):
+        self._contents = contents
+        BatchProcess.__init__(self, git, [
+            'cat-file', '--batch' if contents else '--batch-check'])
+
+    def _request_object(self, name):
+        fields = self._request(name).split()
+        if len(fields) != 3 or fields[1] == b'missing':
+            return None
+        return fields[0], fields[1].decode('ascii'), int(fields[2])
+
+    def info(self, name):
+        """Returns (id, type, size) for the given object, or None.
+        """
+        with self._lock:
+            info = self._request_object(name)
+            if info is not None and self._contents:
+                self._read(info[2] + 1)
+            return info
+
+    def write_to(self, name, fp):
+        """Streams the content of an object to a file object.
+
+        Returns (id, type, size), or None if the object doesn't exist.
+        """
+        assert self._contents
+        with self._lock:
+            info = self._request_object(name)
+            if info is not None:
+                self._read(info[2], fp)
+                self._read(1)
+            return info
+
+
+class HashObject(BatchProcess):
+    """Long-running ``git hash-object -w --stdin-paths`` process.
+
+    Hashes files of the working tree (applying the configured filters) and
+    writes them to the object store. Paths are relative to the working tree.
+    """
+    def __init__(self, git, workdir, env=None):
+        BatchProcess.__init__(self, git,
+                              ['hash-object', '-w', '--stdin-paths'],
+                              cwd=workdir.path, env=env)
+
+    def hash(self, path):
+        """Returns the blob ID of the file, or None if it couldn't be read.
+        """
+        if b'\n' in path:
+            # Can't be sent on a line, use a separate process
+            try:
+                return subprocess.check_output(
+                    self._cmd[:-1] + ['--', path],
+                    cwd=self._cwd, env=self._env).strip()
+            except subprocess.CalledProcessError:
+                return None
+        with self._lock:
+            try:
+                return self._request(path)
+            except subprocess.CalledProcessError:
+                # The file probably vanished, and Git gave up
+                return None
+
+
+class HashPool(object):
+    """Hashes files in parallel, with several HashObject processes.
+
+    Git streams big files itself, so the only work done here is dispatching
+    paths to the processes. Processes beyond the first are stopped after each
+    batch, so an idle repository only keeps one around.
+    """
+    def __init__(self, git, workdir, size=None, env=None):
+        self.size = size or multiprocessing.cpu_count()
+        self._processes = [HashObject(git, workdir, env)
+                           for _ in irange(self.size)]
+
+    def hash(self, path):
+        """Returns the blob ID of one file, or None if it couldn't be read.
+        """
+        return self._processes[0].hash(path)
+
+    def hash_many(self, paths):
+        """Hashes many files, returning a dict mapping paths to blob IDs.
+
+        Paths are taken in order, so giving the biggest files first balances
+        the load better. Unreadable files map to None.
+        """
+        results = {}
+        nb = min(self.size, len(paths))
+        if nb <= 1:
+            for path in paths:
+                results[path] = self.hash(path)
+            return results
+
+        pending = deque(paths)
+        errors = []
+
+        def worker(process):
+            try:
+                while True:
+                    try:
+                        path = pending.popleft()
+                    except IndexError:
+                        break
+                    results[path] = process.hash(path)
+            except Exception as e:
+                logging.debug("Exception in hashing thread", exc_info=True)
+                errors.append(e)
+
+        threads = [Thread(target=worker, args=(process,))
+                   for process in self._processes[:nb]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for process in self._processes[1:nb]:
+            process.close()
+        if errors:
+            raise errors[0]
+        return results
+
+    def close(self):
+        for process in self._processes:
+            process.close()
+
+
+class CheckoutManifest(object):
+    """Records what a check-out wrote to the directory.
+
+    Used after the fact to find files that were changed by someone else while
+    the check-out was writing, without rescanning the directory. Files whose
+    stat can't be trusted yet (see :meth:`~gitobox.cache.StatCache.is_racy`)
+    are hashed with `hash_files`, if given (see
+    :meth:`~gitobox.git.GitRepository._hash_files`).
+    """
+    def __init__(self, ref, hash_files=None):
+        self.ref = ref
+        self._hash_files = hash_files
+        # path -> (stat key, blob ID), for the files that were written
+        self.written = {}
+        # paths that were deleted
+        self.removed = set()
+        # paths that couldn't be written
+        self.skipped = set()
+
+    def conflicts(self, workdir, events=(), waiting=()):
+        """Lists the paths that don't match what the check-out wrote.
+
+        Written files whose stat changed, removed files that are back,
+        skipped files, the paths in `events` (changes that were seen while
+        writing) that are not explained by the check-out, and the paths it
+        wrote or removed that were in `waiting` (changes that were not
+        committed yet, or under a directory that was). Returns a sorted list
+        of relative paths.
+        """
+        conflicts = set(self.skipped)
+        if waiting:
+            waiting = set(encode_path(path) for path in waiting)
+            for path in list(self.written) + list(self.removed):
+                parent = path
+                while True:
+                    if parent in waiting:
+                        conflicts.add(path)
+                        break
+                    if b'/' not in parent:
+                        break
+                    parent = parent.rsplit(b'/', 1)[0]
+        now = int(time.time() * 1000000000)
+        racy = []
+        for path, (key, _) in iteritems(self.written):
+            try:
+                st = os.lstat((workdir / path).path)
+            except OSError:
+                conflicts.add(path)
+                continue
+            if StatCache.key(st) != key:
+                conflicts.add(path)
+            elif StatCache.is_racy(key, now):
+                racy.append((path, st))
+        if racy and self._hash_files is not None:
+            # Same stat, but could have been written again since
+            hashed = self._hash_files(racy)
+            for path, st in racy:
+                if hashed.get(path, (None, None))[1] != self.written[path][1]:
+                    conflicts.add(path)
+        for path in self.removed:
+            if path not in self.written and (workdir / path).lexists():
+                conflicts.add(path)
+
+        # Directories created or emptied by the check-out
+        parents = set()
+        for path in list(self.written) + list(self.removed):
+            while b'/' in path:
+                path = path.rsplit(b'/', 1)[0]
+                if path in parents:
+                    break
+                parents.add(path)
+        for path in events:
+            path = encode_path(path)
+            if (path not in self.written and path not in self.removed and
+                    path not in parents):
+                conflicts.add(path)
+        return sorted(conflicts)
 
 
 class GitRepository(object):
-    def __init__(self, repo, workdir, branch, password, port):
+    def __init__(self, repo, workdir, branch, password, port, socket=None,
+                 ignore=None, hash_jobs=None, split_commits=False,
+                 lfs_threshold=None, blob_cache=None, catch_up_gap=None):
         if not (repo / 'objects').is_dir() or not (repo / 'refs').is_dir():
             logging.critical("Not a Git repository: %s", repo)
             sys.exit(1)
@@ -49,109 +435,1388 @@ class GitRepository(object):
         self.repo = repo.absolute()
         self.workdir = workdir.absolute()
         self.branch = branch
+        self.split_commits = split_commits
+        self.catch_up_gap = catch_up_gap
+        self._ident = None
         self._git = ['git', '--git-dir', self.repo.path,
-                     '--work-tree', self.workdir.path]
+                     '--work-tree', self.workdir.path,
+                     '--literal-pathspecs']
+        self._git_version = None
+
+        # The index is private to gitobox, so Git commands run in the
+        # repository by users (or hooks) never see or lock it
+        self._index = self.repo / 'gitobox' / 'index'
+        if (not self._index.exists() and
+                (self.repo / 'index').exists()):
+            # Index from an older version, using the repository's
+            if not self._index.parent.is_dir():
+                self._index.parent.mkdir(parents=True)
+            (self.repo / 'index').rename(self._index)
+        self._env = self._index_env(self._index)
+
+        # Timings of Git operations: name -> (count, total seconds)
+        # More detail is recorded in gitobox.metrics, labeled by folder
+        self.timings = {}
+        self._local = local()
+        self._folder_label = str(self.workdir)
+
+        # Operations on the index are serialized
+        self._index_lock = RLock()
+
+        # Long-running processes used to resolve revisions, read and write
+        # blobs
+        self._cat_file = CatFile(self._git)
+        self._cat_blob = CatFile(self._git, contents=True)
+        self._hash_pool = HashPool(self._git, self.workdir, hash_jobs,
+                                   self._env)
+
+        # Store for large files, used if a threshold is set or if it has been
+        # used before
+        lfs_objects = self.repo / 'lfs' / 'objects'
+        if lfs_threshold is not None or lfs_objects.is_dir():
+            self._lfs = LargeFileStore(lfs_objects, lfs_threshold)
+        else:
+            self._lfs = None
+
+        # Uncompressed blobs to check out from, up to `blob_cache` bytes
+        if blob_cache:
+            self._blobs = BlobCache(self.repo / 'gitobox' / 'blobs',
+                                    blob_cache)
+        else:
+            self._blobs = None
+
+        # Operations of the check-out in progress, to finish it if we die
+        self._journal = CheckoutJournal(self.repo / 'gitobox' /
+                                        'checkout-journal')
+
+        # Commit the directory was last synced with (checked in or out), to
+        # find pushes that never got checked out
+        self._synced = self.repo / 'gitobox' / 'synced'
+
+        # What decides whether check-outs apply filters, see _uses_filters():
+        # the attributes files in the index (None until first needed), and
+        # the configuration with the stat of the files it was read from
+        self._attributes_files = None
+        self._filter_config = None, None
+
+        # Stat cache, only valid with the index it was built with
+        self.cache = StatCache(self.repo / 'gitobox' / 'statcache.sqlite3')
+        if not self._index.exists():
+            self.cache.clear()
+
+        # Patterns ignored in addition to .gitignore files
+        exclude_file = self.repo / 'gitobox' / 'exclude'
+        IgnoreFilter(DEFAULT_IGNORE if ignore is None
+                     else ignore).write_exclude_file(exclude_file)
+        self._exclude = ['--exclude-standard',
+                         '--exclude-from=%s' % exclude_file]
 
         self._run(['config', 'receive.denyCurrentBranch', 'ignore'])
+        self._run(['symbolic-ref', 'HEAD', 'refs/heads/%s' % self.branch])
 
-        # Installs hook
+        # Installs the hooks, a single script that tells from its name
+        # whether it is run before or after the refs get updated
+        for name in ('pre-receive', 'post-receive'):
+            hook = self.repo / 'hooks' / name
+            if hook.exists() and not self._is_own_hook(hook):
+                logging.critical("Repository at %s already has a %s hook; "
+                                 "not overriding!\n"
+                                 "Please delete it and try again\n",
+                                 self.repo, name)
+                sys.exit(1)
+        # Slow to import, and only needed here
+        import pkg_resources
+
+        python = encode_path(sys.executable)
+        for name in ('pre-receive', 'post-receive'):
+            hook = self.repo / 'hooks' / name
+            logging.debug("Installing %s hook", name)
+            template = pkg_resources.resource_stream('gitobox',
+                                                     'hooks/receive')
+            with hook.open('wb') as fp:
+                for line in template:
+                    if line.find(b'{{') != -1:
+                        line = (line
+                                .replace(b'{{PYTHON}}', python)
+                                .replace(b'{{PASSWORD}}',
+                                         self._py_literal(password))
+                                .replace(b'{{PORT}}',
+                                         str(port).encode('ascii'))
+                                .replace(b'{{SOCKET}}',
+                                         b'None' if socket is None
+                                         else self._py_literal(socket.path)))
+                    fp.write(line)
+            template.close()
+            hook.chmod(0o755)
+        # The update hook of older versions
         update_hook = self.repo / 'hooks' / 'update'
-        if update_hook.exists():
-            with update_hook.open('rb') as fp:
+        if update_hook.exists() and self._is_own_hook(update_hook):
+            logging.debug("Removing old update hook")
+            update_hook.remove()
+
+    @staticmethod
+    def _is_own_hook(hook):
+        """Checks whether a hook was installed by Gitobox.
+        """
+        with hook.open('rb') as fp:
+            line = fp.readline().rstrip()
+            if line.startswith(b'#!'):
                 line = fp.readline().rstrip()
-                if line.startswith(b'#!'):
-                    line = fp.readline().rstrip()
-                if line != b'# Gitobox hook: do not edit!':
-                    logging.critical("Repository at %s already has an update "
-                                     "hook; not overriding!\n"
-                                     "Please delete it and try again\n",
-                                     self.repo)
-                    sys.exit(1)
-                else:
-                    logging.debug("Replacing update hook")
-        else:
-            logging.debug("Installing update hook")
-        template = pkg_resources.resource_stream('gitobox', 'hooks/update')
-        with update_hook.open('wb') as fp:
-            for line in template:
-                if line.find(b'{{') != -1:
-                    line = (line
-                            .replace(b'{{PASSWORD}}', shell_quote(password))
-                            .replace(b'{{PORT}}', shell_quote(str(port)))
-                            .replace(b'{{BRANCH}}', shell_quote(branch)))
-                fp.write(line)
-        template.close()
-        update_hook.chmod(0o755)
-
-    def _run(self, cmd, allow_fail=False, stdout=False):
+        return line == b'# Gitobox hook: do not edit!'
+
+    @staticmethod
+    def _py_literal(value):
+        """Formats bytes as a Python literal, for the hook script.
+        """
+        return b"b'" + b''.join(
+            (('\\x%02x' % c) if c < 0x20 or c >= 0x7f or c in (0x27, 0x5c)
+             else chr(c)).encode('ascii')
+            for c in bytearray(value)) + b"'"
+
+    # Maximum number of paths passed on a single command-line
+    MAX_ARGS = 1000
+
+    COMMIT_MESSAGE = '(gitobox automatic commit)'
+
+    EMPTY_TREE = b'4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+    TREE_MODE = b'40000'
+
+    # Number of files listed in a commit message
+    MAX_LISTED_CHANGES = 50
+
+    # Don't split changes into more commits than that
+    MAX_SPLIT_COMMITS = 16
+
+    # Most commits made for changes found on startup, see catch_up_gap
+    MAX_CATCH_UP_COMMITS = 32
+
+    @staticmethod
+    def _index_env(index):
+        """Makes the environment for Git commands using the given index file.
+        """
+        env = dict(os.environ)
+        env['GIT_INDEX_FILE'] = index.path
+        return env
+
+    def _run(self, cmd, allow_fail=False, stdout=False, input=None,
+             env=None, background=False):
         logging.debug("Running: %s", repr_cmdline(['git'] + cmd))
-        cmd = self._git + cmd
+        start = time.time()
+        prefix = _low_priority_prefix() if background else []
+        proc = subprocess.Popen(prefix + self._git + cmd,
+                                stdin=None if input is None
+                                else subprocess.PIPE,
+                                stdout=subprocess.PIPE if stdout else None,
+                                env=self._env if env is None else env)
+        out, _ = proc.communicate(input)
+        self._record_timing(cmd[0], time.time() - start)
 
         if allow_fail:
-            return subprocess.call(cmd)
+            return proc.returncode
+        elif proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode,
+                                                self._git + cmd)
         elif stdout:
-            return subprocess.check_output(cmd)
+            return out
         else:
-            return subprocess.check_call(cmd)
+            return 0
 
-    def has_changes(self, ref):
-        """Determines whether the working copy has changes, compared to `ref`.
+    def _record_timing(self, operation, duration, command=True):
+        """Records the duration of a Git command, or of a whole operation.
         """
-        self._run(['update-ref', '--no-deref', 'HEAD', ref])
-        self._run(['add', '--all', '.'])
-        status = self._run(['status', '--porcelain'], stdout=True)
-        self._run(['symbolic-ref', 'HEAD', 'refs/heads/%s' % self.branch])
-        return bool(status.strip())
+        count, total = self.timings.get(operation, (0, 0.0))
+        self.timings[operation] = count + 1, total + duration
+        if command:
+            GIT_COMMANDS.observe(duration, folder=self._folder_label,
+                                 operation=getattr(self._local, 'operation',
+                                                   None) or 'other',
+                                 command=operation)
+            op_timings = getattr(self._local, 'op_timings', None)
+            if op_timings is not None:
+                op_timings.append((operation, duration))
+        else:
+            OPERATIONS.observe(duration, folder=self._folder_label,
+                               operation=operation)
+
+    @contextlib.contextmanager
+    def _timed(self, name, serialize=True):
+        """Serializes a repository operation, and logs how long it took.
+
+        The time spent in each Git command is reported. If `serialize` is
+        False, the operation doesn't take the index lock.
+        """
+        self._local.op_timings = op_timings = []
+        self._local.operation = name
+        start = time.time()
+        try:
+            with span(name, folder=self._folder_label):
+                if serialize:
+                    with self._index_lock:
+                        yield
+                else:
+                    yield
+        finally:
+            total = time.time() - start
+            timings = {}
+            for operation, duration in op_timings:
+                timings[operation] = timings.get(operation, 0.0) + duration
+            self._local.op_timings = None
+            self._local.operation = None
+            self._record_timing(name, total, command=False)
+            logging.debug("%s took %.3fs (%s)", name, total,
+                          ", ".join("%s %.3fs" % t
+                                    for t in sorted(iteritems(timings))))
+
+    def _resolve(self, name):
+        """Resolves a revision to an object ID, or None if it doesn't exist.
+        """
+        start = time.time()
+        try:
+            info = self._cat_file.info(name)
+        finally:
+            self._record_timing('cat-file', time.time() - start)
+        return None if info is None else info[0]
+
+    def branch_tip(self):
+        """Returns the commit the branch points to, or None if it's unborn.
+        """
+        return self._resolve('refs/heads/%s' % self.branch)
+
+    def _synced_commit(self):
+        """Returns the commit the directory was last synced with, or None.
+        """
+        if not self._synced.exists():
+            return None
+        with self._synced.open('rb') as fp:
+            return fp.read().strip() or None
+
+    def _set_synced_commit(self, commit):
+        temp = self._synced.parent / (self._synced.unicodename + '.tmp')
+        with temp.open('wb') as fp:
+            fp.write(commit + b'\n')
+        temp.rename(self._synced)
+
+    def check_out_unapplied(self):
+        """Checks out the branch if it was updated without the directory.
+
+        Git moves the branch before the ``post-receive`` hook runs, so a push
+        is left out of the directory if the hook couldn't get the lock, if the
+        check-out failed, or if gitobox died before it started. Committing
+        the directory on top of it would revert the push.
+
+        Returns the :class:`~gitobox.git.CheckoutManifest`, or None if the
+        directory was up to date.
+        """
+        tip = self.branch_tip()
+        if tip is None:
+            return None
+        synced = self._synced_commit()
+        if synced is None:
+            # First start (or from an older version), the index is trusted
+            self._set_synced_commit(tip)
+            return None
+        elif synced == tip:
+            return None
+        logging.warning("Branch was updated to %s but the directory wasn't, "
+                        "checking it out", tip.decode('ascii')[:7])
+        return self.check_out(tip)
+
+    def object_type(self, name, objects=None):
+        """Returns the type of an object (e.g. b'commit'), or None.
+
+        `objects` is another object directory to look in, e.g. where Git
+        keeps the objects of a push until its hooks accept it.
+        """
+        env = self._env
+        if objects is not None:
+            env = dict(env)
+            env['GIT_ALTERNATE_OBJECT_DIRECTORIES'] = objects
+        try:
+            return self._run(['cat-file', '-t', name], stdout=True,
+                             env=env).strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def _write_object(self, kind, data):
+        """Writes an object to the object store, in-process.
+
+        Like Git, an object that already exists loose gets its mtime updated,
+        so that pruning doesn't take it for an old unreachable object; one
+        that is only in a pack is written loose again.
+
+        Returns its ID.
+        """
+        data = ('%s %d\0' % (kind, len(data))).encode('ascii') + data
+        sha = hashlib.sha1(data).hexdigest()
+        path = self.repo / 'objects' / sha[:2] / sha[2:]
+        exists = path.exists()
+        if exists:
+            try:
+                os.utime(path.path, None)
+            except OSError:
+                exists = False
+        if not exists:
+            if not path.parent.is_dir():
+                path.parent.mkdir(parents=True)
+            temp = path.parent / ('tmp_obj_%s' %
+                                  make_unique_bytestring().decode('ascii'))
+            with temp.open('wb') as fp:
+                fp.write(zlib.compress(data))
+            temp.chmod(0o444)
+            temp.rename(path)
+        return sha.encode('ascii')
 
-    def check_in(self, paths=None):
+    def _hash_files(self, files):
+        """Hashes files of the working tree in parallel, writing them as blobs.
+
+        `files` is a list of (path, lstat result). Returns a dict mapping the
+        paths that could be read to (mode, blob ID).
+        """
+        results = {}
+        regular = []
+        large = []
+        # Git reads attributes once per process, they have to be restarted
+        # for changed attributes to apply
+        if any(is_attributes_file(path) for path, _ in files):
+            self._hash_pool.close()
+        for path, st in files:
+            if stat.S_ISLNK(st.st_mode):
+                try:
+                    target = os.readlink((self.workdir / path).path)
+                except OSError:
+                    continue
+                results[path] = b'120000', self._write_object('blob', target)
+            elif (self._lfs is not None and
+                    self._lfs.threshold is not None and
+                    st.st_size >= self._lfs.threshold):
+                large.append((path, st))
+            else:
+                regular.append((path, st))
+
+        if large:
+            # Large files go to the store, a pointer gets committed
+            large.sort(key=lambda f: f[1].st_size, reverse=True)
+            start = time.time()
+            pointers = run_parallel(
+                lambda f: self._lfs.store((self.workdir / f[0]).path),
+                large, self._hash_pool.size)
+            self._record_timing('lfs-store', time.time() - start)
+            for (path, st), pointer in zip(large, pointers):
+                if pointer is not None:
+                    results[path] = (self._file_mode(st),
+                                     self._write_object('blob', pointer))
+        if not regular:
+            return results
+
+        # Biggest files first, so they don't end up last on a single process
+        regular.sort(key=lambda f: f[1].st_size, reverse=True)
+        start = time.time()
+        blobs = self._hash_pool.hash_many([path for path, st in regular])
+        self._record_timing('hash-object', time.time() - start)
+        for path, st in regular:
+            blob = blobs.get(path)
+            if blob is not None:
+                results[path] = self._file_mode(st), blob
+        return results
+
+    @staticmethod
+    def _file_mode(st):
+        return b'100755' if st.st_mode & stat.S_IXUSR else b'100644'
+
+    def _list_files(self):
+        """Lists all the files in the index or the working tree.
+        """
+        out = self._run(['ls-files', '-z', '--cached', '--others'] +
+                        self._exclude,
+                        stdout=True)
+        return sorted(set(f for f in out.split(b'\0') if f))
+
+    def _update_index(self, entries, removed):
+        """Sets index entries, (mode, blob, path) tuples, and removes paths.
+        """
+        if self._attributes_files is not None:
+            for _, _, path in entries:
+                if is_attributes_file(path):
+                    self._attributes_files.add(path)
+            for path in removed:
+                self._attributes_files.discard(path)
+        if entries or removed:
+            self._run(['update-index', '-z', '--replace', '--index-info'],
+                      input=b''.join(
+                          [b'0 ' + b'0' * 40 + b'\t' + p + b'\0'
+                           for p in removed] +
+                          [m + b' ' + b + b'\t' + p + b'\0'
+                           for m, b, p in entries]))
+
+    def _stage(self, paths, moves=()):
+        """Updates the index from the given relative paths, or every file.
+
+        Files are looked up in the stat cache and only hashed into the object
+        store if their size, mtime or inode changed; paths that no longer exist
+        are removed from the index. Files missing from the cache that have the
+        same stat as a cached file under a path that is gone were moved there,
+        and get its blob without being read; `moves`, (source, destination)
+        relative paths in the order they happened, tell where to look first.
+
+        Returns the ID of the resulting tree.
+        """
+        known = None
+        if paths is None:
+            paths = self._list_files()
+            # Reading the whole cache at once beats a query per file
+            known = self.cache.load()
+        by_stat = None
+        entries = []
+        removed = []
+        cache_updates = []
+        changed = []
+        moved = []
+        for path in paths:
+            try:
+                st = os.lstat((self.workdir / path).path)
+            except OSError:
+                removed.append(path)
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                # Was a file, is now a directory (or is a nested repository);
+                # the files in it are listed separately
+                removed.append(path)
+                continue
+            if known is None:
+                cached = self.cache.lookup(path, st)
+            else:
+                cached = known.get(path)
+                if cached is not None:
+                    key, mode, blob = cached
+                    cached = (mode, blob) if key == StatCache.key(st) else None
+            if cached is None:
+                if known is not None and by_stat is None:
+                    by_stat = {}
+                    for known_path, (key, mode, blob) in iteritems(known):
+                        by_stat.setdefault(key, []).append(
+                            (known_path, mode, blob))
+                cached = None
+                if moves:
+                    origin = self._moved_from(path, moves)
+                    if origin is not None:
+                        cached = self.cache.lookup(origin, st)
+                if cached is None:
+                    cached = self._find_moved(st, by_stat)
+                if cached is not None:
+                    moved.append((path, st) + cached)
+                else:
+                    changed.append((path, st))
+
+        STAGED_FILES.observe(len(changed), folder=self._folder_label)
+        STAGED_BYTES.observe(sum(st.st_size for _, st in changed),
+                             folder=self._folder_label)
+        hashed = self._hash_files(changed)
+        for path, st in changed:
+            if path not in hashed:
+                if not (self.workdir / path).lexists():
+                    removed.append(path)
+                else:
+                    # Can't be read right now (permissions, locked file...);
+                    # the index keeps what it had, it will be tried again
+                    logging.warning("Couldn't read %s, not committing it",
+                                    path.decode('utf-8', 'replace'))
+                continue
+            mode, blob = hashed[path]
+            entries.append((mode, blob, path))
+            try:
+                if (StatCache.key(os.lstat((self.workdir / path).path)) ==
+                        StatCache.key(st)):
+                    cache_updates.append((path, st, mode, blob))
+            except OSError:
+                pass
+        for path, st, mode, blob in moved:
+            entries.append((mode, blob, path))
+            cache_updates.append((path, st, mode, blob))
+        logging.debug("Staging %d paths (%d hashed, %d moved, %d removed)",
+                      len(paths), len(changed), len(moved), len(removed))
+        self._update_index(entries, removed)
+        self.cache.remove(removed)
+        self.cache.update(cache_updates)
+        return self._run(['write-tree'], stdout=True).strip()
+
+    @staticmethod
+    def _moved_from(path, moves):
+        """Finds where a file was before the given moves, or None.
+        """
+        origin = path
+        for src, dest in reversed(moves):
+            if origin == dest:
+                origin = src
+            elif origin.startswith(dest + b'/'):
+                origin = src + origin[len(dest):]
+        return None if origin == path else origin
+
+    def _find_moved(self, st, by_stat=None):
+        """Finds the blob of a file that was moved or renamed.
+
+        Looks for a cached file with the same inode, size and mtime, which a
+        move keeps, in `by_stat` (stat key -> [(path, mode, blob)]) or the
+        cache. Its path has to be gone: inodes get reused, and tools like
+        ``rsync -a`` or ``unzip`` set mtimes, so a match alone doesn't mean
+        it's the same file. Returns (mode, blob) or None.
+        """
+        if not st.st_ino:
+            # No inode numbers on this filesystem
+            return None
+        if by_stat is None:
+            candidates = self.cache.lookup_inode(st)
+        else:
+            candidates = by_stat.get(StatCache.key(st), ())
+        for path, mode, blob in candidates:
+            if not (self.workdir / path).lexists():
+                break
+        else:
+            return None
+        if stat.S_ISLNK(st.st_mode):
+            return (mode, blob) if mode == b'120000' else None
+        elif mode == b'120000':
+            return None
+        # The executable bit might have been changed with it
+        return self._file_mode(st), blob
+
+    def rebuild_cache(self):
+        """Empties the stat cache, so every file gets hashed again.
+        """
+        logging.info("Clearing stat cache")
+        self.cache.clear()
+
+    def verify_cache(self):
+        """Checks the stat cache against the index and the files' content.
+
+        Entries that don't match are dropped, so these files will be hashed
+        again on the next check-in. Returns the number of dropped entries.
+        """
+        with self._timed('verify_cache'):
+            out = self._run(['ls-files', '-z', '--stage'], stdout=True)
+            index = {}
+            for line in out.split(b'\0'):
+                if line:
+                    info, path = line.split(b'\t', 1)
+                    mode, blob, _ = info.split(b' ')
+                    index[path] = mode, blob
+
+            bad = []
+            to_hash = []
+            entries = self.cache.entries()
+            for path, mode, blob in entries:
+                try:
+                    st = os.lstat((self.workdir / path).path)
+                except OSError:
+                    bad.append(path)
+                    continue
+                if (index.get(path) != (mode, blob) or
+                        self.cache.lookup(path, st) is None):
+                    bad.append(path)
+                else:
+                    to_hash.append((path, st))
+            hashed = self._hash_files(to_hash)
+            for path, st in to_hash:
+                if hashed.get(path) != index[path]:
+                    bad.append(path)
+            self.cache.remove(bad)
+        if bad:
+            logging.warning("Stat cache: %d/%d entries were wrong",
+                            len(bad), len(entries))
+        else:
+            logging.info("Stat cache: %d entries verified", len(entries))
+        return len(bad)
+
+    def _relative_path(self, path):
+        """Turns a path in the working directory into a relative path.
+
+        Returns bytes, or None if it's not under the working directory.
+        """
+        path = Path(path).absolute()
+        if path.lies_under(self.workdir) and path != self.workdir:
+            return self.workdir.rel_path_to(path).path
+        return None
+
+    def _expand_paths(self, paths):
+        """Turns changed paths into the list of files to stage.
+
+        Paths outside of the working directory are dropped. Directories are
+        expanded to the files they contain, ignored files are left out, and
+        paths that no longer exist are matched against the index so that their
+        deletion gets staged (this also covers deleted directories).
+
+        Returns relative paths, as bytes.
+        """
+        pathspecs = set()
+        for path in paths:
+            path = Path(path).absolute()
+            if path == self.workdir:
+                return None
+            elif path.lies_under(self.workdir):
+                pathspecs.add(self.workdir.rel_path_to(path).path)
+
+        if len(pathspecs) > self.MAX_ARGS:
+            # Matching that many pathspecs is slower than filtering ourselves
+            files = []
+            for path in self._list_files():
+                prefix = path
+                while prefix:
+                    if prefix in pathspecs:
+                        files.append(path)
+                        break
+                    prefix = prefix.rpartition(b'/')[0]
+            return files
+        elif not pathspecs:
+            return []
+
+        out = self._run(['ls-files', '-z', '--cached', '--others'] +
+                        self._exclude + ['--'] + sorted(pathspecs),
+                        stdout=True)
+        return sorted(set(f for f in out.split(b'\0') if f))
+
+    def check_in(self, paths=None, times=None, moves=None, catch_up=False):
         """Commit changes to the given files (if there are differences).
 
-        If `paths` is None, assumes that any file might have changed.
+        If `paths` is None, assumes that any file might have changed, and scans
+        the whole working directory. Otherwise, only the given paths (and the
+        content of the given directories) are staged.
+
+        `times` optionally maps the changed paths to when they changed; the
+        commits get the time of the latest change they contain as their
+        author date. If `catch_up` is set (for the scan on startup, of changes
+        made while nothing was watching) and so is `catch_up_gap`, the files'
+        mtimes are used instead, and changes more than that many seconds apart
+        go in separate commits.
+
+        `moves` optionally lists the (source, destination) paths of files and
+        directories that were moved, so that the files are found in the stat
+        cache under their old path instead of being hashed again (moves are
+        also recognized from inodes without this, see :meth:`_stage`).
+
+        A push that wasn't checked out is checked out first (see
+        :meth:`check_out_unapplied`).
+
+        The commits are written in-process from the staged tree, and the
+        branch is updated directly; HEAD is not used. If `split_commits` is
+        set, one commit is made per top-level directory that changed.
         """
-        self._run(['symbolic-ref', 'HEAD', 'refs/heads/%s' % self.branch])
+        self.check_out_unapplied()
+        with self._timed('check_in'):
+            if paths is not None:
+                paths = self._expand_paths(paths)
+            relative_moves = []
+            for src, dest in moves or ():
+                src = self._relative_path(src)
+                dest = self._relative_path(dest)
+                if src is not None and dest is not None:
+                    relative_moves.append((src, dest))
+            tree = self._stage(paths, moves=relative_moves)
+
+            branch = 'refs/heads/%s' % self.branch
+            parent = self._resolve(branch)
+            base = (self.EMPTY_TREE if parent is None
+                    else self._resolve(parent + b'^{tree}'))
+            if tree == base:
+                logging.info("No revision created")
+                return
+
+            changes = list(self._diff_trees(base, tree))
+            if catch_up and self.catch_up_gap:
+                # Changes made while we were not watching, replay them
+                times = self._file_times(changes, parent)
+                sessions = self._group_by_time(changes, times)
+            else:
+                times = self._relative_times(times)
+                sessions = [changes]
+            groups = [group
+                      for session in sessions
+                      for group in self._group_changes(session)]
+            commit = parent
+            current = base
+            for i, (group, group_changes) in enumerate(groups):
+                if i == len(groups) - 1:
+                    current = tree
+                else:
+                    current = self._edit_tree(
+                        current,
+                        dict((path, None if status == b'D' else (mode, blob))
+                             for status, path, mode, blob in group_changes))
+                commit = self._write_commit(
+                    current, commit,
+                    self._commit_message(group, group_changes),
+                    self._change_time(group_changes, times))
+            self._run(['update-ref', '-m', 'gitobox: check in', branch,
+                       commit, parent or b'0' * 40])
+            self._set_synced_commit(commit)
+            logging.info("Created %s %s",
+                         "revision" if len(groups) == 1
+                         else "%d revisions, up to" % len(groups),
+                         commit.decode('ascii'))
+
+    def _group_changes(self, changes):
+        """Splits changes into the commits to make, as (group, changes).
+
+        The group is a top-level directory name, b'' for the files at the
+        top, or None if the changes are not split.
+        """
+        if not self.split_commits:
+            return [(None, changes)]
+        groups = {}
+        for change in changes:
+            path = change[1]
+            group = path.split(b'/', 1)[0] if b'/' in path else b''
+            groups.setdefault(group, []).append(change)
+        if len(groups) > self.MAX_SPLIT_COMMITS:
+            return [(None, changes)]
+        return sorted(iteritems(groups))
+
+    def _file_times(self, changes, parent):
+        """Gets the mtimes of the files that were added or modified.
+
+        Times are kept between the date of the `parent` commit and now.
+        """
+        floor = 0 if parent is None else self._commit_time(parent)
+        now = time.time()
+        times = {}
+        for status, path, _, _ in changes:
+            if status == b'D':
+                continue
+            try:
+                st = os.lstat((self.workdir / path).path)
+            except OSError:
+                continue
+            times[path] = min(max(st.st_mtime, floor), now)
+        return times
+
+    def _group_by_time(self, changes, times):
+        """Splits changes into sessions, where mtimes are close together.
+
+        A new session starts when the next change happened more than
+        `catch_up_gap` seconds after the previous one; if that makes too many,
+        only the largest gaps are used. Deletions, which have no time, go in
+        the last session.
+        """
+        timed = sorted((c for c in changes if c[1] in times),
+                       key=lambda c: times[c[1]])
+        untimed = [c for c in changes if c[1] not in times]
+        if not timed:
+            return [changes]
+        gaps = [(times[timed[i][1]] - times[timed[i - 1][1]], i)
+                for i in irange(1, len(timed))]
+        gaps.sort(reverse=True)
+        splits = sorted(i for gap, i in gaps[:self.MAX_CATCH_UP_COMMITS - 1]
+                        if gap > self.catch_up_gap)
+        sessions = []
+        start = 0
+        for end in splits + [len(timed)]:
+            sessions.append(timed[start:end])
+            start = end
+        sessions[-1].extend(untimed)
+        if len(sessions) > 1:
+            logging.info("Changes made while not running were spread over "
+                         "time, making %d commits", len(sessions))
+        return [sorted(session, key=lambda c: c[1]) for session in sessions]
+
+    def _commit_message(self, group, changes):
+        """Summarizes changes, (status, path, mode, blob), for a commit.
+        """
+        counts = {}
+        for change in changes:
+            status = b'M' if change[0] == b'T' else change[0]
+            counts[status] = counts.get(status, 0) + 1
+        subject = ", ".join("%d %s" % (counts[status], word)
+                            for status, word in [(b'A', "added"),
+                                                 (b'M', "modified"),
+                                                 (b'D', "deleted")]
+                            if status in counts)
+        subject = subject.encode('ascii')
+        if group:
+            subject += b" in " + group + b"/"
+        elif group is not None:
+            subject += b" at top level"
+        lines = [subject, b'']
+        for status, path, _, _ in changes[:self.MAX_LISTED_CHANGES]:
+            lines.append(status + b' ' + path)
+        if len(changes) > self.MAX_LISTED_CHANGES:
+            lines.append(("... and %d more" % (
+                len(changes) - self.MAX_LISTED_CHANGES)).encode('ascii'))
+        lines.extend([b'', self.COMMIT_MESSAGE.encode('ascii')])
+        return b'\n'.join(lines) + b'\n'
+
+    def _relative_times(self, times):
+        """Turns the paths of a `times` dict into relative paths, as bytes.
+        """
+        if not times:
+            return {}
+        relative = {}
+        for path, timestamp in iteritems(times):
+            if path is None:
+                continue
+            path = Path(path).absolute()
+            if path.lies_under(self.workdir) and path != self.workdir:
+                relative[self.workdir.rel_path_to(path).path] = timestamp
+        return relative
+
+    def _change_time(self, changes, times):
+        """Finds when the latest of some changes happened.
+
+        Uses the time recorded for the path, or for the closest parent
+        directory, or now if there is none.
+        """
+        latest = None
+        for change in changes:
+            path = change[1]
+            while path:
+                if path in times:
+                    if latest is None or times[path] > latest:
+                        latest = times[path]
+                    break
+                path = path.rpartition(b'/')[0]
+        return time.time() if latest is None else latest
+
+    def _identity(self):
+        """Gets the name and email to commit with, as ``Name <email>``.
+
+        Read once from Git (configuration or environment).
+        """
+        if self._ident is None:
+            ident = self._run(['var', 'GIT_COMMITTER_IDENT'], stdout=True)
+            self._ident = ident.strip().rsplit(b' ', 2)[0]
+        return self._ident
+
+    @staticmethod
+    def _format_date(timestamp):
+        """Formats a date for a commit object, in the local timezone.
+        """
+        timestamp = int(timestamp)
+        if time.localtime(timestamp).tm_isdst > 0 and time.daylight:
+            offset = -time.altzone
+        else:
+            offset = -time.timezone
+        sign = '+' if offset >= 0 else '-'
+        offset = abs(offset) // 60
+        return ('%d %s%02d%02d' % (timestamp, sign, offset // 60,
+                                   offset % 60)).encode('ascii')
+
+    def _write_commit(self, tree, parent, message, author_time):
+        """Writes a commit object in-process, returns its ID.
+        """
+        ident = self._identity()
+        lines = [b'tree ' + tree]
+        if parent is not None:
+            lines.append(b'parent ' + parent)
+        lines.append(b'author ' + ident + b' ' +
+                     self._format_date(author_time))
+        lines.append(b'committer ' + ident + b' ' +
+                     self._format_date(time.time()))
+        return self._write_object('commit',
+                                  b'\n'.join(lines) + b'\n\n' + message)
+
+    def _commit_time(self, commit):
+        """Reads the author date of a commit, as a timestamp.
+        """
+        buf = io.BytesIO()
+        if self._cat_blob.write_to(commit, buf) is None:
+            raise KeyError("Missing commit %s" % commit.decode('ascii'))
+        for line in buf.getvalue().split(b'\n'):
+            if not line:
+                break
+            elif line.startswith(b'author '):
+                return int(line.rsplit(b' ', 2)[1])
+        return 0
+
+    def _read_tree(self, tree):
+        """Reads a tree object, as a dict mapping names to (mode, ID).
+        """
+        buf = io.BytesIO()
+        if self._cat_blob.write_to(tree, buf) is None:
+            raise KeyError("Missing tree %s" % tree.decode('ascii'))
+        data = buf.getvalue()
+        entries = {}
+        pos = 0
+        while pos < len(data):
+            space = data.index(b' ', pos)
+            nul = data.index(b'\0', space)
+            entries[data[space + 1:nul]] = (
+                data[pos:space],
+                binascii.hexlify(data[nul + 1:nul + 21]))
+            pos = nul + 21
+        return entries
+
+    def _edit_tree(self, tree, changes):
+        """Applies changes to a tree, writing the new trees in-process.
+
+        `changes` maps relative paths to (mode, blob ID), or to None to delete
+        them. Returns the ID of the new tree.
+        """
+        tree = self._edit_subtree(None if tree == self.EMPTY_TREE else tree,
+                                  changes)
+        return self._write_object('tree', b'') if tree is None else tree
+
+    def _edit_subtree(self, tree, changes):
+        entries = {} if tree is None else self._read_tree(tree)
+        subchanges = {}
+        for path, change in iteritems(changes):
+            name, sep, rest = path.partition(b'/')
+            if sep:
+                subchanges.setdefault(name, {})[rest] = change
+            elif change is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = change
+        for name, sub in iteritems(subchanges):
+            old = entries.get(name)
+            if old is not None and old[0] == self.TREE_MODE:
+                subtree = self._edit_subtree(old[1], sub)
+                if subtree is None:
+                    del entries[name]
+                else:
+                    entries[name] = self.TREE_MODE, subtree
+            else:
+                # Not a directory, or a file replaced it
+                subtree = self._edit_subtree(None, sub)
+                if subtree is not None:
+                    entries[name] = self.TREE_MODE, subtree
+        if not entries:
+            return None
+
+        def sort_key(item):
+            # Git sorts directories as if their name ended with a slash
+            name, (mode, _) = item
+            return name + b'/' if mode == self.TREE_MODE else name
+        return self._write_object('tree', b''.join(
+            mode + b' ' + name + b'\0' + binascii.unhexlify(sha)
+            for name, (mode, sha) in sorted(iteritems(entries),
+                                            key=sort_key)))
+
+    def _diff_trees(self, old, new):
+        """Lists the entries that differ between two trees.
+
+        Yields (status, path, new mode, new blob ID) tuples, where status is
+        A, M, D or T (type changed).
+        """
+        out = self._run(['diff-tree', '-r', '-z', '--no-renames', old, new],
+                        stdout=True)
+        fields = out.split(b'\0')
+        for i in irange(0, len(fields) - 1, 2):
+            _, mode, _, blob, status = fields[i].split(b' ')
+            yield status, fields[i + 1], mode, blob
+
+    def _changed_entries(self, old, new):
+        """Lists the entries that differ between two trees.
+
+        Yields (path, new mode, new blob ID) tuples, where mode and ID are
+        None for entries that were removed.
+        """
+        for status, path, mode, blob in self._diff_trees(old, new):
+            if status == b'D':
+                yield path, None, None
+            elif status == b'T':
+                # Type changed: remove then write, possibly as a symlink
+                yield path, None, None
+                yield path, mode, blob
+            else:
+                yield path, mode, blob
+
+    def _write_blob(self, path, mode, blob, filter_path=None):
+        """Atomically replaces a file with the content of a blob.
+
+        The blob is streamed to a temporary file in the same directory, which
+        is then renamed over the target. If `filter_path` is given, the
+        working tree filters for that relative path are applied (see
+        :meth:`_write_content`).
+
+        Returns the stat of the file, as written.
+        """
+        directory = path.parent
+        if not directory.is_dir():
+            directory.mkdir(parents=True)
+        temp = directory / ('.gitobox.%s.tmp' %
+                            make_unique_bytestring().decode('ascii'))
+        try:
+            if mode == b'120000':
+                link = io.BytesIO()
+                self._cat_blob.write_to(blob, link)
+                os.symlink(link.getvalue(), temp.path)
+            else:
+                with temp.open('wb') as fp:
+                    cache = self._write_content(blob, fp, filter_path)
+                if cache:
+                    self._blobs.add(blob, temp.path)
+                temp.chmod(0o755 if mode == b'100755' else 0o644)
+            st = os.lstat(temp.path)
+            temp.rename(path)
+            return st
+        except Exception:
+            if temp.lexists():
+                temp.remove()
+            raise
+
+    def _write_content(self, blob, fp, filter_path=None):
+        """Writes the content of a file to an open file object.
+
+        If the blob is a pointer to the large file store, the file it points
+        to is written instead. Blobs in the blob cache are copied from it.
+
+        If `filter_path` is given, the content goes through the conversions
+        ``git checkout`` would do for that path (end of lines, ``ident``,
+        smudge filters), which hashing the file undoes when checking it in.
+        The result depends on the path, so it doesn't use the blob cache.
+
+        Returns True if the blob was read from Git and should be added to the
+        blob cache.
+        """
+        if self._lfs is not None:
+            info = self._cat_file.info(blob)
+            if info is not None and info[2] <= MAX_POINTER_SIZE:
+                data = io.BytesIO()
+                self._cat_blob.write_to(blob, data)
+                data = data.getvalue()
+                pointer = parse_pointer(data)
+                if pointer is not None:
+                    if self._lfs.has(pointer[0]):
+                        self._lfs.materialize(pointer[0], fp)
+                        return False
+                    logging.warning("Large file %s is not in the store, "
+                                    "writing the pointer",
+                                    pointer[0].decode('ascii'))
+                    fp.write(data)
+                    return False
+                elif filter_path is None:
+                    # Small file, already read
+                    fp.write(data)
+                    return False
+        if filter_path is not None:
+            self._write_filtered(blob, filter_path, fp)
+            return False
+        if self._blobs is not None and self._blobs.copy_to(blob, fp):
+            return False
+        self._cat_blob.write_to(blob, fp)
+        return self._blobs is not None and self._blobs.wants(fp.tell())
+
+    def _write_filtered(self, blob, path, fp):
+        """Streams a blob through the filters for a path, to a file object.
+
+        ``cat-file --batch --filters`` reports the size from before
+        filtering, so this runs one ``cat-file --filters`` per file.
+        """
+        start = time.time()
+        cmd = self._git + ['cat-file', '--filters', b'--path=' + path, blob]
+        # Attributes are looked up from the current directory
+        proc = subprocess.Popen(cmd,
+                                stdout=subprocess.PIPE,
+                                cwd=self.workdir.path,
+                                env=self._env)
+        try:
+            shutil.copyfileobj(proc.stdout, fp, BatchProcess.CHUNK_SIZE)
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        self._record_timing('cat-file', time.time() - start)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
 
-        self._run(['add', '--all', '.'])
-        ret = self._run(['commit', '-m', '(gitobox automatic commit)'],
-                        allow_fail=True)
+    def _uses_filters(self, changes):
+        """Checks whether files might need converting on check-out.
 
-        if ret == 0:
-            ref = self._run(['rev-parse', 'HEAD'], stdout=True)
-            logging.info("Created revision %s", ref.decode('ascii'))
+        That is if ``core.autocrlf`` is set, or if there are attributes files
+        (which can set ``text``, ``eol`` or ``filter``), in the repository,
+        the tree being checked out or the user's configuration. Filtering
+        needs Git 2.11; with older versions, files are written as stored.
+
+        The configuration is only read again if its files changed, and the
+        index is only listed once, then kept track of by
+        :meth:`_update_index`.
+        """
+        xdg_config = Path(os.environ.get('XDG_CONFIG_HOME',
+                                         os.path.expanduser('~/.config')))
+        config_files = [self.repo / 'config',
+                        Path(os.path.expanduser('~/.gitconfig')),
+                        xdg_config / 'git' / 'config',
+                        Path('/etc/gitconfig')]
+        key = []
+        for path in config_files:
+            try:
+                key.append(StatCache.key(os.stat(path.path)))
+            except OSError:
+                key.append(None)
+        if self._filter_config[0] != key:
+            self._filter_config = key, self._get_config(
+                r'^core\.(autocrlf|attributesfile)$')
+        config = self._filter_config[1]
+
+        attributes = [self.repo / 'info' / 'attributes']
+        if b'core.attributesfile' in config:
+            attributes.append(Path(os.path.expanduser(
+                config[b'core.attributesfile'].decode('utf-8'))))
         else:
-            logging.info("No revision created")
+            attributes.append(xdg_config / 'git' / 'attributes')
+        needed = (config.get(b'core.autocrlf', b'false') != b'false' or
+                  any(path.is_file() for path in attributes) or
+                  any(is_attributes_file(path) for path, _, _ in changes))
+        if not needed:
+            if self._attributes_files is None:
+                self._attributes_files = set(
+                    name
+                    for name in self._run(['ls-files', '-z'],
+                                          stdout=True).split(b'\0')
+                    if is_attributes_file(name))
+            needed = bool(self._attributes_files)
+        if needed and self.git_version() < (2, 11):
+            logging.warning("Git is older than 2.11, files are checked out "
+                            "without end-of-line conversion or filters")
+            return False
+        return needed
+
+    def _get_config(self, regexp):
+        """Reads the configuration options matching a regular expression.
+
+        Returns a dict of lowercase option names to values.
+        """
+        proc = subprocess.Popen(self._git + ['config', '-z', '--get-regexp',
+                                             regexp],
+                                stdout=subprocess.PIPE,
+                                env=self._env)
+        out, _ = proc.communicate()
+        if proc.returncode != 0:
+            # Also 1 if no option matched
+            return {}
+        config = {}
+        for entry in out.split(b'\0'):
+            if entry:
+                name, _, value = entry.partition(b'\n')
+                config[name] = value
+        return config
+
+    def _remove_path(self, path):
+        """Removes a file, and its parent directories if they become empty.
+
+        Returns False if a directory is in the way, which is left alone.
+        """
+        if not path.lexists():
+            return True
+        if path.is_dir() and not path.is_link():
+            logging.warning("Can't remove file %s, a directory is in the "
+                            "way", path)
+            return False
+        logging.info("Removing file %s", path)
+        path.remove()
+        directory = path.parent
+        while directory != self.workdir and not directory.listdir():
+            logging.info("Removing empty directory %s", directory)
+            directory.rmdir()
+            directory = directory.parent
+        return True
 
     def check_out(self, ref):
         """Check out the given revision.
+
+        Only the files that differ between the current tree (the index) and
+        `ref` are touched: removed files are deleted and changed files are
+        streamed from Git and written atomically. The operations are written
+        to a journal first, so that :meth:`resume_check_out` can finish them
+        if gitobox dies in the middle.
+
+        Returns a :class:`~gitobox.git.CheckoutManifest` of what was written.
+        """
+        with self._timed('check_out'):
+            old = self._run(['write-tree'], stdout=True).strip()
+            changes = list(self._changed_entries(old, ref))
+            if not changes:
+                self._set_synced_commit(ref)
+                return CheckoutManifest(ref, self._hash_files)
+            self._journal.begin(ref, changes)
+            return self._apply_check_out(ref, changes, {})
+
+    def resume_check_out(self):
+        """Finishes a check-out that was interrupted, from its journal.
+
+        Only the operations that weren't done are, the others are trusted if
+        the files still have the stat they were written with. Operations that
+        fail are skipped, and if resuming fails altogether the journal is
+        dropped, so that startup can go on. Returns False if there was nothing
+        to resume.
         """
-        fd, temptar = Path.tempfile()
-        os.close(fd)
         try:
-            self._run(['symbolic-ref', 'HEAD', 'refs/heads/%s' % self.branch])
-
-            # Creates an archive from the tree
-            self._run(['archive', '--format=tar', '-o', temptar.path, ref])
-            tar = tarfile.open(str(temptar), 'r')
-
-            # List the files in the tree
-            files = set(self.workdir / m.name
-                        for m in tar.getmembers())
-
-            # Remove from the directory all the files that don't exist
-            removed_files = False
-            for path in self.workdir.recursedir(top_down=False):
-                if path.is_file() and path not in files:
-                    logging.info("Removing file %s", path)
-                    path.remove()
-                    removed_files = True
-                elif path.is_dir():
-                    if not path.listdir() and removed_files:
-                        logging.info("Removing empty directory %s", path)
-                        path.rmdir()
-                    removed_files = False
-
-            # Replace all the files
-            tar.extractall(str(self.workdir))
-
-            tar.close()
-        finally:
-            temptar.remove()
+            journal = self._journal.load()
+            if journal is None:
+                return False
+            ref, changes, done = journal
+            logging.warning("Resuming interrupted check-out of %s: %d of %d "
+                            "operations left", ref.decode('ascii')[:7],
+                            len(changes) - len(done), len(changes))
+            with self._timed('resume_check_out'):
+                # Temporary files of the write that got interrupted
+                directories = set((self.workdir / path).parent
+                                  for i, (path, mode, _) in enumerate(changes)
+                                  if mode is not None and i not in done)
+                for directory in directories:
+                    if directory.is_dir():
+                        for temp in directory.listdir('.gitobox.*.tmp'):
+                            logging.info("Removing temporary file %s", temp)
+                            temp.remove()
+                self._apply_check_out(ref, changes, done)
+        except Exception:
+            logging.exception("Couldn't resume interrupted check-out, "
+                              "dropping its journal")
+            self._journal.finish()
+        return True
+
+    def _apply_check_out(self, ref, changes, done):
+        """Applies the operations of a check-out, then updates the index.
+
+        `done` maps the operations already done (numbered in `changes`) to the
+        stat key of the file they wrote (empty for removals), or None if they
+        were skipped.
+        """
+        manifest = CheckoutManifest(ref, self._hash_files)
+
+        # Deletions first, so that files can replace directories and
+        # directories can replace files
+        removed = []
+        for i, (path, mode, blob) in enumerate(changes):
+            if mode is None:
+                if i not in done:
+                    try:
+                        ok = self._remove_path(self.workdir / path)
+                    except (IOError, OSError) as e:
+                        logging.warning("Couldn't remove %s: %s",
+                                        path.decode('utf-8', 'replace'), e)
+                        ok = not (self.workdir / path).lexists()
+                    if ok:
+                        self._journal.done(i)
+                    else:
+                        self._journal.done(i, skipped=True)
+                        done[i] = None
+                if done.get(i, ()) is None:
+                    manifest.skipped.add(path)
+                    continue
+                removed.append(path)
+                manifest.removed.add(path)
+        # Attributes files are written first, the filters used for the other
+        # files depend on them
+        filters = self._uses_filters(changes)
+        order = sorted(irange(len(changes)),
+                       key=lambda i: not is_attributes_file(changes[i][0]))
+        entries = []
+        cache_updates = []
+        for i in order:
+            path, mode, blob = changes[i]
+            if mode is None:
+                continue
+            elif mode == b'160000':
+                logging.warning("Not checking out submodule %s",
+                                path.decode('utf-8', 'replace'))
+                entries.append((mode, blob, path))
+                continue
+            target = self.workdir / path
+            if i in done:
+                if done[i] is None:
+                    manifest.skipped.add(path)
+                    continue
+                # Written before the interruption; the stat cache only gets
+                # it if it hasn't been changed since
+                entries.append((mode, blob, path))
+                try:
+                    st = os.lstat(target.path)
+                except OSError:
+                    continue
+                if StatCache.key(st) == done[i]:
+                    cache_updates.append((path, st, mode, blob))
+                    manifest.written[path] = done[i], blob
+                continue
+            if target.is_dir() and not target.is_link():
+                logging.warning("Can't write file %s, a directory is in "
+                                "the way", target)
+                manifest.skipped.add(path)
+                self._journal.done(i, skipped=True)
+                continue
+            try:
+                st = self._write_blob(target, mode, blob,
+                                      path if filters else None)
+            except (IOError, OSError, subprocess.CalledProcessError) as e:
+                logging.warning("Couldn't write %s: %s", target, e)
+                manifest.skipped.add(path)
+                self._journal.done(i, skipped=True)
+                continue
+            self._journal.done(i, st)
+            entries.append((mode, blob, path))
+            cache_updates.append((path, st, mode, blob))
+            manifest.written[path] = StatCache.key(st), blob
+
+        logging.info("Checked out %d changed paths", len(changes))
+        if any(is_attributes_file(path) for path, _, _ in changes):
+            self._hash_pool.close()
+
+        # Records the new files in the index and the stat cache, without
+        # reading them again. If they get changed after we wrote them, their
+        # stat won't match and they will be hashed on the next check-in
+        self._update_index(entries, removed)
+        self.cache.remove(removed)
+        self.cache.update(cache_updates)
+        self._set_synced_commit(ref)
+        self._journal.finish()
+        return manifest
+
+    def git_version(self):
+        """Returns the version of Git, as a tuple of integers.
+        """
+        if self._git_version is None:
+            out = self._run(['version'], stdout=True).decode('ascii',
+                                                             'replace')
+            version = []
+            for part in out.split()[-1].split('.'):
+                if not part.isdigit():
+                    break
+                version.append(int(part))
+            self._git_version = tuple(version)
+        return self._git_version
+
+    def count_objects(self):
+        """Counts the loose objects and the packs, from ``count-objects``.
+
+        Returns a dict with the fields of ``git count-objects -v`` (`count`,
+        `size`, `in-pack`, `packs`, ...), as integers.
+        """
+        out = self._run(['count-objects', '-v'], stdout=True)
+        counts = {}
+        for line in out.decode('ascii', 'replace').splitlines():
+            key, sep, value = line.partition(':')
+            if sep and value.strip().isdigit():
+                counts[key.strip()] = int(value)
+        return counts
+
+    def repack(self):
+        """Packs the loose objects, and merges packs when they pile up.
+
+        With Git 2.32 and up, packs are merged geometrically (each pack at
+        least twice as big as the next), so that the cost stays proportional
+        to the new objects; older versions only pack the loose objects.
+        Commands run with a low priority, and concurrently with other
+        operations, which Git supports.
+        """
+        with self._timed('repack', serialize=False):
+            cmd = ['repack', '-d', '-l', '-q']
+            if self.git_version() >= (2, 32):
+                cmd.append('--geometric=2')
+            self._run(cmd, background=True)
+            self._run(['prune-packed', '-q'], background=True)
+
+    def write_commit_graph(self):
+        """Updates the commit-graph file, incrementally.
+        """
+        with self._timed('commit_graph', serialize=False):
+            if self.git_version() >= (2, 24):
+                self._run(['commit-graph', 'write', '--reachable', '--split'],
+                          background=True)
+
+    def prune(self, expire):
+        """Deletes the unreachable loose objects older than `expire`.
+
+        Objects referenced by the index count as reachable; recent ones are
+        kept because operations in progress might be about to use them. For
+        that to hold, everything that writes objects has to freshen those
+        that already exist: Git does, and so does :meth:`_write_object`.
+        """
+        with self._timed('prune', serialize=False):
+            self._run(['prune', '--expire=%s' % expire], background=True)
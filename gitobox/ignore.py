@@ -0,0 +1,68 @@
+"""Ignore patterns for files that should never be committed.
+
+Contains :class:`~gitobox.ignore.IgnoreFilter`, which matches paths against
+gitignore-style patterns. The same patterns are given to Git (through an
+exclude file) so that a full scan ignores the same files as the watcher.
+"""
+
+from __future__ import unicode_literals
+
+import fnmatch
+import re
+
+
+# Temporary files of sync clients and office software, and our own
+DEFAULT_IGNORE = [
+    '.dropbox',
+    '.dropbox.attr',
+    '.dropbox.cache',
+    '~$*',
+    '.~lock*',
+    '.gitobox.*.tmp',
+]
+
+
+class IgnoreFilter(object):
+    """Matches relative paths against gitignore-style patterns.
+
+    A pattern without a slash matches any component of the path (so if it
+    matches a directory, everything under it is ignored). A pattern with a
+    slash matches from the root of the folder. A trailing slash is accepted
+    but not enforced. Negation (``!``) is not supported.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        names = []
+        anchored = []
+        for pattern in self.patterns:
+            pattern = pattern.rstrip('/')
+            if not pattern or pattern.startswith('#'):
+                continue
+            if '/' in pattern:
+                anchored.append(fnmatch.translate(pattern.lstrip('/')))
+            else:
+                names.append(fnmatch.translate(pattern))
+        self._names = re.compile('|'.join(names)) if names else None
+        self._anchored = (re.compile('|'.join(anchored)) if anchored
+                          else None)
+
+    def match(self, path):
+        """Returns True if the relative path is ignored.
+        """
+        components = path.split('/')
+        if self._names is not None:
+            for component in components:
+                if self._names.match(component):
+                    return True
+        if self._anchored is not None:
+            for i in range(1, len(components) + 1):
+                if self._anchored.match('/'.join(components[:i])):
+                    return True
+        return False
+
+    def write_exclude_file(self, path):
+        """Writes the patterns in a file Git can read (``--exclude-from``).
+        """
+        with path.open('w', encoding='utf-8') as fp:
+            for pattern in self.patterns:
+                fp.write(pattern + '\n')
@@ -0,0 +1,115 @@
+"""Write journal of check-outs, to finish them after a crash.
+
+Contains :class:`~gitobox.journal.CheckoutJournal`.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+import os
+
+from gitobox.cache import StatCache
+
+
+MAGIC = b'gitobox-checkout 1\n'
+
+
+class CheckoutJournal(object):
+    """The operations a check-out is about to do, and those it did.
+
+    Before the folder gets touched, the list of operations (a commit ID, then
+    one ``<mode> <blob> <path>`` record per operation, NUL-terminated, with
+    ``-`` for the mode and blob of removals) is written to `path` and synced
+    to disk. Each operation that completes is then appended to the progress
+    file next to it: its number and, for files written, their stat key (see
+    :meth:`~gitobox.cache.StatCache.key`), or ``-`` if it was skipped. Both
+    files are removed once the
+    index has been updated.
+
+    The progress file is flushed but not synced after each operation; the
+    files written to the folder aren't synced either, so this protects
+    against the process dying, not against power loss.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._progress_path = path.parent / (path.unicodename + '.done')
+        self._progress = None
+
+    def begin(self, ref, operations):
+        """Records the operations, a list of (path, mode, blob) tuples.
+        """
+        temp = self.path.parent / (self.path.unicodename + '.tmp')
+        with temp.open('wb') as fp:
+            fp.write(MAGIC + ref + b'\n')
+            for path, mode, blob in operations:
+                fp.write(b' '.join([mode or b'-', blob or b'-', path]) +
+                         b'\0')
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._progress = self._progress_path.open('wb')
+        temp.rename(self.path)
+
+    def done(self, number, st=None, skipped=False):
+        """Records that an operation was done, with the stat of what it wrote.
+        """
+        if skipped:
+            line = '%d -\n' % number
+        elif st is None:
+            line = '%d\n' % number
+        else:
+            line = '%d %d %d %d\n' % ((number,) + StatCache.key(st))
+        self._progress.write(line.encode('ascii'))
+        self._progress.flush()
+
+    def load(self):
+        """Reads an interrupted journal.
+
+        Returns (ref, operations, done) where `done` maps the number of the
+        operations done to the stat key of what they wrote (empty for
+        removals) or None if they were skipped, or None if there is no
+        journal to resume.
+        """
+        if not self.path.exists():
+            return None
+        with self.path.open('rb') as fp:
+            data = fp.read()
+        header, sep, records = data[len(MAGIC):].partition(b'\n')
+        if not data.startswith(MAGIC) or not sep:
+            logging.warning("Ignoring invalid check-out journal %s",
+                            self.path)
+            return None
+        operations = []
+        for record in records.split(b'\0')[:-1]:
+            mode, blob, path = record.split(b' ', 2)
+            if mode == b'-':
+                mode = blob = None
+            operations.append((path, mode, blob))
+
+        done = {}
+        size = 0
+        if self._progress_path.exists():
+            with self._progress_path.open('rb') as fp:
+                for line in fp:
+                    # The last line might have been cut short
+                    if not line.endswith(b'\n'):
+                        break
+                    fields = line.split()
+                    number = int(fields[0])
+                    if fields[1:] == [b'-']:
+                        done[number] = None
+                    else:
+                        done[number] = tuple(int(f) for f in fields[1:])
+                    size += len(line)
+        self._progress = self._progress_path.open('ab')
+        self._progress.truncate(size)
+        return header, operations, done
+
+    def finish(self):
+        """Removes the journal, once the check-out is complete.
+        """
+        if self._progress is not None:
+            self._progress.close()
+            self._progress = None
+        for path in (self.path, self._progress_path):
+            if path.exists():
+                path.remove()
@@ -0,0 +1,139 @@
+"""Storage of large files outside of the Git object store.
+
+Contains :class:`~gitobox.lfs.LargeFileStore`. Large files are copied into a
+content-addressed store in the repository, and a small pointer file is
+committed in their place. The pointer format and the layout of the store
+(``lfs/objects/ab/cd/abcd...``) are those of Git LFS.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import re
+
+from gitobox.copying import copy_data, reflink
+from gitobox.utils import make_unique_bytestring
+
+
+POINTER_VERSION = b'version https://git-lfs.github.com/spec/v1\n'
+
+# Blobs bigger than this are never pointers
+MAX_POINTER_SIZE = 1024
+
+_oid_re = re.compile(br'^[0-9a-f]{64}$')
+
+
+def make_pointer(oid, size):
+    """Makes the content of a pointer file.
+    """
+    return (POINTER_VERSION + b'oid sha256:' + oid + b'\n' +
+            ('size %d\n' % size).encode('ascii'))
+
+
+def parse_pointer(data):
+    """Reads a pointer file, returns (oid, size) or None if it isn't one.
+    """
+    if len(data) > MAX_POINTER_SIZE or not data.startswith(POINTER_VERSION):
+        return None
+    fields = {}
+    for line in data[len(POINTER_VERSION):].splitlines():
+        key, sep, value = line.partition(b' ')
+        if sep:
+            fields[key] = value
+    oid = fields.get(b'oid', b'')
+    if not oid.startswith(b'sha256:') or not _oid_re.match(oid[7:]):
+        return None
+    try:
+        size = int(fields.get(b'size', b''))
+    except ValueError:
+        return None
+    return oid[7:], size
+
+
+class LargeFileStore(object):
+    """Content-addressed store for large files, using Git LFS's layout.
+
+    Objects are named after the SHA-256 of their content and are never
+    modified; files are written into the working directory as copies (cloned
+    where the filesystem supports it), never as hard links, since programs
+    editing a file in place would otherwise corrupt the store.
+    """
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, path, threshold=None):
+        self.path = path
+        # Files that are at least that big are stored here, None to only
+        # read from the store
+        self.threshold = threshold
+        self._temp = path.parent / 'tmp'
+
+    def object_path(self, oid):
+        oid = oid.decode('ascii')
+        return self.path / oid[:2] / oid[2:4] / oid
+
+    def has(self, oid):
+        return self.object_path(oid).is_file()
+
+    def store(self, filename):
+        """Copies a file into the store.
+
+        Returns the content of the pointer file for it, or None if it
+        couldn't be read.
+        """
+        try:
+            src = open(filename, 'rb')
+        except (IOError, OSError):
+            return None
+        if not self._temp.is_dir():
+            self._temp.mkdir(parents=True)
+        temp = self._temp / make_unique_bytestring().decode('ascii')
+        try:
+            sha = hashlib.sha256()
+            size = 0
+            with src:
+                with temp.open('wb') as dst:
+                    cloned = reflink(src, dst)
+                    if not cloned:
+                        size = self._copy_hashing(src, sha, dst)
+            if cloned:
+                # The file might have changed since, hash what was cloned
+                with temp.open('rb') as fp:
+                    size = self._copy_hashing(fp, sha)
+            oid = sha.hexdigest().encode('ascii')
+            target = self.object_path(oid)
+            if target.exists():
+                temp.remove()
+            else:
+                if not target.parent.is_dir():
+                    target.parent.mkdir(parents=True)
+                temp.chmod(0o444)
+                temp.rename(target)
+                logging.debug("Stored large file %s (%d bytes) as %s",
+                              filename, size, oid.decode('ascii'))
+        except Exception:
+            if temp.exists():
+                temp.remove()
+            raise
+        return make_pointer(oid, size)
+
+    def _copy_hashing(self, src, sha, dst=None):
+        """Reads a file to the end, hashing it and maybe copying it.
+
+        Returns the number of bytes read.
+        """
+        size = 0
+        while True:
+            chunk = src.read(self.CHUNK_SIZE)
+            if not chunk:
+                return size
+            sha.update(chunk)
+            size += len(chunk)
+            if dst is not None:
+                dst.write(chunk)
+
+    def materialize(self, oid, fp):
+        """Writes the content of an object to an open file.
+        """
+        with self.object_path(oid).open('rb') as src:
+            copy_data(src, fp)
@@ -0,0 +1,158 @@
+"""The lock protecting a folder's synchronization operations.
+
+Contains :class:`~gitobox.locking.SyncLock`. It is held by the
+:class:`~gitobox.timer.ResettableTimer` while the directory is changing, and
+by pushes while they update the directory. Pushes that find it held wait in a
+bounded, first-come first-served queue instead of being rejected.
+"""
+
+from __future__ import unicode_literals
+
+from collections import deque
+from threading import Condition
+import time
+
+from gitobox.metrics import LOCK_BUSY, LOCK_HELD, PUSH_WAIT
+
+
+class SyncLock(object):
+    """A lock with a fair queue of waiters and a deadline.
+
+    :meth:`acquire` and :meth:`release` behave like a
+    :class:`threading.Semaphore` of 1, except that a non-blocking
+    :meth:`acquire` fails while there are waiters in the queue: the directory
+    changing again doesn't get to jump ahead of pushes that have been waiting.
+
+    :meth:`wait_acquire` puts the caller in the queue.
+
+    `name` labels the lock's metrics in :mod:`gitobox.metrics`.
+    """
+    def __init__(self, max_waiting=16, name=''):
+        self.max_waiting = max_waiting
+        self.name = name
+        self._cond = Condition()
+        self._held = False
+        self._queue = deque()
+        # Who holds the lock ('timer', 'push' or 'pause') and since when
+        self._holder = None
+        self._held_since = None
+
+        # Metrics
+        self.waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_queued = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    @property
+    def queued(self):
+        """Number of waiters in the queue.
+        """
+        return len(self._queue)
+
+    def busy(self):
+        """Returns True if the lock is held or pushes are waiting for it.
+        """
+        with self._cond:
+            return self._held or bool(self._queue)
+
+    def acquire(self, blocking=True):
+        with self._cond:
+            while self._held or self._queue:
+                if not blocking:
+                    LOCK_BUSY.inc(folder=self.name)
+                    return False
+                self._cond.wait()
+            self._take('timer')
+            return True
+
+    def _take(self, holder):
+        """Marks the lock as held; call with cond held.
+        """
+        self._held = True
+        self._holder = holder
+        self._held_since = time.time()
+
+    def release(self):
+        with self._cond:
+            if not self._held:
+                raise RuntimeError("Releasing unheld SyncLock")
+            self._held = False
+            LOCK_HELD.observe(time.time() - self._held_since,
+                              folder=self.name, holder=self._holder)
+            self._cond.notifyAll()
+
+    def wait_acquire(self, deadline, progress=None, interval=2.0,
+                     holder='push'):
+        """Waits in line for the lock, for at most `deadline` seconds.
+
+        While waiting, `progress(position, queued)` is called every `interval`
+        seconds, outside of any lock (so it can be slow, e.g. write to a
+        socket); `position` is the number of waiters ahead plus one.
+
+        Returns False if the lock couldn't be acquired in time, or if the queue
+        is full. `holder` labels the time it is then held in the metrics.
+        """
+        with self._cond:
+            if not self._held and not self._queue:
+                self._take(holder)
+                self._record_wait(0.0)
+                return True
+            if len(self._queue) >= self.max_waiting:
+                self.rejected += 1
+                return False
+
+            ticket = object()
+            self._queue.append(ticket)
+            self.max_queued = max(self.max_queued, len(self._queue))
+            start = now = time.time()
+            next_progress = start
+            try:
+                while self._held or self._queue[0] is not ticket:
+                    if now >= start + deadline:
+                        self.timeouts += 1
+                        return False
+                    if progress is not None and now >= next_progress:
+                        position = self._queue.index(ticket) + 1
+                        queued = len(self._queue)
+                        self._cond.release()
+                        try:
+                            progress(position, queued)
+                        finally:
+                            self._cond.acquire()
+                        next_progress = time.time() + interval
+                    now = time.time()
+                    wakeup = start + deadline
+                    if progress is not None:
+                        wakeup = min(wakeup, next_progress)
+                    self._cond.wait(max(wakeup - now, 0.0))
+                    now = time.time()
+                self._take(holder)
+                self._record_wait(now - start)
+                return True
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notifyAll()
+
+    def _record_wait(self, duration):
+        self.waits += 1
+        self.total_wait += duration
+        self.max_wait = max(self.max_wait, duration)
+        PUSH_WAIT.observe(duration, folder=self.name)
+
+    def stats(self):
+        """Returns the queue metrics and current holder, as a dictionary.
+        """
+        with self._cond:
+            held = self._held
+            return {'holder': self._holder if held else None,
+                    'held_for': time.time() - self._held_since if held
+                    else None,
+                    'queued': len(self._queue),
+                    'max_queued': self.max_queued,
+                    'waits': self.waits,
+                    'total_wait': self.total_wait,
+                    'max_wait': self.max_wait,
+                    'timeouts': self.timeouts,
+                    'rejected': self.rejected}
@@ -2,19 +2,21 @@
 
 This contains :func:`~gitobox.main.main`, which is the entry point declared to
 setuptools. It is also callable directly.
+
+``gitobox ctl ...`` is handed to :mod:`gitobox.ctl` before anything else gets
+imported, so that it starts fast.
 """
 
 from __future__ import unicode_literals
 
 import argparse
+import atexit
 import codecs
 import locale
 import logging
-from rpaths import Path
 import sys
 
 from gitobox import __version__ as gitobox_version
-from gitobox.sync import synchronize
 
 
 def setup_logging(verbosity):
@@ -35,6 +37,17 @@ def setup_logging(verbosity):
 def main():
     """Entry point when called on the command line.
     """
+    if sys.argv[1:2] == ['ctl']:
+        from gitobox.ctl import ctl_main
+        ctl_main(sys.argv[2:])
+
+    from rpaths import Path
+
+    from gitobox.daemon import daemon
+    from gitobox.metrics import REGISTRY, MetricsServer, enable_tracing
+    from gitobox.sync import synchronize
+    from gitobox.utils import parse_size
+
     # Locale
     locale.setlocale(locale.LC_ALL, '')
 
@@ -62,23 +75,134 @@ def main():
                     "repository; it is particularly useful to make a Git "
                     "branch out of changes happening in DropBox or "
                     "similar \"dump\" collaboration software",
+        epilog="Use 'gitobox ctl REPOSITORY COMMAND' to control a running "
+               "gitobox (sync-now, flush, pause, resume, status)",
         parents=[options])
-    parser.add_argument('folder',
+    parser.add_argument('folder', nargs='?',
                         help="Folder to watch for changes")
-    parser.add_argument('repository',
+    parser.add_argument('repository', nargs='?',
                         help="Git repository to synchronize")
+    parser.add_argument('-c', '--config', action='store',
+                        help="Run as a daemon, synchronizing all the folders "
+                        "listed in this configuration file")
     parser.add_argument('-b', '--branch', action='store', default='master',
                         help="Git branch to synchronize (default: master)")
     parser.add_argument('-t', '--timeout', action='store', type=int,
                         default='5',
                         help="Time to wait after last directory change before "
                         "committing (in seconds)")
+    parser.add_argument('--max-delay', action='store', type=float,
+                        default='60',
+                        help="Commit after that long even if the directory "
+                        "is still changing (in seconds, default: 60, 0 to "
+                        "disable)")
+    parser.add_argument('--backoff', action='store', type=float,
+                        default='0',
+                        help="Extra time to wait for each change per second "
+                        "happening in the directory (in seconds, default: 0)")
+    parser.add_argument('--ignore', action='append', default=[],
+                        metavar='PATTERN',
+                        help="Never commit files matching this "
+                        "gitignore-style pattern (can be repeated); "
+                        "temporary files of DropBox and office software are "
+                        "always ignored")
+    parser.add_argument('--poll', action='store', type=float, default='0',
+                        metavar='SECONDS',
+                        help="Scan the folder for changes at this interval "
+                        "instead of relying on filesystem events, e.g. on "
+                        "network filesystems (default: 0, use events)")
+    parser.add_argument('--poll-budget', action='store', type=float,
+                        default='0.1', metavar='FRACTION',
+                        help="Maximum fraction of the time spent scanning "
+                        "when polling; scans are spaced further apart on "
+                        "large folders (default: 0.1)")
+    parser.add_argument('--split-commits', action='store_true',
+                        help="Make one commit per top-level directory that "
+                        "changed, instead of one for the whole folder")
+    parser.add_argument('--catch-up-gap', action='store', type=float,
+                        metavar='SECONDS',
+                        help="On startup, commit the changes made while "
+                        "gitobox wasn't running as several commits dated "
+                        "from the files' modification times, starting a new "
+                        "one when changes are more than SECONDS apart")
+    parser.add_argument('--lfs-threshold', action='store', type=parse_size,
+                        metavar='SIZE',
+                        help="Keep files at least that big (e.g. 50M) out "
+                        "of Git: they are copied to a store in the "
+                        "repository and committed as Git LFS pointers. "
+                        "Applies to files as they change; use "
+                        "--rebuild-cache to convert all of them")
+    parser.add_argument('--blob-cache', action='store', type=parse_size,
+                        metavar='SIZE',
+                        help="Keep uncompressed copies of the files checked "
+                        "out, up to that total size (e.g. 2G), and write "
+                        "them from there when they are checked out again; "
+                        "copies are free on filesystems supporting reflinks "
+                        "(btrfs, XFS)")
+    parser.add_argument('--maintenance-interval', action='store',
+                        type=float, default='300', metavar='SECONDS',
+                        help="How often to check whether the repository "
+                        "needs repacking, done in the background while the "
+                        "folder is idle (default: 300, 0 disables it)")
+    parser.add_argument('--push-deadline', action='store', type=float,
+                        default='30',
+                        help="How long a push waits for the directory to "
+                        "settle before being rejected (in seconds, default: "
+                        "30)")
+    parser.add_argument('--metrics-port', action='store', type=int,
+                        metavar='PORT',
+                        help="Serve metrics in the Prometheus text format on "
+                        "http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print a summary of the metrics on exit")
+    parser.add_argument('--trace', action='store', metavar='FILE',
+                        help="Write timed spans of the operations to this "
+                        "file, in Chrome's trace event format")
+    cache_opts = parser.add_mutually_exclusive_group()
+    cache_opts.add_argument('--verify-cache', action='store_const',
+                            dest='cache', const='verify',
+                            help="Check the stat cache against the files' "
+                            "content on startup")
+    cache_opts.add_argument('--rebuild-cache', action='store_const',
+                            dest='cache', const='rebuild',
+                            help="Discard the stat cache on startup, hashing "
+                            "every file again")
 
     args = parser.parse_args()
+    if args.config is not None:
+        if args.folder is not None or args.repository is not None:
+            parser.error("folder and repository can't be given with --config")
+    elif args.folder is None or args.repository is None:
+        parser.error("folder and repository are required, unless --config "
+                     "is given")
+    if not 0 < args.poll_budget <= 1:
+        parser.error("--poll-budget should be between 0 and 1")
     setup_logging(args.verbosity)
 
-    synchronize(Path(args.folder), Path(args.repository), args.branch,
-                args.timeout)
+    if args.metrics_port is not None:
+        MetricsServer(args.metrics_port).start()
+    if args.stats:
+        atexit.register(
+            lambda: sys.stderr.write("\n" + REGISTRY.summarize()))
+    if args.trace is not None:
+        enable_tracing(args.trace)
+
+    if args.config is not None:
+        daemon(Path(args.config), cache=args.cache)
+    else:
+        synchronize(Path(args.folder), Path(args.repository), args.branch,
+                    args.timeout, cache=args.cache,
+                    push_deadline=args.push_deadline,
+                    max_delay=args.max_delay or None,
+                    backoff=args.backoff,
+                    ignore=args.ignore,
+                    poll=args.poll or None,
+                    poll_budget=args.poll_budget,
+                    split_commits=args.split_commits,
+                    lfs_threshold=args.lfs_threshold,
+                    maintenance_interval=args.maintenance_interval,
+                    blob_cache=args.blob_cache,
+                    catch_up_gap=args.catch_up_gap)
 
     sys.exit(0)
 
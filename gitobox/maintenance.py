@@ -0,0 +1,136 @@
+"""Background maintenance of the repository.
+
+Contains :class:`~gitobox.maintenance.Maintenance`. Every check-in adds loose
+objects to the repository; they are packed from time to time by a background
+thread, while the folder is idle. A single thread does this for all the
+repositories.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+from threading import Condition, Thread
+import time
+
+from gitobox.metrics import MAINTENANCE
+
+
+# Repositories whose maintenance is scheduled, and the thread running it
+_scheduled = []
+_scheduled_cond = Condition()
+_thread = None
+
+
+def _schedule(maintenance):
+    global _thread
+    with _scheduled_cond:
+        _scheduled.append(maintenance)
+        if _thread is None:
+            _thread = Thread(target=_run, name='gitobox-maintenance')
+            _thread.setDaemon(True)
+            _thread.start()
+        _scheduled_cond.notify()
+
+
+def _run():
+    """Runs the checks of every repository when they are due.
+    """
+    while True:
+        with _scheduled_cond:
+            now = time.time()
+            due = [m for m in _scheduled if m.next_check <= now]
+            if not _scheduled:
+                _scheduled_cond.wait()
+                continue
+            elif not due:
+                _scheduled_cond.wait(min(m.next_check
+                                         for m in _scheduled) - now)
+                continue
+        for maintenance in due:
+            try:
+                maintenance.run_once()
+            except Exception:
+                logging.exception("Error during repository maintenance")
+            maintenance.next_check = time.time() + maintenance.interval
+
+
+class Maintenance(object):
+    """Packs a repository when objects pile up, while its folder is idle.
+
+    Every `interval` seconds, the objects are counted. If there are at least
+    `loose_threshold` loose objects or `pack_threshold` packs, the repository
+    is repacked and its commit-graph updated; unreachable objects are pruned
+    about once a day.
+
+    Tasks only start when nothing changed in the folder for `IDLE_DELAY`
+    seconds and the lock is free; if that stops being the case, the remaining
+    tasks are postponed to the next check. The lock itself is never taken:
+    Git supports running these concurrently with other commands, and
+    check-ins and pushes shouldn't wait for maintenance.
+    """
+    IDLE_DELAY = 30.0
+    PRUNE_INTERVAL = 24 * 3600.0
+    PRUNE_EXPIRE = '2.weeks.ago'
+
+    def __init__(self, repository, lock, watcher, interval=300.0,
+                 loose_threshold=1000, pack_threshold=20):
+        self._repository = repository
+        self._lock = lock
+        self._watcher = watcher
+        self.interval = interval
+        self.loose_threshold = loose_threshold
+        self.pack_threshold = pack_threshold
+        self._last_prune = time.time()
+        self.next_check = None
+
+    def start(self):
+        self.next_check = time.time() + self.interval
+        _schedule(self)
+
+    def stop(self):
+        with _scheduled_cond:
+            if self in _scheduled:
+                _scheduled.remove(self)
+
+    def idle(self):
+        """Checks that the folder is quiet and nothing holds the lock.
+        """
+        return (self._watcher.idle_for() >= self.IDLE_DELAY and
+                not self._lock.busy())
+
+    def run_once(self):
+        """Runs the tasks that are due, while the folder stays idle.
+
+        Returns the names of the tasks that ran.
+        """
+        if not self.idle():
+            return []
+        counts = self._repository.count_objects()
+        tasks = []
+        if (counts.get('count', 0) >= self.loose_threshold or
+                counts.get('packs', 0) >= self.pack_threshold):
+            logging.info("Repository has %d loose objects and %d packs, "
+                         "repacking", counts.get('count', 0),
+                         counts.get('packs', 0))
+            tasks.append(('repack', self._repository.repack))
+            tasks.append(('commit_graph',
+                          self._repository.write_commit_graph))
+        if time.time() - self._last_prune >= self.PRUNE_INTERVAL:
+            tasks.append(('prune', self._prune))
+
+        done = []
+        for name, task in tasks:
+            if not self.idle():
+                logging.info("Folder is busy, postponing maintenance")
+                for postponed, _ in tasks[len(done):]:
+                    MAINTENANCE.inc(folder=self._lock.name, task=postponed,
+                                    result='postponed')
+                break
+            task()
+            MAINTENANCE.inc(folder=self._lock.name, task=name, result='done')
+            done.append(name)
+        return done
+
+    def _prune(self):
+        self._repository.prune(self.PRUNE_EXPIRE)
+        self._last_prune = time.time()
@@ -0,0 +1,372 @@
+"""Instrumentation: counters, histograms and trace spans.
+
+Contains the :data:`~gitobox.metrics.REGISTRY` where the other modules record
+what they do, :class:`~gitobox.metrics.MetricsServer` that exposes it in the
+Prometheus text format, and :func:`~gitobox.metrics.span` which times an
+operation and optionally writes it to a trace file (Chrome's trace event
+format, which chrome://tracing and Perfetto can load).
+"""
+
+from __future__ import unicode_literals
+
+import contextlib
+import json
+import logging
+import os
+from threading import Lock, Thread, current_thread, local
+import time
+
+from gitobox.utils import PY3, iteritems
+
+if PY3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+# Buckets for durations, in seconds
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0,
+                60.0, 300.0)
+
+# Buckets for numbers of files
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+# Buckets for sizes, in bytes
+SIZE_BUCKETS = (1 << 10, 1 << 16, 1 << 20, 16 << 20, 256 << 20, 1 << 30,
+                16 << 30)
+
+
+def _labels_key(labels):
+    return tuple(sorted(iteritems(labels)))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, ('%s' % v).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else '%d' % value
+
+
+class Counter(object):
+    """A value that only goes up, for each set of labels.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_labels_key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(iteritems(self._values))
+        return ['%s%s %s' % (self.name, _format_labels(key),
+                             _format_value(value))
+                for key, value in values]
+
+    def summarize(self):
+        with self._lock:
+            values = sorted(iteritems(self._values))
+        return ['%s%s: %s' % (self.name, _format_labels(key), value)
+                for key, value in values]
+
+
+class _HistogramValues(object):
+    def __init__(self, nb_buckets):
+        self.buckets = [0] * nb_buckets
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+
+class Histogram(object):
+    """Counts observations in buckets, for each set of labels.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets) + (float('inf'),)
+        self._lock = Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = _HistogramValues(
+                    len(self.bounds))
+            for i, bound in enumerate(self.bounds):
+                if value <= bound:
+                    values.buckets[i] += 1
+                    break
+            values.count += 1
+            values.sum += value
+            values.max = max(values.max, value)
+
+    def count(self, **labels):
+        with self._lock:
+            values = self._values.get(_labels_key(labels))
+            return 0 if values is None else values.count
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for key, values in sorted(iteritems(self._values)):
+                cumulative = 0
+                for bound, nb in zip(self.bounds, values.buckets):
+                    cumulative += nb
+                    lines.append('%s_bucket%s %d' % (
+                        self.name,
+                        _format_labels(key, [('le', _format_value(bound))]),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (self.name, _format_labels(key),
+                                              _format_value(values.sum)))
+                lines.append('%s_count%s %d' % (self.name,
+                                                _format_labels(key),
+                                                values.count))
+        return lines
+
+    def summarize(self):
+        lines = []
+        with self._lock:
+            for key, values in sorted(iteritems(self._values)):
+                lines.append('%s%s: count %d, total %g, average %g, max %g' % (
+                    self.name, _format_labels(key), values.count, values.sum,
+                    values.sum / values.count, values.max))
+        return lines
+
+
+class Registry(object):
+    """The set of metrics of the process.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, help, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, *args)
+            elif not isinstance(metric, cls):
+                raise TypeError("Metric %s is a %s" % (name, metric.type))
+            return metric
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def _sorted(self):
+        with self._lock:
+            return [m for _, m in sorted(iteritems(self._metrics))]
+
+    def render(self):
+        """Formats all the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._sorted():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summarize(self):
+        """Formats all the metrics for humans, e.g. for ``--stats``.
+        """
+        lines = []
+        for metric in self._sorted():
+            lines.extend(metric.summarize())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+# Metrics recorded by the other modules
+DEBOUNCE = REGISTRY.histogram(
+    'gitobox_debounce_seconds',
+    "Time from the first change to the directory being considered stable")
+OPERATIONS = REGISTRY.histogram(
+    'gitobox_operation_seconds',
+    "Duration of repository operations (check_in, check_out, ...)")
+GIT_COMMANDS = REGISTRY.histogram(
+    'gitobox_git_command_seconds',
+    "Duration of Git commands, by operation they ran in")
+STAGED_FILES = REGISTRY.histogram(
+    'gitobox_staged_files',
+    "Number of files hashed per staging", COUNT_BUCKETS)
+STAGED_BYTES = REGISTRY.histogram(
+    'gitobox_staged_bytes',
+    "Number of bytes hashed per staging", SIZE_BUCKETS)
+EVENTS = REGISTRY.counter(
+    'gitobox_watcher_events_total',
+    "Changes seen by the watcher")
+LOCK_HELD = REGISTRY.histogram(
+    'gitobox_lock_held_seconds',
+    "How long the folder's lock was held, by holder")
+LOCK_BUSY = REGISTRY.counter(
+    'gitobox_lock_busy_total',
+    "Changes that found the folder's lock held by a push")
+PUSH_WAIT = REGISTRY.histogram(
+    'gitobox_push_wait_seconds',
+    "Time pushes waited in line for the folder's lock")
+PUSHES = REGISTRY.counter(
+    'gitobox_pushes_total',
+    "Pushes received from the hook, by result")
+FILE_COPIES = REGISTRY.counter(
+    'gitobox_file_copies_total',
+    "Files copied, by method (reflink, copy_file_range, sendfile, stream)")
+BLOB_CACHE = REGISTRY.counter(
+    'gitobox_blob_cache_total',
+    "Blobs looked up in the blob cache when checking out, by result")
+MAINTENANCE = REGISTRY.counter(
+    'gitobox_maintenance_total',
+    "Background maintenance tasks, by task and result")
+SPANS = REGISTRY.histogram(
+    'gitobox_span_seconds',
+    "Duration of traced spans")
+
+
+class Tracer(object):
+    """Writes spans to a file in Chrome's trace event format.
+    """
+    def __init__(self, filename):
+        self._fp = open(filename, 'w')
+        self._fp.write('[\n')
+        self._lock = Lock()
+        self._pid = os.getpid()
+        self._threads = set()
+
+    def write(self, name, start, duration, args):
+        thread = current_thread()
+        lines = []
+        if thread.ident not in self._threads:
+            # Metadata event naming the thread
+            lines.append(json.dumps({'name': 'thread_name', 'ph': 'M',
+                                     'pid': self._pid, 'tid': thread.ident,
+                                     'args': {'name': thread.name}}))
+        event = {'name': name, 'ph': 'X', 'pid': self._pid,
+                 'tid': thread.ident,
+                 'ts': int(start * 1000000), 'dur': int(duration * 1000000)}
+        if args:
+            event['args'] = args
+        lines.append(json.dumps(event, default=str))
+        with self._lock:
+            self._threads.add(thread.ident)
+            for line in lines:
+                self._fp.write(line + ',\n')
+            self._fp.flush()
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+_tracer = None
+_spans = local()
+
+
+def enable_tracing(filename):
+    """Starts writing spans to the given file.
+    """
+    global _tracer
+    _tracer = Tracer(filename)
+
+
+def disable_tracing():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def current_span():
+    """Returns the name of the innermost span of this thread, or None.
+    """
+    stack = getattr(_spans, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """Times an operation, recording it in a histogram and the trace file.
+
+    Spans nest per thread; the parent is recorded in the trace.
+    """
+    stack = getattr(_spans, 'stack', None)
+    if stack is None:
+        stack = _spans.stack = []
+    if stack:
+        args['parent'] = stack[-1]
+    stack.append(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        stack.pop()
+        SPANS.observe(duration, span=name)
+        tracer = _tracer
+        if tracer is not None:
+            tracer.write(name, start, duration, args)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request from %s: %s", self.client_address[0],
+                      format % args)
+
+
+class MetricsServer(object):
+    """Serves the metrics over HTTP, in a background thread.
+    """
+    def __init__(self, port, address='127.0.0.1'):
+        self._server = HTTPServer((address, port), _MetricsHandler)
+        self.port = self._server.server_address[1]
+        self._thread = Thread(target=self._server.serve_forever,
+                              name='gitobox-metrics')
+        self._thread.setDaemon(True)
+
+    def start(self):
+        logging.info("Serving metrics on http://%s:%d/metrics",
+                     self._server.server_address[0], self.port)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
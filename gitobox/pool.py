@@ -0,0 +1,109 @@
+"""Bounded pool of worker threads.
+
+Contains :class:`~gitobox.pool.WorkerPool`, used to limit how many
+synchronization operations (check-ins and check-outs) run at the same time
+when a single process serves many folders, and
+:func:`~gitobox.pool.run_parallel` to spread a batch of work over threads.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+from threading import Event, Thread
+
+from gitobox.utils import irange
+
+try:
+    from queue import Empty, Queue
+except ImportError:  # PY2
+    from Queue import Empty, Queue
+
+
+class _Task(object):
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.done = Event()
+        self.result = None
+        self.exception = None
+
+
+class WorkerPool(object):
+    """Runs functions on a fixed number of threads.
+
+    :meth:`run` blocks the calling thread until the function has executed, so
+    callers keep their usual flow (and their locks) while the pool bounds the
+    number of operations executing concurrently.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._queue = Queue()
+        for i in irange(size):
+            thread = Thread(target=self._worker,
+                            name='gitobox-worker-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            try:
+                task.result = task.function(*task.args, **task.kwargs)
+            except Exception as e:
+                logging.debug("Exception in worker thread", exc_info=True)
+                task.exception = e
+            finally:
+                task.done.set()
+
+    def run(self, function, *args, **kwargs):
+        """Runs a function in the pool, waits for it and returns its result.
+
+        Exceptions are raised again in the calling thread.
+        """
+        task = _Task(function, args, kwargs)
+        self._queue.put(task)
+        task.done.wait()
+        if task.exception is not None:
+            raise task.exception
+        return task.result
+
+
+def run_parallel(function, items, jobs):
+    """Calls a function on each item, on up to `jobs` temporary threads.
+
+    Returns the results, in order. The first exception is raised again once
+    all the threads are done.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if jobs <= 1 or len(items) <= 1:
+        for i, item in enumerate(items):
+            results[i] = function(item)
+        return results
+
+    pending = Queue()
+    for i in irange(len(items)):
+        pending.put(i)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                i = pending.get_nowait()
+            except Empty:
+                break
+            try:
+                results[i] = function(items[i])
+            except Exception as e:
+                logging.debug("Exception in worker thread", exc_info=True)
+                errors.append(e)
+
+    threads = [Thread(target=worker) for _ in irange(min(jobs, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
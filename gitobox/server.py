@@ -1,121 +1,280 @@
 """Hook server code.
 
 Contains the :class:`~gitobox.server.Server` class which is used to communicate
-with the Git hook.
+with the Git hooks, and with ``gitobox ctl`` (see :mod:`gitobox.ctl`).
+
+The hooks (``pre-receive`` and ``post-receive``, see ``hooks/receive``) send
+one framed request per push: the length of the payload in decimal and a
+newline, then the payload, which is made of lines::
+
+    gitobox-hook 2
+    <password>
+    <pre-receive or post-receive>
+    <directory of the pushed objects, or empty>
+    <number of refs>
+    <old> <new> <ref>
+    ...
+
+Control requests use the same framing, with this payload::
+
+    gitobox-ctl 1
+    <command>
+    <argument>
+    ...
+
+They are only accepted on the Unix domain sockets, which only the user
+running gitobox can connect to.
+
+The server answers with lines of progress, the last one being ``OK`` or
+``ERROR``.
 """
 
 from __future__ import unicode_literals
 
+import errno
 import logging
+import os
 import select
 import socket
 import sys
-import time
+from threading import BoundedSemaphore, Thread
+
 
-from gitobox.utils import irange, iteritems, itervalues
+PROTOCOL = b'gitobox-hook 2'
+CONTROL_PROTOCOL = b'gitobox-ctl 1'
+CONTROL_COMMANDS = ('sync-now', 'flush', 'pause', 'resume', 'status')
+
+
+def frame(payload):
+    """Frames a request payload, for sending it to the server.
+    """
+    return ('%d\n' % len(payload)).encode('ascii') + payload
+
+
+class HookRequest(object):
+    """A request from a hook: the pushed ref updates.
+
+    `updates` is a list of (old, new, ref) tuples; `objects` is where the
+    pushed objects are while Git holds them in quarantine, or None.
+    """
+    def __init__(self, password, phase, objects, updates):
+        self.password = password
+        self.phase = phase
+        self.objects = objects
+        self.updates = updates
+
+    @classmethod
+    def parse(cls, payload):
+        """Reads a request payload, returns None if it is malformed.
+        """
+        lines = payload.split(b'\n')
+        if len(lines) < 5 or lines[0] != PROTOCOL:
+            return None
+        password, phase, objects, count = lines[1:5]
+        if phase not in (b'pre-receive', b'post-receive'):
+            return None
+        try:
+            count = int(count)
+        except ValueError:
+            return None
+        if len(lines) < 5 + count:
+            return None
+        updates = []
+        for line in lines[5:5 + count]:
+            update = line.split(b' ', 2)
+            if len(update) != 3:
+                return None
+            updates.append(tuple(update))
+        return cls(password, phase.decode('ascii'), objects or None, updates)
+
+
+class ControlRequest(object):
+    """A request from ``gitobox ctl``: a command and its arguments.
+    """
+    def __init__(self, command, args):
+        self.command = command
+        self.args = args
+
+    @classmethod
+    def parse(cls, payload):
+        """Reads a request payload, returns None if it is malformed.
+        """
+        lines = payload.split(b'\n')
+        if len(lines) < 2 or lines[0] != CONTROL_PROTOCOL:
+            return None
+        try:
+            command = lines[1].decode('ascii')
+            args = [arg.decode('utf-8') for arg in lines[2:]]
+        except UnicodeDecodeError:
+            return None
+        return cls(command, args)
+
+
+def parse_request(payload):
+    """Reads a request payload, of either kind; None if it is malformed.
+    """
+    if payload.startswith(CONTROL_PROTOCOL + b'\n'):
+        return ControlRequest.parse(payload)
+    return HookRequest.parse(payload)
 
 
 class Server(object):
-    """A server, that receives a bunch of lines on a TCP socket.
+    """A server, that receives requests from the hooks on a socket.
 
-    Listens on a random TCP port (`port` attribute) and calls back the given
-    function when the specified number of lines have been received.
+    Listens on a TCP port chosen by the system (`port` attribute) and,
+    optionally, on Unix domain sockets (see :meth:`listen_unix`). Each
+    connection is handled on its own thread, which calls back the given
+    function with the :class:`HookRequest` once it has been received; slow
+    operations in the callback don't hold up other clients.
+    :class:`ControlRequest` go to the `control` function instead, if there is
+    one.
 
-    The callback gets passed the data (list of bytes objects), the connection
-    and the address, so more data can be exchanged.
+    The callbacks get passed the request, the connection and the address, so
+    they can stream progress back; for the Unix domain sockets, the address
+    is the path that was given to :meth:`listen_unix`.
     """
     TIMEOUT = 5.0
-    LENGTH = 1024
+    MAX_REQUEST = 1 << 20
+    MAX_CLIENTS = 64
 
-    def __init__(self, client_lines, callback):
+    def __init__(self, callback, control=None):
         self._callback = callback
-        self._client_lines = client_lines
+        self._control = control
+        self._clients = BoundedSemaphore(self.MAX_CLIENTS)
+        self._listeners = []
+        # Unix domain sockets -> their path
+        self._unix_paths = {}
 
-        # Choose a port
-        self._server = None
-        for port in irange(15550, 15580):
-            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            address = ('127.0.0.1', port)
-            try:
-                server.bind(address)
-                server.listen(5)
-            except socket.error:
-                pass
-            else:
-                logging.debug("Server created on %s:%d", *address)
-                self._server = server
-                self.port = port
-                break
-        if self._server is None:
-            logging.critical("Couldn't find a TCP port to listen on")
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server.bind(('127.0.0.1', 0))
+            server.listen(5)
+        except socket.error as e:
+            server.close()
+            logging.critical("Couldn't find a TCP port to listen on: %s", e)
             sys.exit(1)
+        self.port = server.getsockname()[1]
+        logging.debug("Server created on 127.0.0.1:%d", self.port)
+        self._listeners.append(server)
+
+    def listen_unix(self, path):
+        """Also listen on a Unix domain socket.
+
+        The socket is only accessible by the current user. Returns False if it
+        couldn't be created (e.g. unsupported platform, path too long).
+        """
+        if not hasattr(socket, 'AF_UNIX'):
+            return False
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if path.is_link() or path.exists():
+                path.remove()
+            old_umask = os.umask(0o077)
+            try:
+                server.bind(path.path)
+            finally:
+                os.umask(old_umask)
+            server.listen(5)
+        except (socket.error, OSError) as e:
+            logging.warning("Couldn't listen on %s: %s", path, e)
+            server.close()
+            return False
+        logging.debug("Server created on %s", path)
+        self._listeners.append(server)
+        self._unix_paths[server] = path
+        return True
+
+    def close(self):
+        for server in self._listeners:
+            server.close()
+        self._listeners = []
+        for path in self._unix_paths.values():
+            if path.exists():
+                path.remove()
+        self._unix_paths = {}
 
     def run(self):
-        clients = {}
-
-        next_timeout = None
-        now = time.time()
-
-        while True:
-            sockets = [self._server]
-            sockets.extend(clients)
-            timeout = (None if next_timeout is None
-                       else next_timeout - now + 0.2)
-            rlist, _, _ = select.select(sockets, [], [],
-                                        timeout)
-            now = time.time()
-
-            # Timeouts
-            for sock, (data, timeout, addr) in list(iteritems(clients)):
-                if now > timeout:
-                    del clients[sock]
-                    sock.send(b"timed out\nERROR\n")
-                    sock.close()
-                    logging.debug("Connection from %s timed out",
+        try:
+            while True:
+                try:
+                    rlist, _, _ = select.select(self._listeners, [], [])
+                except (select.error, OSError) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for server in rlist:
+                    conn, addr = server.accept()
+                    local = server in self._unix_paths
+                    if local:
+                        addr = self._unix_paths[server]
+                    logging.debug("Connection from %s", addr)
+                    self._clients.acquire()
+                    thread = Thread(target=self._handle,
+                                    args=(conn, addr, local))
+                    thread.setDaemon(True)
+                    thread.start()
+        finally:
+            self.close()
+
+    def _handle(self, conn, addr, local):
+        try:
+            conn.settimeout(self.TIMEOUT)
+            try:
+                payload = self._read_frame(conn)
+            except socket.timeout:
+                logging.debug("Connection from %s timed out", addr)
+                conn.sendall(b"timed out\nERROR\n")
+                return
+            request = None if payload is None else parse_request(payload)
+            if request is None:
+                logging.debug("Got invalid request on hook server from %s",
+                              addr)
+                conn.sendall(b"invalid request\nERROR\n")
+                return
+            callback = self._callback
+            if isinstance(request, ControlRequest):
+                if not local or self._control is None:
+                    logging.debug("Refused control request from %s", addr)
+                    conn.sendall(b"control commands are only accepted on "
+                                 b"the Unix socket\nERROR\n")
+                    return
+                callback = self._control
+            # The callback can take as long as it needs
+            conn.settimeout(None)
+            try:
+                callback(request, conn, addr)
+            except Exception:
+                logging.exception("Error handling connection from %s",
                                   addr)
-                    next_timeout = -1
+                conn.sendall(b"internal server error\nERROR\n")
+        except socket.error as e:
+            logging.debug("Connection from %s failed: %s", addr, e)
+        finally:
+            conn.close()
+            self._clients.release()
 
-            for sock in rlist:
-                if sock == self._server:
-                    conn, addr = self._server.accept()
-                    logging.debug("Connection from %s", addr)
-                    timeout = now + self.TIMEOUT
-                    clients[conn] = [b''], timeout, addr
-                    if next_timeout is None:
-                        next_timeout = timeout
-                    else:
-                        next_timeout = min(next_timeout, timeout)
-                else:
-                    data, timeout, addr = clients[conn]
-                    res = conn.recv(self.LENGTH - len(data[-1]))
-                    done = not res
-                    if res:
-                        end = res.find(b'\n')
-                        while end != -1:
-                            data[-1] += res[:end]
-                            if len(data) == self._client_lines:
-                                done = True
-                                break
-                            data.append(b'')
-                            res = res[end+1:]
-                            end = res.find(b'\n')
-                        else:
-                            data[-1] += res
-                    if done or len(data[-1]) >= self.LENGTH:
-                        del clients[conn]
-                        try:
-                            if len(data) == self._client_lines:
-                                self._callback(data, conn, addr)
-                        except Exception:
-                            conn.send(b"internal server error\nERROR\n")
-                            raise
-                        finally:
-                            conn.close()
-                        next_timeout = -1
-
-            if next_timeout == -1:
-                if clients:
-                    next_timeout = min(t
-                                       for _, t, _ in itervalues(clients))
-                else:
-                    next_timeout = None
+    def _read_frame(self, conn):
+        """Reads a request: its length on a line, then the payload.
+
+        Returns None if the length is invalid or the client hung up.
+        """
+        header = b''
+        while not header.endswith(b'\n'):
+            res = conn.recv(1)
+            if not res or len(header) > 10:
+                return None
+            header += res
+        try:
+            length = int(header)
+        except ValueError:
+            return None
+        if not 0 <= length <= self.MAX_REQUEST:
+            return None
+        payload = []
+        while length > 0:
+            res = conn.recv(min(length, 65536))
+            if not res:
+                return None
+            payload.append(res)
+            length -= len(res)
+        return b''.join(payload)
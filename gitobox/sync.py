@@ -4,43 +4,164 @@
 from __future__ import unicode_literals
 
 import logging
-from threading import Semaphore, Thread
+from threading import Lock, Timer
+import time
 
 from gitobox.git import GitRepository
-from gitobox.server import Server
+from gitobox.ignore import DEFAULT_IGNORE
+from gitobox.locking import SyncLock
+from gitobox.maintenance import Maintenance
+from gitobox.metrics import PUSHES
+from gitobox.server import CONTROL_COMMANDS, Server
 from gitobox.utils import unicode_, make_unique_bytestring
-from gitobox.watch import DirectoryWatcher
+from gitobox.watch import DirectoryWatcher, PollingWatcher
 
 
 class Synchronizer(object):
     """Main application logic: synchronizes folder with a Git repository.
+
+    By default, a Synchronizer has its own watchdog observer and hook server.
+    When many folders are served from one process, these can be shared instead
+    (see :class:`~gitobox.daemon.Daemon`); a `pool` can also be given to bound
+    the number of check-ins and check-outs running concurrently.
     """
-    def __init__(self, folder, repository, branchname, timeout):
-        # The global lock for synchronization operations
-        self._lock = Semaphore(1)
+    PUSH_MESSAGE_INTERVAL = 2.0
+
+    # Number of conflicting paths listed in the hook's output
+    MAX_CONFLICTS_LISTED = 20
+
+    # How long the lock is kept for a push between its pre-receive and
+    # post-receive hooks
+    PUSH_COMPLETE_TIMEOUT = 30.0
+
+    NULL_ID = b'0' * 40
+
+    def __init__(self, folder, repository, branchname, timeout, cache=None,
+                 observer=None, server=None, pool=None,
+                 push_deadline=30.0, max_queued_pushes=16,
+                 max_delay=None, backoff=0.0, ignore=(), poll=None,
+                 poll_budget=0.1, split_commits=False, lfs_threshold=None,
+                 maintenance_interval=300.0, blob_cache=None,
+                 catch_up_gap=None):
+        folder = folder.absolute()
+
+        # What to do with the stat cache on startup: None, 'verify' or
+        # 'rebuild'
+        self._cache_action = cache
+
+        # The global lock for synchronization operations; pushes wait in line
+        # for it, for at most push_deadline seconds (should be shorter than
+        # any timeout the Git client has)
+        self._lock = SyncLock(max_queued_pushes, name=str(folder))
+        self.push_deadline = push_deadline
+        # Push accepted by pre-receive, holding the lock until post-receive
+        self._pending_lock = Lock()
+        self._pending = None
+        self._pending_events = None
+        self._pending_timer = None
+        # Paused from ``gitobox ctl``: the lock is held until resumed
+        self._paused = False
+        self._pause_lock = Lock()
+        # The next full scan is the one from start(), see catch_up_gap
+        self._catching_up = False
+
+        self._pool = pool
 
-        # Watches the directory for file changes
-        self._watcher = DirectoryWatcher(folder,
-                                         self._directory_changed,
-                                         self._lock,
-                                         timeout)
+        # Files that are never committed
+        ignore = DEFAULT_IGNORE + list(ignore)
+
+        # Watches the directory for file changes, either through filesystem
+        # events or by scanning it every `poll` seconds
+        if poll:
+            self._watcher = PollingWatcher(folder,
+                                           self._directory_changed,
+                                           self._lock,
+                                           timeout,
+                                           interval=poll,
+                                           budget=poll_budget,
+                                           max_delay=max_delay,
+                                           backoff=backoff,
+                                           ignore=ignore)
+        else:
+            self._watcher = DirectoryWatcher(folder,
+                                             self._directory_changed,
+                                             self._lock,
+                                             timeout,
+                                             observer=observer,
+                                             max_delay=max_delay,
+                                             backoff=backoff,
+                                             ignore=ignore)
 
         # Make up a random password
         self.password = make_unique_bytestring()
 
         # Listens for connections from the Git hook
-        self._hook_server = Server(2, self._hook_triggered)
+        if server is None:
+            self._hook_server = Server(self.hook_triggered,
+                                       self.control_requested)
+        else:
+            self._hook_server = server
+
+        # Hooks connect through a Unix socket in the Git directory if possible;
+        # ``gitobox ctl`` only can
+        socket_path = repository.absolute() / 'gitobox.sock'
+        if not self._hook_server.listen_unix(socket_path):
+            logging.warning("No control socket, 'gitobox ctl' won't work")
+            socket_path = None
+        self.socket_path = socket_path
 
         # Sets up the directory (installs the hook)
         self._repository = GitRepository(repository, folder, branchname,
                                          self.password,
-                                         self._hook_server.port)
+                                         self._hook_server.port,
+                                         socket_path,
+                                         ignore=ignore,
+                                         split_commits=split_commits,
+                                         lfs_threshold=lfs_threshold,
+                                         blob_cache=blob_cache,
+                                         catch_up_gap=catch_up_gap)
 
-    def run(self):
-        watcher_thread = Thread(target=self._watcher.run)
-        watcher_thread.setDaemon(True)
+        # Packs the repository in the background, when the folder is idle
+        if maintenance_interval:
+            self._maintenance = Maintenance(self._repository, self._lock,
+                                            self._watcher,
+                                            maintenance_interval)
+        else:
+            self._maintenance = None
+
+    def _execute(self, function, *args):
+        """Runs a repository operation, in the worker pool if there is one.
+        """
+        if self._pool is None:
+            return function(*args)
+        else:
+            return self._pool.run(function, *args)
+
+    def start(self):
+        """Starts watching the folder, and schedules the initial check-in.
+
+        A check-out that was interrupted is finished first, so that the
+        half-written folder doesn't get committed, and so is a push that
+        didn't get checked out.
+        """
+        self._execute(self._repository.resume_check_out)
+        try:
+            self._execute(self._repository.check_out_unapplied)
+        except Exception:
+            # It will be tried again before the initial check-in
+            logging.exception("Couldn't check out the branch")
+        if self._cache_action == 'verify':
+            self._execute(self._repository.verify_cache)
+        elif self._cache_action == 'rebuild':
+            self._repository.rebuild_cache()
+        self._catching_up = True
         self._watcher.assume_all_changed()
-        watcher_thread.start()
+        self._watcher.run()
+        if self._maintenance is not None:
+            self._maintenance.start()
+
+    def run(self):
+        self.start()
 
         try:
             self._hook_server.run()
@@ -50,54 +171,320 @@ class Synchronizer(object):
             logging.critical("Exiting after unhandled exception!")
             raise
 
-    def _directory_changed(self, paths=None):
+    def _directory_changed(self, changes=None, moves=()):
         # We got called back though the ResettableTimer, so the lock is held
-        if paths is None:
+        if changes is None:
             logging.warning("Assuming all paths changed")
+            # Only the first scan replays what happened while we weren't
+            # running; later ones (e.g. after a push) are just re-checks
+            self._execute(self._repository.check_in, None, None, None,
+                          self._catching_up)
+            self._catching_up = False
         else:
             logging.warning("Paths changed: %s",
-                            " ".join(unicode_(p) for p in paths))
-        self._repository.check_in(paths)
+                            " ".join(unicode_(p) for p in changes))
+            self._execute(self._repository.check_in, list(changes), changes,
+                          moves)
+
+    def _wait_for_lock(self, conn):
+        """Waits in line for the lock, telling the client while it's held.
 
-    def _hook_triggered(self, data, conn, addr):
-        passwd, ref = data
-        if passwd != self.password:
+        Returns False if it couldn't be acquired before the push deadline.
+        """
+        def progress(position, queued):
+            conn.sendall(("waiting for directory to settle (%d queued)\n" %
+                          queued).encode('ascii'))
+
+        start = time.time()
+        acquired = self._lock.wait_acquire(self.push_deadline, progress,
+                                           self.PUSH_MESSAGE_INTERVAL)
+        stats = self._lock.stats()
+        logging.info("Push %s lock after %.1fs (%d waits, average %.1fs, "
+                     "max %.1fs, %d timed out, %d rejected)",
+                     "got" if acquired else "didn't get",
+                     time.time() - start, stats['waits'],
+                     stats['total_wait'] / max(stats['waits'], 1),
+                     stats['max_wait'], stats['timeouts'], stats['rejected'])
+        return acquired
+
+    def hook_triggered(self, request, conn, addr):
+        """Handles a request from the hooks, for a push.
+
+        In ``pre-receive``, the push is checked as a whole: if it updates the
+        branch, it waits in line for the lock, and is rejected if the branch
+        moved since the push started (the folder got committed while it
+        waited). The lock is then kept until Git has updated the branch and
+        the ``post-receive`` request comes in, which checks out the new commit.
+        Nothing gets written to the folder for a push Git ends up rejecting.
+        """
+        if request.password != self.password:
             logging.debug("Got invalid message on hook server from %s",
                           addr)
-            conn.send(b"hook auth failed\nERROR\n")
+            conn.sendall(b"hook auth failed\nERROR\n")
+            PUSHES.inc(folder=self._lock.name, result='auth_failed')
+            return
+        branch = ('refs/heads/%s' % self._repository.branch).encode('utf-8')
+        updates = [u for u in request.updates if u[2] == branch]
+        if not updates:
+            conn.sendall(b"OK\n")
             return
-        logging.info("Hook triggered from %s", addr, )
-        if not self._lock.acquire(blocking=False):
-            logging.info("Lock is held, failing...")
-            conn.send(b"update is in progress, try again later\nERROR\n")
+        old, new, _ = updates[-1]
+        logging.info("Hook %s triggered from %s", request.phase, addr)
+        if request.phase == 'pre-receive':
+            self._pre_receive(old, new, request.objects, conn)
         else:
-            try:
-                conn.send(b"updating directory to " + ref[:7] + b"...\n")
-                self._repository.check_out(ref)
-                conn.send(b"synced directory updated!\n")
-                logging.info("Directory updated to %s",
-                             ref.decode('ascii')[:7])
-            finally:
-                self._lock.release()
+            self._post_receive(new, conn)
 
-            if self._repository.has_changes(ref):
-                # The lock has been released, changes now happening in DropBox
-                # will start DirectoryWatcher's timer as usual.
-                # However, while we were copying files from Git into the
-                # directory, it might have been changed (i.e. DropBox might
-                # have conflicted). In this case, a new commit will happen in a
-                # few seconds
-                logging.info("Conflict detected during directory update")
+    def _pre_receive(self, old, new, objects, conn):
+        if self._paused:
+            conn.sendall(b"synchronization is paused, try again later\n"
+                         b"ERROR\n")
+            PUSHES.inc(folder=self._lock.name, result='rejected')
+            return
+        if new == self.NULL_ID:
+            conn.sendall(("you can't delete branch '%s'\nERROR\n" %
+                          self._repository.branch).encode('utf-8'))
+            PUSHES.inc(folder=self._lock.name, result='rejected')
+            return
+        if self._repository.object_type(new, objects) != b'commit':
+            conn.sendall(b"can only push commits to the synced branch\n"
+                         b"ERROR\n")
+            PUSHES.inc(folder=self._lock.name, result='rejected')
+            return
+        if not self._wait_for_lock(conn):
+            logging.info("Lock is still held, failing...")
+            conn.sendall(b"directory didn't settle in time or too many "
+                         b"pushes are queued, try again later\nERROR\n")
+            PUSHES.inc(folder=self._lock.name, result='rejected')
+            return
+        # Changes seen from now on, to tell them apart from ours
+        events = self._watcher.start_recording()
+        # The lock might have been handed over with changes waiting, e.g.
+        # recorded during a check-in; they go in before the push
+        try:
+            self._watcher.commit_pending()
+        except Exception:
+            self._watcher.stop_recording(events)
+            self._lock.release()
+            raise
+        tip = self._repository.branch_tip() or self.NULL_ID
+        if tip != old:
+            self._watcher.stop_recording(events)
+            self._lock.release()
+            self._watcher.resume()
+            logging.info("Branch moved to %s while push waited, rejecting",
+                         tip.decode('ascii')[:7])
+            conn.sendall(b"the directory changed while your push was "
+                         b"waiting, fetch and push again\nERROR\n")
+            PUSHES.inc(folder=self._lock.name, result='outdated')
+            return
+        # Keeps the lock until Git has updated the branch
+        with self._pending_lock:
+            self._pending = new
+            self._pending_events = events
+            self._pending_timer = Timer(self.PUSH_COMPLETE_TIMEOUT,
+                                        self._push_expired, [new])
+            self._pending_timer.setDaemon(True)
+            self._pending_timer.start()
+        conn.sendall(b"OK\n")
+
+    def _take_pending(self, new):
+        """Takes over the lock held for a push, if it's still held for it.
+
+        Returns the set recording changes since pre-receive, or None.
+        """
+        with self._pending_lock:
+            if self._pending != new:
+                return None
+            events = self._pending_events
+            self._pending = self._pending_events = None
+            self._pending_timer.cancel()
+            self._pending_timer = None
+            return events
+
+    def _push_expired(self, new):
+        events = self._take_pending(new)
+        if events is not None:
+            logging.warning("Push of %s didn't complete, unlocking",
+                            new.decode('ascii')[:7])
+            self._watcher.stop_recording(events)
+            self._lock.release()
+            self._watcher.resume()
+            if self._repository.branch_tip() == new:
+                # Git did update the branch, the check-in will check it out
+                self._watcher.assume_all_changed()
+
+    def _post_receive(self, new, conn):
+        events = self._take_pending(new)
+        if events is None:
+            # Took too long, the lock had to be given up
+            if not self._wait_for_lock(conn):
+                # The next check-in checks it out first
                 self._watcher.assume_all_changed()
-                # Tell the pusher about it, so he can fetch
-                conn.send(b"WARNING: DROPBOX CONFLICT\n"
-                          b"the directory was updated while changes were "
-                          b"being written from Git to the directory; "
-                          b"leave DropBox time to sync then fetch again\n")
+                conn.sendall(b"directory didn't settle in time, it will be "
+                             b"updated later\nERROR\n")
+                PUSHES.inc(folder=self._lock.name, result='rejected')
+                return
+            if self._repository.branch_tip() != new:
+                self._lock.release()
+                self._watcher.resume()
+                conn.sendall(b"branch moved again, not updating the "
+                             b"directory\nERROR\n")
+                PUSHES.inc(folder=self._lock.name, result='outdated')
+                return
+            events = self._watcher.start_recording()
+
+        # Changes that couldn't be committed before the push; if the check-out
+        # overwrites them, they are conflicts
+        waiting = self._watcher.pending_paths()
+        try:
+            conn.sendall(b"updating directory to " + new[:7] + b"...\n")
+            manifest = self._execute(self._repository.check_out, new)
+            conn.sendall(b"synced directory updated!\n")
+            logging.info("Directory updated to %s",
+                         new.decode('ascii')[:7])
+        finally:
+            self._watcher.stop_recording(events)
+            self._lock.release()
+            self._watcher.resume()
+
+        conflicts = manifest.conflicts(self._repository.workdir, events,
+                                       waiting)
+        if conflicts:
+            # The lock has been released, changes now happening in DropBox
+            # will start the watcher's timer as usual.
+            # However, while we were copying files from Git into the
+            # directory, it might have been changed (i.e. DropBox might
+            # have conflicted). In this case, a new commit will happen in a
+            # few seconds
+            logging.info("Conflict detected during directory update: %d "
+                         "paths", len(conflicts))
+            self._watcher.assume_all_changed()
+            # Tell the pusher about it, so he can fetch
+            conn.sendall(b"WARNING: DROPBOX CONFLICT\n"
+                         b"these files were changed while changes were "
+                         b"being written from Git to the directory:\n")
+            for path in conflicts[:self.MAX_CONFLICTS_LISTED]:
+                conn.sendall(b"  " + path.replace(b"\n", b"\\n") + b"\n")
+            if len(conflicts) > self.MAX_CONFLICTS_LISTED:
+                conn.sendall(("  ... and %d more\n" % (
+                    len(conflicts) - self.MAX_CONFLICTS_LISTED))
+                    .encode('ascii'))
+            conn.sendall(b"leave DropBox time to sync then fetch again\n")
 
-            conn.send(b"OK\n")
+        PUSHES.inc(folder=self._lock.name,
+                   result='conflict' if conflicts else 'ok')
+        conn.sendall(b"OK\n")
+
+    def control_requested(self, request, conn, addr):
+        """Handles a command from ``gitobox ctl``.
+        """
+        if request.command not in CONTROL_COMMANDS:
+            conn.sendall(("unknown command %r\nERROR\n" %
+                          request.command).encode('utf-8'))
+            return
+        logging.info("Got control command %s", request.command)
+        handler = getattr(self, '_ctl_' + request.command.replace('-', '_'))
+        if handler(request.args, conn):
+            conn.sendall(b"OK\n")
+        else:
+            conn.sendall(b"ERROR\n")
+
+    def _ctl_sync_now(self, args, conn):
+        if self._paused:
+            conn.sendall(b"synchronization is paused, resume it first\n")
+            return False
+        pending = self._watcher.pending()
+        if not pending:
+            conn.sendall(b"nothing to commit\n")
+        elif self._watcher.sync_now():
+            conn.sendall(("committing %d changes\n" % pending)
+                         .encode('ascii'))
+        else:
+            conn.sendall(b"a push is updating the directory, changes will "
+                         b"be committed after it\n")
+        return True
+
+    def _ctl_flush(self, args, conn):
+        if self._paused:
+            conn.sendall(b"synchronization is paused, resume it first\n")
+            return False
+        try:
+            timeout = float(args[0]) if args and args[0] else None
+        except ValueError:
+            conn.sendall(b"invalid timeout\n")
+            return False
+
+        def progress(pending):
+            conn.sendall(("waiting for changes to be committed (%d more "
+                          "recorded)\n" % pending).encode('ascii'))
+
+        if self._watcher.flush(timeout, progress, self.PUSH_MESSAGE_INTERVAL):
+            conn.sendall(b"changes committed\n")
+            return True
+        conn.sendall(b"changes still not committed, giving up\n")
+        return False
+
+    def _ctl_pause(self, args, conn):
+        """Takes the lock and keeps it: changes are recorded, not committed.
+        """
+        def progress(position, queued):
+            conn.sendall(b"waiting for the current check-in or push\n")
+
+        with self._pause_lock:
+            if self._paused:
+                conn.sendall(b"already paused\n")
+                return True
+            if not self._lock.wait_acquire(self.push_deadline, progress,
+                                           self.PUSH_MESSAGE_INTERVAL,
+                                           holder='pause'):
+                conn.sendall(b"directory didn't settle in time, try again "
+                             b"later\n")
+                return False
+            self._paused = True
+        logging.warning("Synchronization paused")
+        conn.sendall(b"paused, changes will be committed on resume\n")
+        return True
+
+    def _ctl_resume(self, args, conn):
+        with self._pause_lock:
+            if not self._paused:
+                conn.sendall(b"not paused\n")
+                return True
+            self._paused = False
+            self._lock.release()
+        logging.warning("Synchronization resumed")
+        self._watcher.resume()
+        conn.sendall(("resumed, %d changes to commit\n" %
+                      self._watcher.pending()).encode('ascii'))
+        return True
+
+    def _ctl_status(self, args, conn):
+        pending, settling, syncing = self._watcher.status()
+        lock = self._lock.stats()
+        tip = self._repository.branch_tip()
+        if self._paused:
+            state = "paused for %.0fs" % lock['held_for']
+        elif syncing:
+            state = "committing"
+        elif lock['holder'] == 'push':
+            state = "updating from a push"
+        elif settling is not None:
+            state = "waiting for changes to settle (%.1fs)" % settling
+        else:
+            state = "idle"
+        lines = ["folder: %s" % self._repository.workdir,
+                 "repository: %s" % self._repository.repo,
+                 "branch: %s at %s" % (self._repository.branch,
+                                       tip.decode('ascii')[:7] if tip
+                                       else "(no commit)"),
+                 "state: %s" % state,
+                 "changes waiting: %d" % pending,
+                 "pushes queued: %d" % lock['queued']]
+        conn.sendall(''.join(l + '\n' for l in lines).encode('utf-8'))
+        return True
 
 
-def synchronize(folder, repository, branchname, timeout):
-    sync = Synchronizer(folder, repository, branchname, timeout)
+def synchronize(folder, repository, branchname, timeout, **kwargs):
+    sync = Synchronizer(folder, repository, branchname, timeout, **kwargs)
     sync.run()
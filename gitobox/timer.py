@@ -3,7 +3,8 @@
 Contains :class:`~gitobox.timer.ResettableTimer`, a timer that waits a given
 amount of time after the *last* call to
 :meth:`~gitobox.timer.ResettableTimer.start()`. This means that every call to
-`start()` makes the timer restart.
+`start()` makes the timer restart; a maximum delay can be set after which it
+triggers anyway.
 
 Also acquires a lock while ticking, allowing Gitobox to not accept hooks while
 waiting for the tree to be stable.
@@ -11,7 +12,9 @@ waiting for the tree to be stable.
 
 from __future__ import unicode_literals
 
+import logging
 from threading import Condition, Thread
+import time
 import traceback
 
 from gitobox.utils import irange
@@ -22,14 +25,36 @@ class ResettableTimer(object):
 
     If a lock is passed to the constructor, it will be acquired when calling
     start(), returning False immediately if that's impossible. It will be
-    released when the timer triggers or is canceled.
+    released when the function returns or the timer is canceled. start() never
+    waits for the function: called while it runs, it starts the next
+    countdown, and the lock is kept until that one triggers as well.
+
+    The quiet period is `timeout` seconds, plus `backoff` seconds for each
+    start() per second received since the timer was primed; when things keep
+    happening fast, we wait a bit longer for them to stop. However, if
+    `max_delay` is set, the function is called at most that many seconds after
+    the timer got primed, even if start() keeps being called.
+
+    ``start(immediate=True)`` skips the quiet period: the function gets called
+    as soon as the lock allows it.
     """
     IDLE, RESET, PRIMED = irange(3)
 
-    def __init__(self, timeout, function, args=[], kwargs={}, lock=None):
+    def __init__(self, timeout, function, args=[], kwargs={}, lock=None,
+                 max_delay=None, backoff=0.0):
         self.thread = Thread(target=self._run)
         self.thread.setDaemon(True)
         self.timeout = timeout
+        self.max_delay = max_delay
+        self.backoff = backoff
+
+        # When the timer got primed, when start() was last called, and how
+        # many times it was called since being primed
+        self.primed_at = None
+        self.last_start = None
+        self.starts = 0
+        # Whether the next call shouldn't wait for the quiet period
+        self.immediate = False
 
         self.function = function
         self.args = args
@@ -43,9 +68,11 @@ class ResettableTimer(object):
         # This protects self.status and is used to wake up self._run()
         self.cond = Condition()
         self.status = ResettableTimer.IDLE
-        # The lock is held if and only if status != IDLE
+        # The lock is held if and only if status != IDLE or executing; it is
+        # kept from one call of the function to the next if start() is called
+        # while it executes
 
-    def start(self):
+    def start(self, immediate=False):
         """Starts or restarts the countdown.
 
         If the Timer has an associated lock, this method returns False if it
@@ -57,6 +84,14 @@ class ResettableTimer(object):
                     self.lock is not None and
                     not self.lock.acquire(blocking=False)):
                 return False
+            now = time.time()
+            if self.status == ResettableTimer.IDLE:
+                self.primed_at = now
+                self.starts = 0
+            self.last_start = now
+            self.starts += 1
+            if immediate:
+                self.immediate = True
             if self.started:
                 self.status = ResettableTimer.RESET
                 self.cond.notifyAll()
@@ -67,12 +102,35 @@ class ResettableTimer(object):
                 self.thread.start()
             return True
 
+    def primed_for(self):
+        """Returns how long the timer has been primed, or None if it's idle.
+        """
+        with self.cond:
+            if self.status == ResettableTimer.IDLE:
+                return None
+            return time.time() - self.primed_at
+
+    def _deadline(self):
+        """Computes when the function should be called; call with cond held.
+        """
+        if self.immediate:
+            return self.primed_at
+        quiet = self.timeout
+        if self.backoff:
+            elapsed = max(self.last_start - self.primed_at, 1.0)
+            quiet += self.backoff * (self.starts / elapsed)
+        deadline = self.last_start + quiet
+        if self.max_delay is not None:
+            deadline = min(deadline, self.primed_at + self.max_delay)
+        return deadline
+
     def cancel(self):
         """Cancels the countdown without calling back.
         """
         with self.cond:
             if self.status != ResettableTimer.IDLE:
                 self.status = ResettableTimer.IDLE
+                self.immediate = False
                 if not self.executing:
                     self.cond.notifyAll()
                     if self.lock is not None:
@@ -81,22 +139,46 @@ class ResettableTimer(object):
     def _run(self):
         with self.cond:
             while True:
-                if self.status == ResettableTimer.PRIMED:
-                    self.cond.wait(self.timeout)
-                else:
+                if self.status == ResettableTimer.IDLE:
                     self.cond.wait()
+                    continue
 
-                # RESET: go to prime and start counting again
-                if self.status == ResettableTimer.RESET:
-                    self.status = ResettableTimer.PRIMED
-                # Still PRIMED: we timed out without interruption, call back
-                elif self.status == ResettableTimer.PRIMED:
+                # RESET: go to prime and compute the deadline again
+                self.status = ResettableTimer.PRIMED
+                now = time.time()
+                deadline = self._deadline()
+                if now < deadline:
+                    self.cond.wait(deadline - now)
+                    continue
+
+                # Still PRIMED: deadline passed without interruption, call back
+                if self.immediate:
+                    logging.info("Syncing now, as requested")
+                elif now - self.last_start < self.timeout:
+                    logging.info("Still changing after %.1fs, not waiting "
+                                 "any longer", now - self.primed_at)
+                self.status = ResettableTimer.IDLE
+                self.immediate = False
+                self.executing = True
+                # The function runs without the condition, so start() never
+                # waits for it; if it gets called meanwhile, the next
+                # countdown is already going when the function returns
+                self.cond.release()
+                try:
+                    self.function(*self.args, **self.kwargs)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    self.cond.acquire()
+                self.executing = False
+                if (self.status != ResettableTimer.IDLE and
+                        getattr(self.lock, 'queued', 0)):
+                    # Others are waiting in line for the lock, don't keep it;
+                    # they have to start() again once done with it. What was
+                    # recorded meanwhile is still waiting (for a push, see
+                    # BaseWatcher.commit_pending())
                     self.status = ResettableTimer.IDLE
-                    self.executing = True
-                    try:
-                        self.function(*self.args, **self.kwargs)
-                    except Exception:
-                        traceback.print_exc()
-                    self.executing = False
-                    if self.lock is not None:
-                        self.lock.release()
+                    self.immediate = False
+                if (self.status == ResettableTimer.IDLE and
+                        self.lock is not None):
+                    self.lock.release()
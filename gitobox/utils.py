@@ -44,3 +44,13 @@ def make_unique_bytestring():
     """Makes a unique (random) bytestring.
     """
     return next(unique_bytestring_gen)
+
+
+def parse_size(s):
+    """Parses a size in bytes, with an optional K, M or G suffix.
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    s = s.strip()
+    if s and s[-1].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
@@ -1,71 +1,509 @@
 """Directory-watching logic.
 
 Contains :class:`~gitobox.watch.DirectoryWatcher`, the class that monitors the
-directory for changes. Uses `pyinotify`, so it's only available on Linux.
+directory for changes using `watchdog` (inotify on Linux), and
+:class:`~gitobox.watch.PollingWatcher`, which scans the directory
+periodically for filesystems where events are missing or unreliable (network
+and FUSE mounts) or trees too large for inotify.
 """
 
 from __future__ import unicode_literals
 
 import logging
+import os
+import stat
+from threading import Condition, Lock, Thread
+import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from gitobox.ignore import DEFAULT_IGNORE, IgnoreFilter
+from gitobox.metrics import DEBOUNCE, EVENTS
 from gitobox.timer import ResettableTimer
+from gitobox.utils import iteritems
 
+try:
+    from os import scandir
+except ImportError:  # PY2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-class DirectoryWatcher(FileSystemEventHandler):
+
+class BaseWatcher(object):
+    """Records changes to a folder, and calls back once it is stable.
+
+    Events are coalesced: a path is only recorded once, and when a whole
+    directory is created, moved or deleted, it is recorded instead of the
+    paths under it. Paths matching the `ignore` patterns are dropped before
+    they get recorded or restart the timer.
+
+    The callback gets a dict mapping the changed paths to the time of their
+    last change and the list of (source, destination) moves seen, or no
+    argument if everything should be considered changed.
+
+    Subclasses feed changes to :meth:`_record` and start the timer.
+    """
     ALL_CHANGED = None
 
-    def __init__(self, folder, callback, lock, timeout):
-        self._callback = callback
+    # Interval between summaries of the events received
+    LOG_INTERVAL = 10.0
 
-        self.observer = Observer()
+    def __init__(self, folder, callback, lock, timeout,
+                 max_delay=None, backoff=0.0, ignore=None):
+        self._callback = callback
 
         self._folder = folder
-        self._changes = set()
-        self.observer.schedule(self, str(folder), recursive=True)
+        self._folder_label = str(folder)
+        self._prefix = os.path.join(str(folder), '')
+        self._ignore = IgnoreFilter(DEFAULT_IGNORE if ignore is None
+                                    else ignore)
+        # Changed paths, with the time of their last change
+        self._changes = {}
+        # Directories recorded as a whole
+        self._subtrees = set()
+        # Files and directories moved, as (source, destination), and the same
+        # as a set, including moves implied by a parent's
+        self._moves = []
+        self._moved = set()
+        # Protects the three above; the timer swaps them for empty ones before
+        # calling back, so events are never held up by a check-in
+        self._changes_lock = Lock()
+        # How many times the timer took the changes, and how many of these
+        # callbacks returned; notified when a callback returns
+        self._taken = 0
+        self._done = 0
+        self._done_cond = Condition(self._changes_lock)
+        # Sets also receiving the paths, see start_recording()
+        self._recorders = []
+        # When the last change was recorded
+        self._last_change = time.time()
 
         self._timer = ResettableTimer(timeout, self._timer_expired,
-                                      lock=lock)
+                                      lock=lock, max_delay=max_delay,
+                                      backoff=backoff)
+
+        self._events = 0
+        self._ignored = 0
+        self._last_summary = time.time()
 
     def assume_all_changed(self):
-        self._changes.add(DirectoryWatcher.ALL_CHANGED)
+        with self._changes_lock:
+            self._changes[BaseWatcher.ALL_CHANGED] = time.time()
         self._timer.start()
 
-    def run(self):
-        self.observer.start()
+    def resume(self):
+        """Starts the timer if changes are waiting, e.g. after a push.
+
+        Changes recorded while the lock was held by someone else couldn't
+        start the timer.
+        """
+        with self._changes_lock:
+            pending = bool(self._changes)
+        if pending:
+            self._timer.start()
+
+    def pending(self):
+        """Returns the number of changes waiting to be committed.
+        """
+        with self._changes_lock:
+            return len(self._changes)
+
+    def pending_paths(self):
+        """Returns the relative paths of the changes waiting to be committed.
+        """
+        with self._changes_lock:
+            paths = list(self._changes)
+        return set(path[len(self._prefix):] for path in paths
+                   if path is not None and path.startswith(self._prefix))
+
+    def status(self):
+        """Returns the number of changes waiting, how long the timer has been
+        running (None if it isn't), and whether a callback is running.
+        """
+        return self.pending(), self._timer.primed_for(), self._timer.executing
+
+    def sync_now(self):
+        """Calls back right away if changes are waiting, skipping the timeout.
+
+        Returns False if there is nothing to commit or the lock is held by
+        someone else.
+        """
+        with self._changes_lock:
+            pending = bool(self._changes)
+        return pending and self._timer.start(immediate=True)
+
+    def flush(self, timeout=None, progress=None, interval=2.0):
+        """Waits until the changes recorded so far have been called back.
+
+        Changes still waiting are called back right away (retried while the
+        lock is held by someone else). `progress(pending)` is called every
+        `interval` seconds, outside of any lock.
+
+        Returns False if that didn't happen within `timeout` seconds.
+        """
+        start = time.time()
+        with self._changes_lock:
+            # The callback running now might have taken them already
+            target = self._taken + (1 if self._changes else 0)
+        next_progress = start + interval
+        while True:
+            self.sync_now()
+            with self._done_cond:
+                if self._done >= target:
+                    return True
+                self._done_cond.wait(0.5)
+                if self._done >= target:
+                    return True
+                pending = len(self._changes)
+            now = time.time()
+            if timeout is not None and now >= start + timeout:
+                return False
+            if progress is not None and now >= next_progress:
+                progress(pending)
+                next_progress = now + interval
+
+    def start_recording(self):
+        """Starts collecting the paths that change, until stop_recording().
+
+        Returns a set that gets the relative paths as events arrive (not
+        coalesced, but without the ignored files).
+        """
+        recorder = set()
+        self._recorders = self._recorders + [recorder]
+        return recorder
+
+    def stop_recording(self, recorder):
+        self._recorders = [r for r in self._recorders if r is not recorder]
+
+    def idle_for(self):
+        """Returns how long ago the last change was recorded, in seconds.
+        """
+        return time.time() - self._last_change
 
     def _timer_expired(self):
-        changes = self._changes
-        self._changes = set()
-        logging.info("Directory stable, syncing...")
-        if DirectoryWatcher.ALL_CHANGED in changes:
+        self._flush(from_timer=True)
+
+    def commit_pending(self):
+        """Calls back with the changes waiting, from this thread.
+
+        For pushes, that take the lock from the timer while changes recorded
+        during the last check-in are waiting: they have to be committed before
+        the push writes to the folder. Call with the lock held.
+
+        Returns False if there were none.
+        """
+        return self._flush(from_timer=False)
+
+    def _flush(self, from_timer):
+        with self._changes_lock:
+            if not self._changes:
+                return False
+            changes = self._changes
+            subtrees = self._subtrees
+            moves = self._moves
+            self._changes = {}
+            self._subtrees = set()
+            self._moves = []
+            self._moved = set()
+            self._taken += 1
+        try:
+            if from_timer:
+                if self._timer.primed_at is not None:
+                    DEBOUNCE.observe(time.time() - self._timer.primed_at,
+                                     folder=self._folder_label)
+                logging.info("Directory stable, syncing...")
+            else:
+                logging.info("Committing changes waiting before push...")
+            self._call_back(changes, subtrees, moves)
+        finally:
+            with self._done_cond:
+                self._done += 1
+                self._done_cond.notifyAll()
+        return True
+
+    def _call_back(self, changes, subtrees, moves):
+        if BaseWatcher.ALL_CHANGED in changes:
             self._callback()
         else:
-            self._callback(changes)
+            # Drop the paths that are in a directory recorded as a whole
+            if subtrees:
+                changes = dict((path, when)
+                               for path, when in iteritems(changes)
+                               if not self._in_subtree(path, subtrees))
+            self._callback(changes, moves)
+
+    @staticmethod
+    def _in_subtree(path, subtrees):
+        """Checks whether one of the parents of `path` is in `subtrees`.
+        """
+        parent = os.path.dirname(path)
+        while parent and parent != path:
+            if parent in subtrees:
+                return True
+            path, parent = parent, os.path.dirname(parent)
+        return False
+
+    def _record(self, what, path, is_directory):
+        """Records a changed path, unless it is ignored.
+
+        Returns True if it was recorded.
+        """
+        if path.startswith(self._prefix):
+            relative = path[len(self._prefix):]
+            if self._ignore.match(relative):
+                self._ignored += 1
+                EVENTS.inc(folder=self._folder_label, kind='ignored')
+                logging.debug("Ignored %s: %s", what, path)
+                self._summarize()
+                return False
+            for recorder in self._recorders:
+                recorder.add(relative)
+
+        self._events += 1
+        self._last_change = time.time()
+        EVENTS.inc(folder=self._folder_label, kind='recorded')
+        logging.debug("%s %s: %s", what,
+                      'directory' if is_directory else 'file', path)
+        self._summarize()
+        with self._changes_lock:
+            if path in self._subtrees:
+                self._changes[path] = time.time()
+                return True
+            elif self._in_subtree(path, self._subtrees):
+                return True
+            if is_directory:
+                self._subtrees.add(path)
+            self._changes[path] = time.time()
+        return True
+
+    def _record_move(self, src, dest):
+        """Records that a path was moved, after recording both paths.
+        """
+        with self._changes_lock:
+            # watchdog also reports the content of a moved directory as moved
+            if (os.path.basename(src) != os.path.basename(dest) or
+                    (os.path.dirname(src), os.path.dirname(dest)) not in
+                    self._moved):
+                self._moves.append((src, dest))
+            self._moved.add((src, dest))
+
+    def _summarize(self):
+        """Logs how many events were received, at most every LOG_INTERVAL.
+        """
+        now = time.time()
+        if now - self._last_summary >= self.LOG_INTERVAL:
+            logging.info("%d changes, %d ignored in the last %.0fs",
+                         self._events, self._ignored,
+                         now - self._last_summary)
+            self._events = self._ignored = 0
+            self._last_summary = now
+
+
+class DirectoryWatcher(BaseWatcher, FileSystemEventHandler):
+    """Watches a folder through watchdog's events.
+    """
+    def __init__(self, folder, callback, lock, timeout, observer=None,
+                 **kwargs):
+        BaseWatcher.__init__(self, folder, callback, lock, timeout, **kwargs)
+
+        # The observer can be shared between watchers, in which case its owner
+        # starts it
+        self._own_observer = observer is None
+        self.observer = Observer() if observer is None else observer
+        self.observer.schedule(self, str(folder), recursive=True)
+
+    def run(self):
+        if self._own_observer:
+            self.observer.start()
 
     def on_moved(self, event):
-        what = 'directory' if event.is_directory else 'file'
-        logging.info("Moved %s: from %s to %s", what, event.src_path,
-                     event.dest_path)
-        self._changes.add(event.src_path)
-        self._changes.add(event.dest_path)
-        self._timer.start()
+        src = self._record("Moved from", event.src_path, event.is_directory)
+        dest = self._record("Moved to", event.dest_path, event.is_directory)
+        if src and dest:
+            self._record_move(event.src_path, event.dest_path)
+        if src or dest:
+            self._timer.start()
 
     def on_created(self, event):
-        what = 'directory' if event.is_directory else 'file'
-        logging.info("Created %s: %s", what, event.src_path)
-        self._changes.add(event.src_path)
-        self._timer.start()
+        if self._record("Created", event.src_path, event.is_directory):
+            self._timer.start()
 
     def on_deleted(self, event):
-        what = 'directory' if event.is_directory else 'file'
-        logging.info("Deleted %s: %s", what, event.src_path)
-        self._changes.add(event.src_path)
-        self._timer.start()
+        if self._record("Deleted", event.src_path, event.is_directory):
+            self._timer.start()
 
     def on_modified(self, event):
-        what = 'directory' if event.is_directory else 'file'
-        logging.info("Modified %s: %s", what, event.src_path)
-        self._changes.add(event.src_path)
-        self._timer.start()
+        if event.is_directory:
+            # A directory is "modified" when its entries change; the entries
+            # themselves get their own events, and staging the directory would
+            # rescan its whole subtree
+            return
+        if self._record("Modified", event.src_path, False):
+            self._timer.start()
+
+
+def _list_dir(path):
+    """Lists a directory, as (name, is_dir, stat) tuples.
+
+    Symbolic links are not followed.
+    """
+    if scandir is not None:
+        result = []
+        for entry in scandir(path):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            result.append((entry.name, stat.S_ISDIR(st.st_mode), st))
+        return result
+    else:
+        result = []
+        for name in os.listdir(path):
+            try:
+                st = os.lstat(os.path.join(path, name))
+            except OSError:
+                continue
+            result.append((name, stat.S_ISDIR(st.st_mode), st))
+        return result
+
+
+def _mtime_ns(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return mtime_ns
+
+
+class PollingWatcher(BaseWatcher):
+    """Watches a folder by scanning it periodically.
+
+    Keeps an index of the tree in memory: for each directory, its mtime and
+    the (is_dir, size, mtime, inode) of its entries. Each pass compares the
+    tree with the index. Directories whose mtime didn't change are not listed
+    again (their entries can't have been added, removed or renamed); only
+    their files are stat'ed, to catch modifications.
+
+    A pass starts every `interval` seconds, but the watcher sleeps long
+    enough between passes to spend at most `budget` (a fraction) of its time
+    scanning.
+    """
+    # A directory modified that recently might change again within the same
+    # mtime, so it is always listed
+    RACY_DELAY = 2.0
+
+    def __init__(self, folder, callback, lock, timeout, interval=10.0,
+                 budget=0.1, **kwargs):
+        BaseWatcher.__init__(self, folder, callback, lock, timeout, **kwargs)
+        self.interval = interval
+        self.budget = budget
+        # relative path of directory -> (mtime_ns, {name: entry})
+        self._index = {}
+        self._thread = None
+
+    def run(self):
+        self._thread = Thread(target=self._poll)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _poll(self):
+        # First pass only builds the index; startup changes are handled by
+        # assume_all_changed()
+        self._scan(emit=False)
+        while True:
+            start = time.time()
+            try:
+                if self._scan(emit=True):
+                    self._timer.start()
+            except Exception:
+                logging.exception("Error scanning %s", self._folder)
+            duration = time.time() - start
+            logging.debug("Scanned %s in %.3fs", self._folder, duration)
+            delay = max(self.interval - duration,
+                        duration * (1.0 - self.budget) / self.budget)
+            time.sleep(delay)
+
+    def _scan(self, emit):
+        """Does a pass over the whole tree, updating the index.
+
+        Returns True if changes were recorded.
+        """
+        self._now = time.time()
+        self._changed = False
+        self._scan_dir('', emit)
+        return self._changed
+
+    def _emit(self, what, relative, is_directory):
+        if self._record(what, self._prefix + relative, is_directory):
+            self._changed = True
+
+    def _scan_dir(self, relative, emit):
+        full = os.path.join(str(self._folder), relative)
+        try:
+            st = os.lstat(full)
+        except OSError:
+            return
+        mtime = _mtime_ns(st)
+        old = self._index.get(relative)
+        if (old is not None and old[0] == mtime and
+                mtime < (self._now - self.RACY_DELAY) * 1000000000):
+            # Directory's entries didn't change, only stat its files
+            entries = old[1]
+            for name, entry in list(entries.items()):
+                if entry[0]:
+                    continue
+                path = os.path.join(relative, name)
+                try:
+                    fst = os.lstat(os.path.join(full, name))
+                except OSError:
+                    # Will be noticed when the directory's mtime changes
+                    continue
+                new = (False, fst.st_size, _mtime_ns(fst), fst.st_ino)
+                if new != entry:
+                    entries[name] = new
+                    if emit:
+                        self._emit("Modified", path, False)
+        else:
+            try:
+                listing = _list_dir(full)
+            except OSError:
+                return
+            old_entries = {} if old is None else old[1]
+            entries = {}
+            for name, is_dir, fst in listing:
+                path = os.path.join(relative, name)
+                if self._ignore.match(path):
+                    continue
+                entry = (is_dir, fst.st_size, _mtime_ns(fst), fst.st_ino)
+                if is_dir:
+                    entry = (True, 0, 0, fst.st_ino)
+                entries[name] = entry
+                prev = old_entries.get(name)
+                if prev is None or prev[0] != is_dir:
+                    if prev is not None:
+                        self._forget(path, prev, emit)
+                    if emit and old is not None:
+                        self._emit("Created", path, is_dir)
+                elif not is_dir and prev != entry and emit:
+                    self._emit("Modified", path, False)
+            for name, prev in old_entries.items():
+                if name not in entries:
+                    self._forget(os.path.join(relative, name), prev, emit)
+            self._index[relative] = mtime, entries
+
+        for name, entry in entries.items():
+            if entry[0]:
+                self._scan_dir(os.path.join(relative, name),
+                               emit and old is not None)
+
+    def _forget(self, relative, entry, emit):
+        """Removes a file or directory from the index.
+        """
+        if entry[0]:
+            prefix = relative + '/'
+            for path in [p for p in self._index
+                         if p == relative or p.startswith(prefix)]:
+                del self._index[path]
+        if emit:
+            self._emit("Deleted", relative, entry[0])
@@ -0,0 +1,278 @@
+from __future__ import unicode_literals
+
+import os
+from rpaths import Path
+import subprocess
+import time
+import unittest
+
+import gitobox.git
+from gitobox.git import GitRepository
+
+
+def git(*args, **kwargs):
+    return subprocess.check_output(['git'] + list(args), **kwargs).strip()
+
+
+class RepositoryTestCase(unittest.TestCase):
+    """Base for tests using a bare repository synced with a folder.
+    """
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='gitobox_test_')
+        self.repo = self.tmp / 'repo.git'
+        self.folder = self.tmp / 'folder'
+        self.folder.mkdir()
+        git('init', '-q', '--bare', self.repo.path)
+
+    def tearDown(self):
+        self.tmp.rmtree()
+
+    def open_repository(self, **kwargs):
+        return GitRepository(self.repo, self.folder, 'master', b'pw', 1,
+                             **kwargs)
+
+    def write(self, name, content):
+        with (self.folder / name).open('wb') as fp:
+            fp.write(content)
+
+    def push_without_hooks(self, files):
+        """Makes a commit on the branch like a push would, without hooks.
+
+        This is what the directory sees if ``post-receive`` never ran.
+        Returns the new commit.
+        """
+        clone = self.tmp / 'clone'
+        if not clone.exists():
+            git('clone', '-q', self.repo.path, clone.path)
+        for name, content in files.items():
+            path = clone / name
+            if content is None:
+                path.remove()
+            else:
+                with path.open('wb') as fp:
+                    fp.write(content)
+        git('-C', clone.path, 'add', '-A')
+        git('-C', clone.path, '-c', 'user.name=Test',
+            '-c', 'user.email=test@example.org',
+            'commit', '-q', '-m', 'pushed')
+        git('--git-dir', self.repo.path, 'fetch', '-q', clone.path,
+            'master:master')
+        return git('--git-dir', self.repo.path, 'rev-parse', 'master')
+
+    def tree_files(self, ref='master'):
+        return set(git('--git-dir', self.repo.path, 'ls-tree', '-r',
+                       '--name-only', ref).split())
+
+
+class TestUnappliedPush(RepositoryTestCase):
+    def test_check_in_after_missed_post_receive(self):
+        """A check-in after a push that wasn't checked out keeps the push.
+        """
+        self.write('a.txt', b'a\n')
+        repository = self.open_repository()
+        repository.check_in()
+        pushed = self.push_without_hooks({'pushed.txt': b'pushed\n',
+                                          'a.txt': None})
+        self.assertEqual(self.tree_files(), set([b'pushed.txt']))
+
+        self.write('b.txt', b'b\n')
+        repository.check_in([self.folder / 'b.txt'])
+
+        self.assertEqual(self.tree_files(),
+                         set([b'pushed.txt', b'b.txt']))
+        self.assertEqual(git('--git-dir', self.repo.path, 'rev-parse',
+                             'master^'), pushed)
+        self.assertTrue((self.folder / 'pushed.txt').is_file())
+        self.assertFalse((self.folder / 'a.txt').exists())
+
+    def test_startup_after_missed_post_receive(self):
+        """Opening the repository again checks out a push that was missed.
+        """
+        self.write('a.txt', b'a\n')
+        self.open_repository().check_in()
+        self.push_without_hooks({'pushed.txt': b'pushed\n'})
+
+        manifest = self.open_repository().check_out_unapplied()
+        self.assertEqual(set(manifest.written), set([b'pushed.txt']))
+        with (self.folder / 'pushed.txt').open('rb') as fp:
+            self.assertEqual(fp.read(), b'pushed\n')
+
+    def test_up_to_date(self):
+        self.write('a.txt', b'a\n')
+        repository = self.open_repository()
+        repository.check_in()
+        self.assertIsNone(repository.check_out_unapplied())
+
+
+class TestFilters(RepositoryTestCase):
+    def check_out_crlf(self, **kwargs):
+        self.write('a.txt', b'a\n')
+        repository = self.open_repository(**kwargs)
+        repository.check_in()
+        pushed = self.push_without_hooks({
+            '.gitattributes': b'*.txt text eol=crlf\n',
+            'small.txt': b'one\ntwo\n'})
+        repository.check_out(pushed)
+        with (self.folder / 'small.txt').open('rb') as fp:
+            return fp.read()
+
+    def test_eol(self):
+        self.assertEqual(self.check_out_crlf(), b'one\r\ntwo\r\n')
+
+    def test_eol_with_lfs(self):
+        """Small files are filtered even if they could be LFS pointers.
+        """
+        self.assertEqual(self.check_out_crlf(lfs_threshold=1 << 20),
+                         b'one\r\ntwo\r\n')
+
+    def test_uses_filters_cached(self):
+        """The index and configuration are only read when they changed.
+        """
+        self.write('a.txt', b'a\n')
+        repository = self.open_repository()
+        repository.check_in()
+        configs = []
+        listings = []
+        get_config = repository._get_config
+        run = repository._run
+
+        def counting_get_config(regexp):
+            configs.append(regexp)
+            return get_config(regexp)
+
+        def counting_run(cmd, **kwargs):
+            if cmd == ['ls-files', '-z']:
+                listings.append(cmd)
+            return run(cmd, **kwargs)
+
+        repository._get_config = counting_get_config
+        repository._run = counting_run
+
+        self.assertFalse(repository._uses_filters([]))
+        self.assertFalse(repository._uses_filters([]))
+        self.assertEqual((len(listings), len(configs)), (1, 1))
+
+        self.assertTrue(repository._uses_filters(
+            [(b'sub/.gitattributes', b'100644', b'0' * 40)]))
+        self.write('.gitattributes', b'*.txt text eol=crlf\n')
+        repository.check_in()
+        self.assertTrue(repository._uses_filters([]))
+        (self.folder / '.gitattributes').remove()
+        repository.check_in()
+        self.assertFalse(repository._uses_filters([]))
+        self.assertEqual((len(listings), len(configs)), (1, 1))
+
+        git('--git-dir', self.repo.path, 'config', 'core.autocrlf', 'true')
+        self.assertTrue(repository._uses_filters([]))
+        self.assertEqual(len(configs), 2)
+
+class TestWriteObject(RepositoryTestCase):
+    def test_freshen(self):
+        """Writing an object that exists updates its mtime.
+        """
+        repository = self.open_repository()
+        blob = repository._write_object('blob', b'content\n')
+        blob = blob.decode('ascii')
+        path = self.repo / 'objects' / blob[:2] / blob[2:]
+        old = time.time() - 30 * 24 * 3600
+        os.utime(path.path, (old, old))
+
+        repository._write_object('blob', b'content\n')
+        self.assertGreater(path.mtime(), old + 3600)
+
+
+class TestPrune(RepositoryTestCase):
+    """Old unreachable objects used again survive the background prune.
+    """
+    def make_old(self, blob):
+        blob = blob.decode('ascii')
+        path = self.repo / 'objects' / blob[:2] / blob[2:]
+        old = time.time() - 30 * 24 * 3600
+        os.utime(path.path, (old, old))
+        return path
+
+    def test_written_in_process(self):
+        repository = self.open_repository()
+        path = self.make_old(repository._write_object('blob', b'target'))
+        repository._write_object('blob', b'target')
+        repository.prune('2.weeks.ago')
+        self.assertTrue(path.exists())
+
+    def test_hashed(self):
+        repository = self.open_repository()
+        self.write('a', b'content\n')
+        st = os.lstat((self.folder / 'a').path)
+        _, blob = repository._hash_files([(b'a', st)])[b'a']
+        path = self.make_old(blob)
+        repository._hash_files([(b'a', st)])
+        repository.prune('2.weeks.ago')
+        self.assertTrue(path.exists())
+
+    def test_unused(self):
+        repository = self.open_repository()
+        path = self.make_old(repository._write_object('blob', b'unused'))
+        repository.prune('2.weeks.ago')
+        self.assertFalse(path.exists())
+
+
+class TestMoves(RepositoryTestCase):
+    def blob(self, name):
+        return git('--git-dir', self.repo.path, 'rev-parse',
+                   'master:%s' % name)
+
+    def test_rename(self):
+        """A renamed file gets the blob of its old path.
+        """
+        self.write('a', b'content\n')
+        repository = self.open_repository()
+        repository.check_in()
+        (self.folder / 'a').rename(self.folder / 'b')
+        repository.check_in()
+        self.assertEqual(self.tree_files(), set([b'b']))
+        self.assertEqual(self.blob('b'), git('hash-object', '--stdin',
+                                             input=b'content\n'))
+
+    def test_same_stat_old_path_exists(self):
+        """A file with the stat of another that is still there is hashed.
+        """
+        self.write('a', b'aaaa\n')
+        repository = self.open_repository()
+        repository.check_in()
+        a_blob = self.blob('a')
+        self.write('b', b'bbbb\n')
+        old = time.time() - 3600
+        os.utime((self.folder / 'b').path, (old, old))
+        # Looks like the inode of b was a's, with the mtime preserved
+        st = os.lstat((self.folder / 'b').path)
+        repository.cache.update([(b'a', st, b'100644', a_blob)])
+        repository.check_in()
+        self.assertEqual(self.blob('b'), git('hash-object', '--stdin',
+                                             input=b'bbbb\n'))
+        self.assertEqual(self.blob('a'), a_blob)
+
+class TestIdleProcesses(RepositoryTestCase):
+    def test_close_if_idle(self):
+        """Batch processes are stopped when idle, restarted when needed.
+        """
+        self.write('a', b'a\n')
+        repository = self.open_repository()
+        repository.check_in()
+        tip = repository.branch_tip()
+        process = repository._cat_file
+        self.assertIsNotNone(process._proc)
+        self.assertIn(process, gitobox.git._running)
+
+        process.close_if_idle()
+        self.assertIsNotNone(process._proc)
+
+        process._last_used -= process.IDLE_TIMEOUT
+        process.close_if_idle()
+        self.assertIsNone(process._proc)
+        self.assertNotIn(process, gitobox.git._running)
+
+        self.assertEqual(repository.branch_tip(), tip)
+        self.assertIsNotNone(process._proc)
+
+
+if __name__ == '__main__':
+    unittest.main()
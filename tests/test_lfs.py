@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+
+import hashlib
+from rpaths import Path
+import shutil
+import unittest
+
+from gitobox import lfs
+from gitobox.lfs import LargeFileStore, parse_pointer
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='gitobox_test_')
+        self.store = LargeFileStore(self.tmp / 'lfs' / 'objects', 0)
+        self._reflink = lfs.reflink
+
+    def tearDown(self):
+        lfs.reflink = self._reflink
+        self.tmp.rmtree()
+
+    def test_changed_after_clone(self):
+        """The object is named after what got cloned, not the file now.
+        """
+        filename = self.tmp / 'big'
+        with filename.open('wb') as fp:
+            fp.write(b'before\n')
+
+        def reflink(src, dst):
+            shutil.copyfileobj(src, dst)
+            src.seek(0)
+            with filename.open('ab') as fp:
+                fp.write(b'after\n')
+            return True
+
+        lfs.reflink = reflink
+        oid, size = parse_pointer(self.store.store(filename.path))
+        self.assertEqual(size, 7)
+        self.assertEqual(oid, hashlib.sha256(b'before\n').hexdigest()
+                         .encode('ascii'))
+        with self.store.object_path(oid).open('rb') as fp:
+            self.assertEqual(fp.read(), b'before\n')
+
+    def test_copy(self):
+        filename = self.tmp / 'big'
+        with filename.open('wb') as fp:
+            fp.write(b'content\n')
+        lfs.reflink = lambda src, dst: False
+        oid, size = parse_pointer(self.store.store(filename.path))
+        self.assertEqual(size, 8)
+        with self.store.object_path(oid).open('rb') as fp:
+            self.assertEqual(fp.read(), b'content\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
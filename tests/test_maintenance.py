@@ -0,0 +1,64 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from gitobox import maintenance
+from gitobox.maintenance import Maintenance
+
+
+class FakeRepository(object):
+    def __init__(self):
+        self.threads = []
+
+    def count_objects(self):
+        self.threads.append(threading.current_thread())
+        return {'count': 0, 'packs': 0}
+
+
+class FakeLock(object):
+    name = 'test'
+
+    def busy(self):
+        return False
+
+
+class FakeWatcher(object):
+    def idle_for(self):
+        return Maintenance.IDLE_DELAY
+
+
+class TestScheduling(unittest.TestCase):
+    def setUp(self):
+        self.scheduled = []
+
+    def tearDown(self):
+        for m in self.scheduled:
+            m.stop()
+
+    def start(self, repository):
+        m = Maintenance(repository, FakeLock(), FakeWatcher(), interval=0.05)
+        m.start()
+        self.scheduled.append(m)
+
+    def test_single_thread(self):
+        """The checks of all the repositories run from one thread.
+        """
+        repositories = [FakeRepository() for _ in range(3)]
+        for repository in repositories:
+            self.start(repository)
+        threads = threading.active_count()
+        self.start(FakeRepository())
+        self.assertEqual(threading.active_count(), threads)
+
+        deadline = time.time() + 5.0
+        while (time.time() < deadline and
+                not all(len(r.threads) >= 2 for r in repositories)):
+            time.sleep(0.05)
+        seen = set(t for r in repositories for t in r.threads)
+        self.assertEqual(seen, set([maintenance._thread]))
+
+
+if __name__ == '__main__':
+    unittest.main()